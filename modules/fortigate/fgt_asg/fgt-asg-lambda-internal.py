@@ -1,13 +1,21 @@
 import os
 import logging
 import time
+import random
 import base64
+import threading
 import urllib
+import http.cookiejar
 import requests
 import re
+import socket
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import boto3
 import botocore
 from botocore.exceptions import ClientError
+from botocore.config import Config
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 class Helper:
     def check_missed_var(required_var_list, target_input):
@@ -17,12 +25,308 @@ class Helper:
                 missed_var_list.append(v)
         return missed_var_list
 
+    def backoff_delay(attempt, base=1, cap=30):
+        # Exponential backoff with jitter, the first waits are short so a FortiGate that just booted is noticed quickly
+        return random.uniform(base, min(cap, base * 2 ** attempt))
+
+class Runtime:
+    # Clients and configuration created once per Lambda container and shared by all invocations
+    instance = None
+    client_configs = {
+        "dynamodb": Config(
+            connect_timeout=5,
+            read_timeout=10,     # seconds to wait for response
+            retries={"max_attempts": 2}
+        )
+    }
+
+    def __init__(self):
+        self.clients = {}
+        self.client_lock = threading.Lock()
+        self.load_config()
+
+    def get():
+        if Runtime.instance is None:
+            Runtime.instance = Runtime()
+        return Runtime.instance
+
+    def refresh():
+        # Drop cached clients and configuration, they will be created again on next use
+        Runtime.instance = Runtime()
+        return Runtime.instance
+
+    def client(self, service_name):
+        with self.client_lock:
+            if service_name not in self.clients:
+                config = Runtime.client_configs.get(service_name, Config(max_pool_connections=50))
+                self.clients[service_name] = boto3.client(
+                    service_name,
+                    endpoint_url=self.endpoint_urls.get(service_name),
+                    config=config
+                )
+            return self.clients[service_name]
+
+    def load_config(self):
+        dydb_endpoint_url = os.getenv("dydb_endpoint_url")
+        # Services reached through PrivateLink endpoints
+        self.endpoint_urls = {}
+        if dydb_endpoint_url:
+            self.endpoint_urls["dynamodb"] = "https://" + dydb_endpoint_url
+
+
+class FortiOSClient:
+    # One pooled session and login cookie per FortiGate, kept for the life of the Lambda container
+    clients = {}
+    clients_lock = threading.Lock()
+    timeout = 20
+    # Login endpoint that worked last time, FortiGates of one group run the same FortiOS version
+    login_api = None
+    # Password change endpoint that worked last time
+    password_change_api = None
+    # Only retry when the connection could not be established, so no request is sent twice
+    retry = Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.5)
+
+    def __init__(self, logger, private_ip, login_port):
+        self.logger = logger
+        self.base_url = f"https://{private_ip}{login_port}"
+        self.host = private_ip
+        self.port = int(login_port[1:]) if login_port else 443
+        self.cookie = {}
+        self.password = ""
+        self.session = requests.Session()
+        # Cookies are sent explicitly from self.cookie, do not let the session replay stale ones
+        self.session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        self.session.verify = False
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=FortiOSClient.retry)
+        self.session.mount("https://", adapter)
+
+    def get(logger, private_ip, login_port):
+        key = f"{private_ip}{login_port}"
+        with FortiOSClient.clients_lock:
+            if key not in FortiOSClient.clients:
+                FortiOSClient.clients[key] = FortiOSClient(logger, private_ip, login_port)
+            client = FortiOSClient.clients[key]
+        client.logger = logger
+        return client
+
+    def is_logged_in(self):
+        return bool(self.cookie.get("cookie") and self.cookie.get("csrftoken"))
+
+    def request(self, method, path, json=None, params=None, timeout=None, auth=True):
+        url = f"{self.base_url}{path}"
+        if timeout is None:
+            timeout = FortiOSClient.timeout
+        for i in range(2):
+            header = {
+                "Content-Type": "application/json"
+            }
+            if auth:
+                header["Cookie"] = self.cookie.get("cookie", "")
+                header["X-CSRFTOKEN"] = self.cookie.get("csrftoken", "")
+            response = self.session.request(method, url, headers=header, params=params, json=json, timeout=timeout)
+            # Cached login has expired or the FortiGate has been replaced, login again once
+            if auth and response.status_code == 401 and i == 0 and self.password:
+                response.close()
+                self.logger.info("Session expired, login to FortiGate instance again.")
+                if not self.login(self.password, max_loop=1):
+                    break
+                continue
+            return response
+        return response
+
+    def ensure_login(self, password, check_get=False, max_loop=10, deadline=None):
+        if self.is_logged_in() and self.password == password:
+            if not check_get or self.check_get():
+                self.logger.info("Reuse cached login of FortiGate instance.")
+                return True
+        return self.login(password, check_get=check_get, max_loop=max_loop, deadline=deadline)
+
+    def is_port_open(self):
+        try:
+            with socket.create_connection((self.host, self.port), timeout=2):
+                return True
+        except OSError as err:
+            self.logger.info(f"Port {self.port} of FortiGate instance is not reachable yet: {err}")
+        return False
+
+    def login(self, password, check_get=False, max_loop=10, deadline=None):
+        self.logger.info("Check connection to FortiGate instance.")
+        login_succ = False
+        encoded_fgt_password = urllib.parse.quote(password)
+        backoff_attempt = 0
+        answered = False
+        for i in range(max_loop * 2):
+            # The other login endpoint is tried at once when FortiGate answered, otherwise wait for it to boot
+            if i > 0 and not (answered and not self.login_api and i % 2):
+                delay = Helper.backoff_delay(backoff_attempt)
+                backoff_attempt += 1
+                if deadline and time.time() + delay > deadline:
+                    self.logger.info("Stop login retry, deadline of the caller is reached.")
+                    break
+                self.logger.info(f"Login try {i}, sleep {delay:.1f} sec.")
+                time.sleep(delay)
+            answered = False
+            # Cheap TCP check first, HTTPS login only when the port is open
+            if not self.is_port_open():
+                continue
+            if self.login_api:
+                api = self.login_api
+            else:
+                api = "logincheck" if i % 2 else "authentication"
+            if api == "logincheck":
+                path = f"/logincheck?username=admin&secretkey={encoded_fgt_password}"
+                body = None
+            else:
+                path = "/api/v2/authentication"
+                body = {
+                    "username" : "admin",
+                    "password" : f"{password}",
+                    "ack_pre_disclaimer" : True
+                }
+            try:
+                response = self.request("POST", path, json=body, auth=False)
+                answered = True
+                if response.status_code == 200:
+                    self.cookie = {
+                        "cookie": "",
+                        "csrftoken": ""
+                    }
+                    login_succ = False
+                    for k, v in response.headers.items():
+                        if k.lower() == "set-cookie":
+                            cookie_list = v.split(',')
+                            cookie_list = [ ele.split(';')[0] for ele in cookie_list]
+                            for item in cookie_list:
+                                cur_v = item.strip()
+                                if api == "logincheck":
+                                    if "ccsrftoken" in cur_v:
+                                        csrftoken = re.search('\"(.*)\"', cur_v)
+                                        if csrftoken and csrftoken.group(1) and csrftoken.group(1) != "0%260":
+                                            self.cookie["csrftoken"] = csrftoken.group(1)
+                                            self.cookie["cookie"] = ";/n".join(cookie_list)
+                                            login_succ = True
+                                else:
+                                    if "ccsrf_token" in cur_v:
+                                        csrftoken = re.search('ccsrf_token.*?=(.*)$', cur_v)
+                                        if csrftoken and csrftoken.group(1) and csrftoken.group(1) != "0%260":
+                                            self.cookie["csrftoken"] = csrftoken.group(1)
+                                            self.cookie["cookie"] = ";/n".join(cookie_list)
+                                            login_succ = True
+                            if login_succ:
+                                break
+                    if login_succ:
+                        self.password = password
+                        self.login_api = api
+                        FortiOSClient.login_api = api
+                    if login_succ and check_get:
+                        login_succ = self.check_get()
+                else:
+                    self.logger.info("Could not get http return status")
+                if self.login_api and (response.status_code != 200 or not self.cookie.get("csrftoken")):
+                    # Remembered endpoint was refused, try both again, also for clients created later by this container
+                    self.login_api = None
+                    if FortiOSClient.login_api == api:
+                        FortiOSClient.login_api = None
+                response.close()
+                if login_succ:
+                    self.logger.info("Check connection to FortiGate instance succeeded.")
+                    break
+            except Exception as err:
+                self.logger.info(f"Could not get http return status, try again. Error: {err}")
+        return login_succ
+
+    def check_get(self):
+        self.logger.info("Check get system status.")
+        fgt_return_status = False
+        try:
+            response = self.request("GET", "/api/v2/monitor/system/status", timeout=30)
+            if response.status_code == 200:
+                response_json = response.json()
+                if response_json:
+                    status = response_json['status']
+                    if status == "success":
+                        fgt_return_status = True
+                else:
+                    self.logger.info("Could not get http return status")
+            response.close()
+        except Exception as err:
+            self.logger.info(f"Could not get http return status, try again. Error {err}")
+        return fgt_return_status
+
+    def get_monitor(self, path):
+        # GET a monitor API and return its results, None if FortiGate did not answer
+        rst = None
+        try:
+            response = self.request("GET", path, timeout=10)
+            if response.status_code == 200:
+                response_json = response.json()
+                if response_json and response_json.get("status") == "success":
+                    rst = response_json.get("results")
+            response.close()
+        except Exception as err:
+            self.logger.info(f"Could not get {path}: {err}")
+        return rst
+
+    def get_boot_state(self):
+        # Time of the last reboot and the VM license status, both change when an activated license reboots FortiGate
+        rst = {}
+        web_ui_state = self.get_monitor("/api/v2/monitor/web-ui/state")
+        if web_ui_state:
+            rst["last_reboot"] = web_ui_state.get("utc_last_reboot")
+        license_status = self.get_monitor("/api/v2/monitor/license/status")
+        if license_status:
+            rst["license_status"] = license_status.get("vm", {}).get("status")
+        return rst
+
+    def wait_ready(self, password, before_state, settle_seconds=30, deadline=None):
+        # Poll FortiGate after license upload until it has rebooted, or the license is valid without a reboot
+        self.logger.info(f"Wait for FortiGate instance to be ready after license upload, state before: {before_state}.")
+        start_time = time.time()
+        attempt = 0
+        while True:
+            cur_state = {}
+            if self.is_port_open() and self.ensure_login(password, max_loop=1):
+                cur_state = self.get_boot_state()
+            if cur_state:
+                if before_state.get("last_reboot") and cur_state.get("last_reboot") and cur_state["last_reboot"] != before_state["last_reboot"]:
+                    self.logger.info("FortiGate instance has rebooted after license upload.")
+                    return True
+                if cur_state.get("license_status") == "VALID":
+                    # Valid license before upload means no reboot, otherwise give the reboot some time to start
+                    if before_state.get("license_status") == "VALID" or time.time() - start_time >= settle_seconds:
+                        self.logger.info("License of FortiGate instance is valid.")
+                        return True
+            delay = Helper.backoff_delay(attempt, cap=10)
+            attempt += 1
+            if deadline and time.time() + delay > deadline:
+                self.logger.info("Stop waiting for FortiGate instance, deadline of the caller is reached.")
+                return False
+            time.sleep(delay)
+
+    def post_monitor(self, path, body):
+        # POST to a monitor API and check the http_status in the returned json
+        fgt_return_status = False
+        response = self.request("POST", path, json=body)
+        if response.status_code == 200:
+            response_json = response.json()
+            https_status = 0
+            if response_json:
+                https_status = response_json['http_status']
+                if https_status == 200:
+                    fgt_return_status = True
+            else:
+                self.logger.info("Could not get http return status")
+        response.close()
+        return fgt_return_status
+
 
 class FgtConf:
     def __init__(self):
         self.logger = logging.getLogger("lambda")
         self.logger.setLevel(logging.INFO)
-        self.cookie = {}
+        self.deadline = None
+        # Time to wait for the FortiGate instance when the caller gives no deadline
+        self.default_wait_seconds = 300
         self.fgt_password = os.getenv("fgt_password")
         self.fgt_login_port = "" if os.getenv("fgt_login_port_number") == "" else ":" + os.getenv("fgt_login_port_number")
         self.return_json = {
@@ -30,14 +334,34 @@ class FgtConf:
             'ResponseContent': None
         }
 
+    def set_deadline(self, remaining_time_in_millis):
+        # Leave a few seconds to return the result
+        self.deadline = time.time() + remaining_time_in_millis / 1000 - 5
+
     def main(self, event):
         self.logger.info(f"Start internal lambda function for FortiOS configuration service.")
         operation = event["operation"]
         parameters = event["parameters"]
+        if not self.load_staged_parameters(parameters):
+            return
+        if parameters.get("deadline"):
+            self.deadline = min(self.deadline, parameters["deadline"]) if self.deadline else parameters["deadline"]
+        if operation == "broadcast_config":
+            missed_var_list = Helper.check_missed_var(["private_ip_list", "config_content"], parameters)
+            if missed_var_list:
+                self.return_json['ErrorMsg'] = "Could not find parameter: " + ", ".join(missed_var_list) + "."
+                return
+            self.return_json['ResponseContent'] = self.broadcast_config(
+                parameters["config_content"],
+                parameters["private_ip_list"],
+                parameters.get("max_workers", 10)
+            )
+            return
         if "private_ip" not in parameters:
             self.return_json['ErrorMsg'] = "Could not find parameter private_ip."
             return
         self.fgt_private_ip = parameters["private_ip"]
+        self.fgt_client = FortiOSClient.get(self.logger, self.fgt_private_ip, self.fgt_login_port)
         if operation == "change_password":
             if "fgt_vm_id" not in parameters:
                 self.return_json['ErrorMsg'] = "Could not find parameter fgt_vm_id."
@@ -63,16 +387,120 @@ class FgtConf:
             if not b_succ:
                 self.return_json['ErrorMsg'] = "Could not cupload configuration to FortiGate instance."
                 return
+        elif operation == "check_health":
+            b_succ = self.fgt_client.ensure_login(self.fgt_password, check_get=True, max_loop=1, deadline=self.deadline)
+            if not b_succ:
+                self.return_json['ErrorMsg'] = f"FortiGate instance {self.fgt_private_ip} is not healthy."
+                return
+        elif operation == "provision_instance":
+            if "fgt_vm_id" not in parameters:
+                self.return_json['ErrorMsg'] = "Could not find parameter fgt_vm_id."
+                return
+            self.return_json['ResponseContent'] = {
+                "steps": self.provision_instance(parameters)
+            }
         else:
             self.return_json['ErrorMsg'] = f"Unknown operation {operation}."
             return
 
+ # Large contents staged on S3 bucket by the main Lambda function
+    def load_staged_parameters(self, parameters):
+        for parameter_name in ["config_content", "license_content"]:
+            staged_object = parameters.get(parameter_name + "_s3")
+            if not staged_object:
+                continue
+            self.logger.info(f"Load {parameter_name} from S3 object {staged_object['key']}.")
+            try:
+                response = Runtime.get().client("s3").get_object(Bucket=staged_object["bucket"], Key=staged_object["key"])
+                parameters[parameter_name] = response["Body"].read().decode("utf-8")
+            except Exception as err:
+                self.logger.error(f"Could not load {parameter_name} from S3 bucket: {err}")
+                self.return_json['ErrorMsg'] = f"Could not load {parameter_name} from S3 bucket."
+                return False
+        return True
+
+ # Push one configuration to many instances
+    def broadcast_config(self, config_content, private_ip_list, max_workers):
+        self.logger.info(f"Broadcast configuration to {len(private_ip_list)} FortiGate instances.")
+        rst = {}
+        if not private_ip_list:
+            return rst
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(private_ip_list)))) as executor:
+            futures = {executor.submit(self.push_config, config_content, private_ip): private_ip for private_ip in private_ip_list}
+            for future in as_completed(futures):
+                private_ip = futures[future]
+                try:
+                    rst[private_ip] = future.result()
+                except Exception as err:
+                    rst[private_ip] = {
+                        "success": False,
+                        "duration": None,
+                        "error": f"{err}"
+                    }
+        return rst
+
+    def push_config(self, config_content, private_ip):
+        # Each target has its own FgtConf so the result and error of one target do not mix with others
+        target = FgtConf()
+        target.deadline = self.deadline
+        target.fgt_private_ip = private_ip
+        target.fgt_client = FortiOSClient.get(self.logger, private_ip, self.fgt_login_port)
+        start_time = time.time()
+        b_succ = bool(target.upload_config(config_content))
+        return {
+            "success": b_succ,
+            "duration": round(time.time() - start_time, 3),
+            "error": target.return_json['ErrorMsg'] if target.return_json['ErrorMsg'] or b_succ else "Could not upload configuration to FortiGate instance."
+        }
+
+ # Provision new instance
+    def provision_instance(self, parameters):
+        # Change password, upload license and upload configuration in order, stop at the first failed step
+        step_list = [
+            ("change_password", lambda: self.change_password(parameters["fgt_vm_id"]))
+        ]
+        if parameters.get("license_type"):
+            step_list.append(("upload_license", lambda: self.upload_license(parameters["license_type"], parameters.get("license_content", ""))))
+        if parameters.get("config_content"):
+            step_list.append(("upload_config", lambda: self.upload_config(parameters["config_content"])))
+        steps = []
+        boot_state = {}
+        for step_name, step_func in step_list:
+            self.logger.info(f"Provision step: {step_name}.")
+            if step_name == "upload_license":
+                # Boot state is read with the session of the new password, a failed read means reboot is detected by license status only
+                if self.fgt_client.ensure_login(self.fgt_password, deadline=self.deadline):
+                    boot_state = self.fgt_client.get_boot_state()
+            if step_name == "upload_config" and "upload_license" in [step["step"] for step in steps]:
+                # FortiGate instance reboots after the license is activated, upload configuration once it is back
+                start_time = time.time()
+                b_ready = self.fgt_client.wait_ready(self.fgt_password, boot_state, deadline=self.deadline)
+                steps.append({
+                    "step": "wait_ready",
+                    "success": b_ready,
+                    "duration": round(time.time() - start_time, 3),
+                    "error": None if b_ready else "FortiGate instance is not confirmed ready after license upload."
+                })
+            start_time = time.time()
+            b_succ = bool(step_func())
+            steps.append({
+                "step": step_name,
+                "success": b_succ,
+                "duration": round(time.time() - start_time, 3),
+                "error": self.return_json['ErrorMsg']
+            })
+            # Errors of each step are reported in its own result
+            self.return_json['ErrorMsg'] = None
+            if not b_succ:
+                break
+        return steps
+
     
  # License
     def upload_license(self, license_type, license_content):
         self.logger.info(f"Upload license to FortiGate instance.")
         # Upload license
-        b_connected = self.connect_to_fgt_http()
+        b_connected = self.fgt_client.ensure_login(self.fgt_password, deadline=self.deadline)
         if not b_connected:
             self.logger.error(f"Could not http connect to FortiGate {self.fgt_private_ip}")
             self.return_json['ErrorMsg'] = f"Could not http connect to FortiGate {self.fgt_private_ip}"
@@ -92,287 +520,155 @@ class FgtConf:
 
     def upload_license_token_http(self, lic_token):
         self.logger.info("Active license token by HTTP.")
-        url = f"https://{self.fgt_private_ip}{self.fgt_login_port}/api/v2/monitor/system/vmlicense/download"
-
-        header = {
-            "Content-Type": "application/json",
-            "Cookie": self.cookie["cookie"],
-            "X-CSRFTOKEN": self.cookie["csrftoken"]
-        }
         body = {
             "token" : lic_token
         }
-        response = requests.post(url, headers=header, json=body, verify=False, timeout=20)
-        fgt_return_status = False
-        if response.status_code == 200:
-            response_json = response.json()
-            https_status = 0
-            if response_json:
-                https_status = response_json['http_status']
-                if https_status == 200:
-                    fgt_return_status = True
-            else:
-                self.logger.info("Could not get http return status")
-
-        response.close()
-        return fgt_return_status
+        return self.fgt_client.post_monitor("/api/v2/monitor/system/vmlicense/download", body)
 
     def upload_license_file_http(self, lic_file_content):
         self.logger.info("Active license token by HTTP.")
-        url = f"https://{self.fgt_private_ip}{self.fgt_login_port}/api/v2/monitor/system/vmlicense/upload"
-        header = {
-            "Content-Type": "application/json",
-            "Cookie": self.cookie["cookie"],
-            "X-CSRFTOKEN": self.cookie["csrftoken"]
-        }
         b64_encode_lic = base64.b64encode(lic_file_content.encode("ascii")).decode("ascii")
         body = {
             "file_content" : b64_encode_lic
         }
-        response = requests.post(url, headers=header, json=body, verify=False, timeout=20)
-        fgt_return_status = False
-        if response.status_code == 200:
-            response_json = response.json()
-            https_status = 0
-            if response_json:
-                https_status = response_json['http_status']
-                if https_status == 200:
-                    fgt_return_status = True
-            else:
-                self.logger.info("Could not get http return status")
-        response.close()
-        return fgt_return_status
+        return self.fgt_client.post_monitor("/api/v2/monitor/system/vmlicense/upload", body)
 
  # FortiGate configuration
     def upload_config(self, config_content):
         self.logger.info("Upload configuration file by HTTP.")
-        b_connected = self.connect_to_fgt_http(check_get=True)
+        b_connected = self.fgt_client.ensure_login(self.fgt_password, check_get=True, deadline=self.deadline)
         if not b_connected:
             self.logger.error(f"Could not http connect to FortiGate {self.fgt_private_ip}")
             self.return_json['ErrorMsg'] = f"Could not http connect to FortiGate {self.fgt_private_ip}"
             return False
-        url = f"https://{self.fgt_private_ip}{self.fgt_login_port}/api/v2/monitor/system/config-script/upload"
-        header = {
-            "Content-Type": "application/json",
-            "Cookie": self.cookie["cookie"],
-            "X-CSRFTOKEN": self.cookie["csrftoken"]
-        }
         b64_encode_lic = base64.b64encode(config_content.encode("ascii")).decode("ascii")
         body = {
             "filename": "config_lambda",
             "file_content" : b64_encode_lic
         }
-        response = requests.post(url, headers=header, json=body, verify=False, timeout=20)
-        fgt_return_status = False
-        if response.status_code == 200:
-            response_json = response.json()
-            https_status = 0
-            if response_json:
-                https_status = response_json['http_status']
-                if https_status == 200:
-                    fgt_return_status = True
-            else:
-                self.logger.info("Could not get http return status")
-        response.close()
-        return fgt_return_status
-
- # using http
-    def connect_to_fgt_http(self, check_get=False, max_loop=10, fgt_password=""):
-        self.logger.info("Check connection to FortiGate instance.")
-        if not fgt_password:
-            fgt_password = self.fgt_password
-        login_succ = False
-        encoded_fgt_password = urllib.parse.quote(fgt_password)
-        for i in range(max_loop * 2):
-            if i > 1:
-                self.logger.info(f"Sleep {i} 30 sec.")
-                time.sleep(30)
-            if i % 2:
-                api = "logincheck"
-                url = f"https://{self.fgt_private_ip}{self.fgt_login_port}/logincheck?username=admin&secretkey={encoded_fgt_password}"
-                header = {
-                    "Content-Type": "application/json"
-                }
-                body = None
-            else:
-                api = "authentication"
-                url = f"https://{self.fgt_private_ip}{self.fgt_login_port}/api/v2/authentication"
-                header = {
-                    "Content-Type": "application/json"
-                }
-                body = {
-                    "username" : "admin",
-                    "password" : f"{fgt_password}",
-                    "ack_pre_disclaimer" : True
-                }
-            try:
-                response = requests.post(url, headers=header, json=body, verify=False, timeout=20)
-                if response.status_code == 200:
-                    self.cookie["cookie"] = ""
-                    self.cookie["csrftoken"] = ""
-                    login_succ = False
-                    for k, v in response.headers.items():
-                        if k.lower() == "set-cookie":
-                            cookie_list = v.split(',')
-                            cookie_list = [ ele.split(';')[0] for ele in cookie_list]
-                            for item in cookie_list:
-                                cur_v = item.strip()
-                                if api == "logincheck":
-                                    if "ccsrftoken" in cur_v:
-                                        csrftoken = re.search('\"(.*)\"', cur_v)
-                                        if csrftoken and csrftoken.group(1) and csrftoken.group(1) != "0%260":
-                                            self.cookie["csrftoken"] = csrftoken.group(1)
-                                            self.cookie["cookie"] = ";/n".join(cookie_list)
-                                            login_succ = True
-                                else:
-                                    if "ccsrf_token" in cur_v:
-                                        csrftoken = re.search('ccsrf_token.*?=(.*)$', cur_v)
-                                        if csrftoken and csrftoken.group(1) and csrftoken.group(1) != "0%260":
-                                            self.cookie["csrftoken"] = csrftoken.group(1)
-                                            self.cookie["cookie"] = ";/n".join(cookie_list)
-                                            login_succ = True
-                            if login_succ:
-                                break
-                    if login_succ and check_get:
-                        login_succ = self.check_get_http()
-                else:
-                    self.logger.info("Could not get http return status")
-                # response.close()
-                if login_succ:
-                    self.logger.info("Check connection to FortiGate instance succeeded.")
-                    break
-            except Exception as err:
-                self.logger.info(f"Could not get http return status, try again. Error: {err}")
-        return login_succ
+        return self.fgt_client.post_monitor("/api/v2/monitor/system/config-script/upload", body)
 
     def change_password(self, fgt_vm_id):
         self.logger.info("Change password for FortiGate instance.")
+        # Retried launch event, the password could have been changed already
+        if self.fgt_client.ensure_login(self.fgt_password, check_get=True, max_loop=1, deadline=self.deadline):
+            self.logger.info("Configured password works, password has been changed already.")
+            return True
         b_succ = False
-        
         session_key = ""
-        max_loop = 10
-        for i in range(max_loop):
-            api = ""
-            if i % 2:
-                api = "loginpwd_change"
-                b_succ_login = self.connect_to_fgt_http(fgt_password=fgt_vm_id, max_loop=1)
-                if not b_succ_login or not self.cookie.get("csrftoken"):
-                    continue
-                session_key = self.cookie["csrftoken"]
-                url = f"https://{self.fgt_private_ip}{self.fgt_login_port}/loginpwd_change"
-                header = {
-                    "Content-Type": "application/json",
-                    "Cookie": self.cookie["cookie"],
-                    "X-CSRFTOKEN": self.cookie["csrftoken"]
-                }
-                params = {
-                    "CSRF_TOKEN" : self.cookie["csrftoken"],
-                    "old_pwd" : fgt_vm_id,
-                    "pwd1" : self.fgt_password,
-                    "pwd2" : self.fgt_password,
-                    "confirm": 1
-                }
-                body = None
-            else:
-                api = "authentication"
-                url = f"https://{self.fgt_private_ip}{self.fgt_login_port}/api/v2/authentication"
-                header = {
-                    "Content-Type": "application/json"
-                }
-                body = {
-                    "username" : "admin",
-                    "secretkey" : f"{fgt_vm_id}",
-                    "password" : f"{fgt_vm_id}",
-                    "ack_pre_disclaimer" : True,
-                    "ack_post_disclaimer" : True,
-                    "new_password1" : f"{self.fgt_password}",
-                    "new_password2" : f"{self.fgt_password}",
-                    "request_key": True
-                }
-                params = None
-            try:
-                response = requests.post(url, headers=header, params=params, json=body, verify=False, timeout=20)
-                if response.status_code == 200:
-                    if api == "authentication":
-                        response_json = response.json()
-                        status_code = 0
-                        if response_json:
-                            status_code = response_json['status_code']
-                            if status_code == 5:
-                                b_succ = True
-                                session_key = response_json['session_key']
-                            else:
-                                self.logger.info(f"Status code is not 5, but {status_code}")
-                        else:
-                            self.logger.info("Could not get http status_code")
-                    else:
-                        response_text = response.text
-                        if "document.location" in response_text:
-                            b_succ = True
-                else:
-                    self.logger.info("Could not get http return status, try check new password.")
-                response.close()
+        # Endpoint that worked last time first, FortiGates of one group run the same FortiOS version
+        api_list = ["authentication", "loginpwd_change"]
+        if FortiOSClient.password_change_api in api_list:
+            api_list.remove(FortiOSClient.password_change_api)
+            api_list.insert(0, FortiOSClient.password_change_api)
+        backoff_attempt = 0
+        # A FortiGate that is still booting is waited for as long as the caller allows
+        deadline = self.deadline if self.deadline else time.time() + self.default_wait_seconds
+        i = 0
+        while True:
+            api = api_list[i % len(api_list)]
+            if self.fgt_client.is_port_open():
+                b_succ, session_key = self.request_password_change(api, fgt_vm_id)
                 if b_succ:
+                    FortiOSClient.password_change_api = api
                     break
-            except Exception as err:
-                self.logger.info(f"Could not get http return status, try again. Error: {err}")
-            b_succ = self.connect_to_fgt_http(max_loop=1)
-            if b_succ:
+                # Change could have been applied without a readable answer
+                if self.fgt_client.login(self.fgt_password, max_loop=1):
+                    b_succ = True
+                    break
+            i += 1
+            # Both endpoints are tried before waiting
+            if i % len(api_list) and self.fgt_client.is_port_open():
+                continue
+            delay = Helper.backoff_delay(backoff_attempt, cap=10)
+            backoff_attempt += 1
+            if time.time() + delay > deadline:
+                self.logger.info("Stop change password retry, deadline of the caller is reached.")
                 break
-            self.logger.info(f"Sleep {i} 10 sec.")
-            time.sleep(10)
+            self.logger.info(f"Change password try {i}, sleep {delay:.1f} sec.")
+            time.sleep(delay)
         if b_succ:
             self.logger.info(f"Password changed successfully.")
             # Logout
-            url = f"https://{self.fgt_private_ip}{self.fgt_login_port}/api/v2/authentication"
-            header = {
-                "Content-Type": "application/json"
+            if session_key:
+                body = {
+                    "session_key": f"{session_key}"
+                }
+                try:
+                    response = self.fgt_client.request("POST", "/api/v2/authentication", json=body, auth=False)
+                    response.close()
+                except Exception as err:
+                    self.logger.info(f"Logout exception. Error: {err}")
+            # Login of the old password can not be reused
+            if self.fgt_client.password != self.fgt_password:
+                self.fgt_client.cookie = {}
+        return b_succ
+
+    def request_password_change(self, api, fgt_vm_id):
+        # Change the initial password, which is the instance ID, by one endpoint
+        b_succ = False
+        session_key = ""
+        if api == "loginpwd_change":
+            b_succ_login = self.fgt_client.login(fgt_vm_id, max_loop=1)
+            if not b_succ_login or not self.fgt_client.cookie.get("csrftoken"):
+                return b_succ, session_key
+            session_key = self.fgt_client.cookie["csrftoken"]
+            path = "/loginpwd_change"
+            params = {
+                "CSRF_TOKEN" : self.fgt_client.cookie["csrftoken"],
+                "old_pwd" : fgt_vm_id,
+                "pwd1" : self.fgt_password,
+                "pwd2" : self.fgt_password,
+                "confirm": 1
             }
+            body = None
+        else:
+            path = "/api/v2/authentication"
             body = {
-                "session_key": f"{session_key}"
+                "username" : "admin",
+                "secretkey" : f"{fgt_vm_id}",
+                "password" : f"{fgt_vm_id}",
+                "ack_pre_disclaimer" : True,
+                "ack_post_disclaimer" : True,
+                "new_password1" : f"{self.fgt_password}",
+                "new_password2" : f"{self.fgt_password}",
+                "request_key": True
             }
-            try:
-                response = requests.post(url, headers=header, json=body, verify=False, timeout=20)
-            except Exception as err:
-                self.logger.info(f"Logout exception. Error: {err}")
-            response.close()
-        
-        return b_succ
-
-    def check_get_http(self):
-        self.logger.info("Check get system status.")
-        url = f"https://{self.fgt_private_ip}{self.fgt_login_port}/api/v2/monitor/system/status"
-        header = {
-            "Content-Type": "application/json",
-            "Cookie": self.cookie["cookie"],
-            "X-CSRFTOKEN": self.cookie["csrftoken"]
-        }
-        fgt_return_status = False
+            params = None
         try:
-            response = requests.get(url, headers=header, verify=False, timeout=30)
+            response = self.fgt_client.request("POST", path, params=params, json=body, auth=(api == "loginpwd_change"))
             if response.status_code == 200:
-                response_json = response.json()
-                if response_json:
-                    status = response_json['status']
-                    if status == "success":
-                        fgt_return_status = True
+                if api == "authentication":
+                    response_json = response.json()
+                    status_code = 0
+                    if response_json:
+                        status_code = response_json['status_code']
+                        if status_code == 5:
+                            b_succ = True
+                            session_key = response_json['session_key']
+                        else:
+                            self.logger.info(f"Status code is not 5, but {status_code}")
+                    else:
+                        self.logger.info("Could not get http status_code")
                 else:
-                    self.logger.info("Could not get http return status")
+                    response_text = response.text
+                    if "document.location" in response_text:
+                        b_succ = True
+            else:
+                self.logger.info("Could not get http return status, try check new password.")
             response.close()
         except Exception as err:
-            self.logger.info(f"Could not get http return status, try again. Error {err}")
-        return fgt_return_status
+            self.logger.info(f"Could not get http return status, try again. Error: {err}")
+        return b_succ, session_key
 
 class Dynamodb:
     def __init__(self):
         self.logger = logging.getLogger("lambda")
         self.logger.setLevel(logging.INFO)
         self.dynamodb_table_name = os.getenv("dynamodb_table_name")
-        self.dydb_endpoint_url = os.getenv("dydb_endpoint_url")
-        self.dynamodb_client = boto3.client(
-            service_name = "dynamodb",
-            endpoint_url = "https://" + self.dydb_endpoint_url
-        )
+        self.record_index_name = "record_type-index"
+        # Only used with the PrivateLink endpoint, the VPC has no other route to DynamoDB
+        self.dynamodb_client = Runtime.get().client("dynamodb")
         self.return_json = {
             'ErrorMsg': None,
             'ResponseContent': None
@@ -413,9 +709,728 @@ class Dynamodb:
             b_succ = self.remove_item_from_dydb(parameters["category"], parameters["attribute_name"], parameters["attribute_content"])
             if not b_succ:
                 self.return_json['ErrorMsg'] = "Could not remove item from DynamoDB."
+        elif operation == "batch_get_item":
+            if "request_items" not in parameters:
+                self.return_json['ErrorMsg'] = "Could not find parameter request_items."
+                return
+            rst = self.batch_get_items(parameters["request_items"])
+            if rst is None:
+                self.return_json['ErrorMsg'] = "Could not batch get items from DynamoDB."
+                return
+            self.return_json['ResponseContent'] = rst
+        elif operation == "transact_write_items":
+            if "operations" not in parameters:
+                self.return_json['ErrorMsg'] = "Could not find parameter operations."
+                return
+            b_succ = self.transact_write_items(parameters["operations"])
+            if not b_succ:
+                self.return_json['ErrorMsg'] = "Could not write items to DynamoDB."
+        elif operation == "acquire_lock":
+            missed_var_list = Helper.check_missed_var(["lock_name", "holder", "lease_seconds", "timeout"], parameters)
+            if missed_var_list:
+                self.return_json['ErrorMsg'] = "Could not find parameter: " + ", ".join(missed_var_list) + "."
+                return
+            fencing_token = self.acquire_lock(parameters["lock_name"], parameters["holder"], parameters["lease_seconds"], parameters["timeout"])
+            if fencing_token is None:
+                self.return_json['ErrorMsg'] = f"Could not acquire lock {parameters['lock_name']}."
+                return
+            self.return_json['ResponseContent'] = {"fencing_token": fencing_token}
+        elif operation == "release_lock":
+            missed_var_list = Helper.check_missed_var(["lock_name", "holder"], parameters)
+            if missed_var_list:
+                self.return_json['ErrorMsg'] = "Could not find parameter: " + ", ".join(missed_var_list) + "."
+                return
+            b_succ = self.release_lock(parameters["lock_name"], parameters["holder"])
+            if not b_succ:
+                self.return_json['ErrorMsg'] = f"Could not release lock {parameters['lock_name']}."
+        elif operation == "renew_lock":
+            missed_var_list = Helper.check_missed_var(["lock_name", "holder", "fencing_token", "lease_seconds"], parameters)
+            if missed_var_list:
+                self.return_json['ErrorMsg'] = "Could not find parameter: " + ", ".join(missed_var_list) + "."
+                return
+            b_succ = self.renew_lock(parameters["lock_name"], parameters["holder"], parameters["fencing_token"], parameters["lease_seconds"])
+            if not b_succ:
+                self.return_json['ErrorMsg'] = f"Could not renew lock {parameters['lock_name']}."
+        elif operation == "check_lock":
+            missed_var_list = Helper.check_missed_var(["lock_name", "holder", "fencing_token"], parameters)
+            if missed_var_list:
+                self.return_json['ErrorMsg'] = "Could not find parameter: " + ", ".join(missed_var_list) + "."
+                return
+            b_valid = self.check_lock(parameters["lock_name"], parameters["holder"], parameters["fencing_token"])
+            if not b_valid:
+                self.return_json['ErrorMsg'] = f"Lock {parameters['lock_name']} is not held by {parameters['holder']}."
+        elif operation == "put_record":
+            missed_var_list = Helper.check_missed_var(["category", "attribute_dict"], parameters)
+            if missed_var_list:
+                self.return_json['ErrorMsg'] = "Could not find parameter: " + ", ".join(missed_var_list) + "."
+                return
+            b_succ = self.put_record(parameters["category"], parameters["attribute_dict"])
+            if not b_succ:
+                self.return_json['ErrorMsg'] = f"Could not put record {parameters['category']}."
+        elif operation == "get_record":
+            if "category" not in parameters:
+                self.return_json['ErrorMsg'] = "Could not find parameter category."
+                return
+            self.return_json['ResponseContent'] = self.get_record(parameters["category"])
+        elif operation == "delete_record":
+            if "category" not in parameters:
+                self.return_json['ErrorMsg'] = "Could not find parameter category."
+                return
+            b_succ = self.delete_record(parameters["category"])
+            if not b_succ:
+                self.return_json['ErrorMsg'] = f"Could not delete record {parameters['category']}."
+        elif operation == "scan_records":
+            if "category_prefix" not in parameters:
+                self.return_json['ErrorMsg'] = "Could not find parameter category_prefix."
+                return
+            self.return_json['ResponseContent'] = self.scan_records(parameters["category_prefix"])
+        elif operation == "query_records":
+            if "category_prefix" not in parameters:
+                self.return_json['ErrorMsg'] = "Could not find parameter category_prefix."
+                return
+            rst = self.query_records(parameters["category_prefix"])
+            if rst is None:
+                self.return_json['ErrorMsg'] = f"Could not query records with prefix {parameters['category_prefix']}."
+                return
+            self.return_json['ResponseContent'] = rst
+        elif operation == "set_map_entry":
+            missed_var_list = Helper.check_missed_var(["category", "attribute_name", "key", "value"], parameters)
+            if missed_var_list:
+                self.return_json['ErrorMsg'] = "Could not find parameter: " + ", ".join(missed_var_list) + "."
+                return
+            b_succ = self.set_map_entry(parameters["category"], parameters["attribute_name"], parameters["key"], parameters["value"])
+            if not b_succ:
+                self.return_json['ErrorMsg'] = f"Could not set {parameters['key']} of {parameters['attribute_name']}."
+        elif operation == "claim_sn":
+            missed_var_list = Helper.check_missed_var(["sn", "instance_id"], parameters)
+            if missed_var_list:
+                self.return_json['ErrorMsg'] = "Could not find parameter: " + ", ".join(missed_var_list) + "."
+                return
+            self.return_json['ResponseContent'] = self.claim_sn(parameters["sn"], parameters["instance_id"], parameters.get("from_pool", False))
+        elif operation == "release_sn":
+            missed_var_list = Helper.check_missed_var(["instance_id", "sn"], parameters)
+            if missed_var_list:
+                self.return_json['ErrorMsg'] = "Could not find parameter: " + ", ".join(missed_var_list) + "."
+                return
+            b_succ = self.release_sn(parameters["instance_id"], parameters["sn"])
+            if not b_succ:
+                self.return_json['ErrorMsg'] = f"Could not release serial number {parameters['sn']}."
+        elif operation == "update_pool_sn":
+            missed_var_list = Helper.check_missed_var(["sn", "action"], parameters)
+            if missed_var_list:
+                self.return_json['ErrorMsg'] = "Could not find parameter: " + ", ".join(missed_var_list) + "."
+                return
+            b_succ = self.update_pool_sn(parameters["sn"], parameters["action"], parameters.get("pool_entry"))
+            if not b_succ:
+                self.return_json['ErrorMsg'] = f"Could not {parameters['action']} serial number {parameters['sn']} of token pool."
+        elif operation == "take_map_entry":
+            missed_var_list = Helper.check_missed_var(["category", "attribute_name", "key"], parameters)
+            if missed_var_list:
+                self.return_json['ErrorMsg'] = "Could not find parameter: " + ", ".join(missed_var_list) + "."
+                return
+            self.return_json['ResponseContent'] = self.take_map_entry(parameters["category"], parameters["attribute_name"], parameters["key"])
         else:
             self.return_json['ErrorMsg'] = f"Unknown operation {operation}."
 
+    def claim_sn(self, sn, instance_id, from_pool=False):
+        # Move one serial number from available_sn_list, or token_pool, to used_sn_map of the instance in one conditional write
+        # Return True, or the token pool entry if from_pool, when the serial number is claimed by this call
+        if from_pool:
+            update_expression = "REMOVE #p.#s SET #u.#i = :sn"
+            # Entries still being prepared by a refill have no VM token yet
+            condition_expression = "attribute_exists(#p.#s.vm_token)"
+            attribute_names = {
+                "#p": "token_pool",
+                "#s": sn
+            }
+            attribute_values = {
+                ":sn": {"S": sn}
+            }
+        else:
+            update_expression = "DELETE #a :s SET #u.#i = :sn"
+            condition_expression = "contains(#a, :sn)"
+            attribute_names = {
+                "#a": "available_sn_list"
+            }
+            attribute_values = {
+                ":s": {"SS": [sn]},
+                ":sn": {"S": sn}
+            }
+        attribute_names["#u"] = "used_sn_map"
+        attribute_names["#i"] = instance_id
+        try:
+            response = self.dynamodb_client.update_item(
+                TableName=self.dynamodb_table_name,
+                Key={
+                    'Category': {
+                        'S': "fortiflex",
+                    }
+                },
+                UpdateExpression=update_expression,
+                ConditionExpression=condition_expression,
+                ExpressionAttributeNames=attribute_names,
+                ExpressionAttributeValues=attribute_values,
+                ReturnValues="UPDATED_OLD"
+            )
+        except ClientError as e:
+            error_code = e.response['Error']['Code']
+            if error_code == "ConditionalCheckFailedException":
+                self.logger.info(f"Serial number {sn} has been claimed by others.")
+            elif error_code == "ValidationException" and self.init_map_attribute("fortiflex", "used_sn_map"):
+                # First serial number ever used
+                return self.claim_sn(sn, instance_id, from_pool)
+            else:
+                self.logger.error(f"Could not claim serial number {sn}: {e}")
+            return None
+        if from_pool:
+            token_pool = self.convert_aws_dydb_to_normal_format(response.get("Attributes", {}).get("token_pool")) or {}
+            return token_pool.get(sn)
+        return True
+
+    def update_pool_sn(self, sn, action, pool_entry=None):
+        # reserve: move the serial number from available_sn_list to an entry of token_pool without VM token
+        # fill: set the prepared entry, release: move the entry back to available_sn_list
+        attribute_names = {
+            "#p": "token_pool",
+            "#s": sn
+        }
+        if action == "reserve":
+            update_expression = "DELETE #a :s SET #p.#s = :e"
+            condition_expression = "contains(#a, :sn)"
+            attribute_names["#a"] = "available_sn_list"
+            attribute_values = {
+                ":s": {"SS": [sn]},
+                ":sn": {"S": sn},
+                ":e": self.convert_to_aws_dydb_format({"reserved_at": time.time()})
+            }
+        elif action == "fill":
+            # Entry is gone if the serial number has been dropped from the inventory meanwhile
+            update_expression = "SET #p.#s = :e"
+            condition_expression = "attribute_exists(#p.#s)"
+            attribute_values = {
+                ":e": self.convert_to_aws_dydb_format(pool_entry)
+            }
+        elif action == "release":
+            update_expression = "REMOVE #p.#s ADD #a :s"
+            condition_expression = "attribute_exists(#p.#s)"
+            attribute_names["#a"] = "available_sn_list"
+            attribute_values = {
+                ":s": {"SS": [sn]}
+            }
+        else:
+            self.logger.error(f"Unknown token pool action: {action}")
+            return False
+        try:
+            self.dynamodb_client.update_item(
+                TableName=self.dynamodb_table_name,
+                Key={
+                    'Category': {
+                        'S': "fortiflex",
+                    }
+                },
+                UpdateExpression=update_expression,
+                ConditionExpression=condition_expression,
+                ExpressionAttributeNames=attribute_names,
+                ExpressionAttributeValues=attribute_values
+            )
+            return True
+        except ClientError as e:
+            error_code = e.response['Error']['Code']
+            if error_code == "ConditionalCheckFailedException":
+                self.logger.info(f"Could not {action} serial number {sn} of token pool, it has been moved by others.")
+            elif error_code == "ValidationException" and action == "reserve" and self.init_map_attribute("fortiflex", "token_pool"):
+                # First serial number ever put into the pool
+                return self.update_pool_sn(sn, action, pool_entry)
+            else:
+                self.logger.error(f"Could not {action} serial number {sn} of token pool: {e}")
+        return False
+
+    def release_sn(self, instance_id, sn):
+        # Move the serial number of the instance from used_sn_map back to available_sn_list in one conditional write
+        try:
+            self.dynamodb_client.update_item(
+                TableName=self.dynamodb_table_name,
+                Key={
+                    'Category': {
+                        'S': "fortiflex",
+                    }
+                },
+                UpdateExpression="REMOVE #u.#i ADD #a :s",
+                ConditionExpression="#u.#i = :sn",
+                ExpressionAttributeNames={
+                    "#u": "used_sn_map",
+                    "#i": instance_id,
+                    "#a": "available_sn_list"
+                },
+                ExpressionAttributeValues={
+                    ":s": {"SS": [sn]},
+                    ":sn": {"S": sn}
+                }
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] == "ConditionalCheckFailedException":
+                self.logger.info(f"Serial number {sn} of instance {instance_id} has been released by others.")
+            else:
+                self.logger.error(f"Could not release serial number {sn}: {e}")
+        return False
+
+    def init_map_attribute(self, category, attribute_name):
+        # Return True only if the empty map is created by this call
+        try:
+            self.dynamodb_client.update_item(
+                TableName=self.dynamodb_table_name,
+                Key={
+                    'Category': {
+                        'S': category,
+                    }
+                },
+                UpdateExpression="SET #a = :m",
+                ConditionExpression="attribute_not_exists(#a)",
+                ExpressionAttributeNames={
+                    "#a": attribute_name
+                },
+                ExpressionAttributeValues={
+                    ":m": {"M": {}}
+                }
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] != "ConditionalCheckFailedException":
+                self.logger.error(f"Could not create map attribute {attribute_name}: {e}")
+        return False
+
+    def set_map_entry(self, category, attribute_name, key, value):
+        # Set one entry of a map attribute without rewriting the whole map
+        aws_format_content = self.convert_to_aws_dydb_format(value)
+        try:
+            self.dynamodb_client.update_item(
+                TableName=self.dynamodb_table_name,
+                Key={
+                    'Category': {
+                        'S': category,
+                    }
+                },
+                UpdateExpression="SET #a.#k = :v",
+                ExpressionAttributeNames={
+                    "#a": attribute_name,
+                    "#k": key
+                },
+                ExpressionAttributeValues={
+                    ":v": aws_format_content
+                }
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] != "ValidationException":
+                self.logger.error(f"Could not set {key} of {attribute_name}: {e}")
+                return False
+        # Map attribute does not exist yet
+        try:
+            self.dynamodb_client.update_item(
+                TableName=self.dynamodb_table_name,
+                Key={
+                    'Category': {
+                        'S': category,
+                    }
+                },
+                UpdateExpression="SET #a = :m",
+                ConditionExpression="attribute_not_exists(#a)",
+                ExpressionAttributeNames={
+                    "#a": attribute_name
+                },
+                ExpressionAttributeValues={
+                    ":m": {"M": {key: aws_format_content}}
+                }
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] == "ConditionalCheckFailedException":
+                # Map has been created by others meanwhile
+                return self.set_map_entry(category, attribute_name, key, value)
+            self.logger.error(f"Could not set {key} of {attribute_name}: {e}")
+        return False
+
+    def take_map_entry(self, category, attribute_name, key):
+        # Remove one entry of a map attribute and return its value, only one caller gets the entry
+        try:
+            response = self.dynamodb_client.update_item(
+                TableName=self.dynamodb_table_name,
+                Key={
+                    'Category': {
+                        'S': category,
+                    }
+                },
+                UpdateExpression="REMOVE #a.#k",
+                ConditionExpression="attribute_exists(#a.#k)",
+                ExpressionAttributeNames={
+                    "#a": attribute_name,
+                    "#k": key
+                },
+                ReturnValues="UPDATED_OLD"
+            )
+            old_value = self.convert_aws_dydb_to_normal_format(response.get("Attributes", {}).get(attribute_name)) or {}
+            return old_value.get(key)
+        except ClientError as e:
+            if e.response['Error']['Code'] == "ConditionalCheckFailedException":
+                self.logger.info(f"Entry {key} of {attribute_name} has been taken by others.")
+            else:
+                self.logger.error(f"Could not take {key} of {attribute_name}: {e}")
+        return None
+
+    def put_record(self, category, attribute_dict):
+        b_succ = False
+        updated_at = time.time()
+        item = {
+            'Category': {
+                'S': category,
+            },
+            'updated_at': {
+                'N': str(updated_at)
+            }
+        }
+        if "#" in category:
+            # Records of one kind are listed by querying the record type index
+            item['record_type'] = {
+                'S': category[:category.index("#") + 1]
+            }
+        for attribute_name, attribute_content in attribute_dict.items():
+            aws_format_content = self.convert_to_aws_dydb_format(attribute_content)
+            if aws_format_content:
+                item[attribute_name] = aws_format_content
+        try:
+            self.dynamodb_client.put_item(
+                TableName=self.dynamodb_table_name,
+                Item=item,
+                ConditionExpression="attribute_not_exists(#u) OR #u <= :u",
+                ExpressionAttributeNames={
+                    "#u": "updated_at"
+                },
+                ExpressionAttributeValues={
+                    ":u": {"N": str(updated_at)}
+                }
+            )
+            b_succ = True
+        except ClientError as e:
+            if e.response['Error']['Code'] == "ConditionalCheckFailedException":
+                self.logger.info(f"Record {category} has been updated by others, skip this write.")
+            else:
+                self.logger.error(f"Could not put record {category}: {e}")
+        return b_succ
+
+    def get_record(self, category):
+        rst = {}
+        try:
+            response = self.dynamodb_client.get_item(
+                TableName=self.dynamodb_table_name,
+                Key={
+                    'Category': {
+                        'S': category,
+                    }
+                },
+                ConsistentRead=True
+            )
+            rst = self.convert_aws_dydb_to_normal_format({"M": response.get("Item", {})})
+        except Exception as err:
+            self.logger.error(f"Could not get record {category}: {err}")
+        return rst
+
+    def delete_record(self, category):
+        b_succ = False
+        try:
+            self.dynamodb_client.delete_item(
+                TableName=self.dynamodb_table_name,
+                Key={
+                    'Category': {
+                        'S': category,
+                    }
+                }
+            )
+            b_succ = True
+        except Exception as err:
+            self.logger.error(f"Could not delete record {category}: {err}")
+        return b_succ
+
+    def scan_records(self, category_prefix):
+        rst = []
+        try:
+            paginator = self.dynamodb_client.get_paginator("scan")
+            page_iterator = paginator.paginate(
+                TableName=self.dynamodb_table_name,
+                FilterExpression="begins_with(#c, :p)",
+                ExpressionAttributeNames={
+                    "#c": "Category"
+                },
+                ExpressionAttributeValues={
+                    ":p": {"S": category_prefix}
+                }
+            )
+            for page in page_iterator:
+                for item in page.get("Items", []):
+                    rst.append(self.convert_aws_dydb_to_normal_format({"M": item}))
+        except Exception as err:
+            self.logger.error(f"Could not scan records with prefix {category_prefix}: {err}")
+        return rst
+
+    def query_records(self, category_prefix):
+        # Return None if the table has no record type index
+        rst = []
+        try:
+            paginator = self.dynamodb_client.get_paginator("query")
+            page_iterator = paginator.paginate(
+                TableName=self.dynamodb_table_name,
+                IndexName=self.record_index_name,
+                KeyConditionExpression="#t = :t",
+                ExpressionAttributeNames={
+                    "#t": "record_type"
+                },
+                ExpressionAttributeValues={
+                    ":t": {"S": category_prefix}
+                }
+            )
+            for page in page_iterator:
+                for item in page.get("Items", []):
+                    rst.append(self.convert_aws_dydb_to_normal_format({"M": item}))
+        except Exception as err:
+            self.logger.error(f"Could not query records with prefix {category_prefix}: {err}")
+            return None
+        return rst
+
+    def acquire_lock(self, lock_name, holder, lease_seconds, timeout):
+        deadline = time.time() + timeout
+        wait_time = 0.05
+        while True:
+            cur_time = time.time()
+            try:
+                response = self.dynamodb_client.update_item(
+                    TableName=self.dynamodb_table_name,
+                    Key={
+                        'Category': {
+                            'S': f"lock#{lock_name}",
+                        }
+                    },
+                    UpdateExpression="SET #h = :h, #e = :e ADD #f :one",
+                    ConditionExpression="attribute_not_exists(#h) OR #e < :now",
+                    ExpressionAttributeNames={
+                        "#h": "holder",
+                        "#e": "expires_at",
+                        "#f": "fencing_token"
+                    },
+                    ExpressionAttributeValues={
+                        ":h": {"S": holder},
+                        ":e": {"N": str(cur_time + lease_seconds)},
+                        ":now": {"N": str(cur_time)},
+                        ":one": {"N": "1"}
+                    },
+                    ReturnValues="UPDATED_NEW"
+                )
+                return int(response["Attributes"]["fencing_token"]["N"])
+            except ClientError as e:
+                if e.response['Error']['Code'] != "ConditionalCheckFailedException":
+                    self.logger.error(f"Could not acquire lock {lock_name}: {e}")
+                    return None
+            if time.time() + wait_time > deadline:
+                break
+            # Full jitter backoff so that waiters do not wake up together
+            time.sleep(random.uniform(0, wait_time))
+            wait_time = min(wait_time * 2, 1)
+        self.logger.error(f"Timeout when acquire lock {lock_name}.")
+        return None
+
+    def release_lock(self, lock_name, holder):
+        b_succ = False
+        try:
+            self.dynamodb_client.update_item(
+                TableName=self.dynamodb_table_name,
+                Key={
+                    'Category': {
+                        'S': f"lock#{lock_name}",
+                    }
+                },
+                UpdateExpression="REMOVE #h, #e",
+                ConditionExpression="#h = :h",
+                ExpressionAttributeNames={
+                    "#h": "holder",
+                    "#e": "expires_at"
+                },
+                ExpressionAttributeValues={
+                    ":h": {"S": holder}
+                }
+            )
+            b_succ = True
+        except ClientError as e:
+            if e.response['Error']['Code'] == "ConditionalCheckFailedException":
+                self.logger.error(f"Lock {lock_name} is not held by {holder}, the lease may have expired.")
+            else:
+                self.logger.error(f"Could not release lock {lock_name}: {e}")
+        return b_succ
+
+    def renew_lock(self, lock_name, holder, fencing_token, lease_seconds):
+        b_succ = False
+        try:
+            self.dynamodb_client.update_item(
+                TableName=self.dynamodb_table_name,
+                Key={
+                    'Category': {
+                        'S': f"lock#{lock_name}",
+                    }
+                },
+                UpdateExpression="SET #e = :e",
+                # Holder and fencing token only stay the same while nobody else has acquired the lock
+                ConditionExpression="#h = :h AND #f = :f",
+                ExpressionAttributeNames={
+                    "#h": "holder",
+                    "#e": "expires_at",
+                    "#f": "fencing_token"
+                },
+                ExpressionAttributeValues={
+                    ":h": {"S": holder},
+                    ":f": {"N": str(fencing_token)},
+                    ":e": {"N": str(time.time() + lease_seconds)}
+                }
+            )
+            b_succ = True
+        except ClientError as e:
+            if e.response['Error']['Code'] == "ConditionalCheckFailedException":
+                self.logger.error(f"Lock {lock_name} has been taken over, could not renew it for {holder}.")
+            else:
+                self.logger.error(f"Could not renew lock {lock_name}: {e}")
+        return b_succ
+
+    def check_lock(self, lock_name, holder, fencing_token):
+        b_valid = False
+        try:
+            response = self.dynamodb_client.get_item(
+                TableName=self.dynamodb_table_name,
+                Key={
+                    'Category': {
+                        'S': f"lock#{lock_name}",
+                    }
+                },
+                ConsistentRead=True
+            )
+            item = response.get("Item", {})
+            b_valid = item.get("holder", {}).get("S") == holder and \
+                int(item.get("fencing_token", {}).get("N", "0")) == fencing_token and \
+                float(item.get("expires_at", {}).get("N", "0")) > time.time()
+        except Exception as err:
+            self.logger.error(f"Could not check lock {lock_name}: {err}")
+        return b_valid
+
+    def batch_get_items(self, request_items):
+        # Return None if not all items could be read
+        rst = {}
+        b_succ = False
+        try:
+            attribute_names = set()
+            for attributes in request_items.values():
+                attribute_names.update(attributes)
+            expression_attribute_names = {"#c": "Category"}
+            projection_list = ["#c"]
+            for i, attribute_name in enumerate(sorted(attribute_names)):
+                expression_attribute_names[f"#a{i}"] = attribute_name
+                projection_list.append(f"#a{i}")
+            keys_and_attributes = {
+                'Keys': [{'Category': {'S': category}} for category in request_items],
+                'ProjectionExpression': ", ".join(projection_list),
+                'ExpressionAttributeNames': expression_attribute_names
+            }
+            unprocessed = {self.dynamodb_table_name: keys_and_attributes}
+            max_loop = 5
+            for i in range(max_loop):
+                response = self.dynamodb_client.batch_get_item(RequestItems=unprocessed)
+                for item in response.get("Responses", {}).get(self.dynamodb_table_name, []):
+                    category = item.pop("Category").get("S")
+                    rst[category] = {}
+                    for attr_name in request_items.get(category, []):
+                        if attr_name in item:
+                            rst[category][attr_name] = self.convert_aws_dydb_to_normal_format(item[attr_name])
+                unprocessed = response.get("UnprocessedKeys")
+                if not unprocessed:
+                    b_succ = True
+                    break
+                time.sleep(0.05 * (2 ** i))
+        except Exception as err:
+            self.logger.error(f"Could not batch get items from Dynamo DB table: {err}")
+        return rst if b_succ else None
+
+    def transact_write_items(self, operation_list):
+        b_succ = False
+        try:
+            category_dict = {}
+            for operation in operation_list:
+                category_dict.setdefault(operation["category"], []).append(operation)
+            transact_items = []
+            for category, category_operation_list in category_dict.items():
+                update_item = self.build_update_item(category, category_operation_list)
+                if update_item:
+                    transact_items.append({"Update": update_item})
+            # TransactWriteItems accepts at most 100 items
+            for i in range(0, len(transact_items), 100):
+                self.dynamodb_client.transact_write_items(TransactItems=transact_items[i:i + 100])
+            b_succ = True
+        except Exception as err:
+            self.logger.error(f"Could not write items to Dynamo DB table: {err}")
+        return b_succ
+
+    def build_update_item(self, category, operation_list):
+        set_list = []
+        add_list = []
+        delete_list = []
+        remove_list = []
+        expression_attribute_names = {}
+        expression_attribute_values = {}
+        for i, operation in enumerate(operation_list):
+            name_key = f"#a{i}"
+            value_key = f":v{i}"
+            action = operation["action"]
+            attribute_content = operation["attribute_content"]
+            if action in ["ADD", "DELETE"] and type(attribute_content) is list:
+                attribute_content = set(attribute_content)
+            aws_format_content = self.convert_to_aws_dydb_format(attribute_content)
+            if action == "PUT":
+                if aws_format_content:
+                    set_list.append(f"{name_key} = {value_key}")
+                else:
+                    remove_list.append(name_key)
+            elif not aws_format_content:
+                self.logger.info(f"Attribute content is empty: {attribute_content}")
+                continue
+            elif action == "ADD":
+                add_list.append(f"{name_key} {value_key}")
+            elif action == "DELETE":
+                delete_list.append(f"{name_key} {value_key}")
+            else:
+                self.logger.error(f"Unknown Dynamo DB write action: {action}")
+                continue
+            expression_attribute_names[name_key] = operation["attribute_name"]
+            if aws_format_content:
+                expression_attribute_values[value_key] = aws_format_content
+        update_expression = ""
+        if set_list:
+            update_expression += "SET " + ", ".join(set_list) + " "
+        if add_list:
+            update_expression += "ADD " + ", ".join(add_list) + " "
+        if delete_list:
+            update_expression += "DELETE " + ", ".join(delete_list) + " "
+        if remove_list:
+            update_expression += "REMOVE " + ", ".join(remove_list) + " "
+        if not update_expression:
+            return None
+        update_item = {
+            'TableName': self.dynamodb_table_name,
+            'Key': {
+                'Category': {
+                    'S': category,
+                }
+            },
+            'UpdateExpression': update_expression.strip(),
+            'ExpressionAttributeNames': expression_attribute_names
+        }
+        if expression_attribute_values:
+            update_item['ExpressionAttributeValues'] = expression_attribute_values
+        return update_item
+
     def get_item_from_dydb(self, category, attributes):
         rst = {}
         try:
@@ -590,9 +1605,13 @@ class Dynamodb:
 def lambda_handler(event, context):
     service = event["service"]
     response = None
+    start_time = time.time()
+    if event.get("refresh_runtime"):
+        Runtime.refresh()
     ## FortiGate configuration operations
     if service == "fgt_vm":
         fgtObject = FgtConf()
+        fgtObject.set_deadline(context.get_remaining_time_in_millis())
         fgtObject.main(event)
         response = fgtObject.return_json
     elif service == "dynamodb":
@@ -604,4 +1623,20 @@ def lambda_handler(event, context):
             'ErrorMsg': f"Unknown service: {service}.",
             'ResponseContent': None
         }
-    return response
\ No newline at end of file
+    # Asynchronous caller waits for the status record of the operation
+    # Status records can only be written when the VPC has a route to DynamoDB
+    if event.get("op_id") and os.getenv("dydb_endpoint_url"):
+        put_op_status(event, response, time.time() - start_time)
+    return response
+
+def put_op_status(event, response, duration):
+    attribute_dict = {
+        "operation": event.get("operation", ""),
+        "state": "failed" if response['ErrorMsg'] else "succeeded",
+        "error": response['ErrorMsg'] or "",
+        "duration": round(duration, 3),
+        # Status records that nobody waits for are expired by the table TTL
+        "expire_at": int(time.time()) + 3600
+    }
+    if not Dynamodb().put_record("op_status#" + event["op_id"], attribute_dict):
+        logging.getLogger("lambda").error(f"Could not save status of operation {event['op_id']}.")
\ No newline at end of file
@@ -6,11 +6,19 @@ import requests
 import re
 import uuid
 import base64
+import threading
+import codecs
+import copy
+import random
+import hashlib
+import functools
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import boto3
 import botocore
 from botocore.exceptions import ClientError
 from botocore.config import Config
+from requests.adapters import HTTPAdapter
 
 class Helper:
     def set_to_list(input_content):
@@ -33,21 +41,1466 @@ class Helper:
                     input_content[k] = v
                 Helper.set_to_list(v)
 
+    def iter_json_list(body, chunk_size=65536):
+        # Yield the elements of a JSON list from a streaming body without loading the whole file
+        decoder = json.JSONDecoder()
+        text_decoder = codecs.getincrementaldecoder("utf-8")()
+        buffer = ""
+        b_started = False
+        b_finished = False
+        for chunk in body.iter_chunks(chunk_size):
+            buffer += text_decoder.decode(chunk)
+            pos = 0
+            while True:
+                while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                    pos += 1
+                if pos >= len(buffer):
+                    break
+                if not b_started:
+                    if buffer[pos] != "[":
+                        raise ValueError("Content is not a JSON list.")
+                    b_started = True
+                    pos += 1
+                    continue
+                if buffer[pos] == "]":
+                    b_finished = True
+                    break
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                except ValueError:
+                    # Element is not complete yet, wait for next chunk
+                    break
+                if end >= len(buffer) and type(item) in [int, float]:
+                    # A number may continue in next chunk
+                    break
+                yield item
+                pos = end
+            buffer = buffer[pos:]
+            if b_finished:
+                return
+        if not b_finished:
+            raise ValueError("Content is not a complete JSON list.")
+
+    def invoke_lambda(logger, lambda_client, function_name, payload, invocation_type=""):
+        b_succ= False
+        rst = {}
+        if invocation_type == "":
+            invocation_type = 'RequestResponse'
+        try:
+            # Payload could be serialized by the caller already
+            if type(payload) is not str:
+                Helper.set_to_list(payload)
+                payload = json.dumps(payload)
+            response = lambda_client.invoke(
+                FunctionName = function_name,
+                InvocationType = invocation_type,
+                Payload = payload
+            )
+            if "StatusCode" in response and response["StatusCode"] in [200, 202, 204]:
+                b_succ = True
+                payload_contant = response["Payload"].read()
+                if payload_contant:
+                    payload_contant_json = json.loads(payload_contant.decode("utf-8"))
+                    if payload_contant_json["ErrorMsg"]:
+                        logger.error("Invoke lambda function response error msg: {}".format(payload_contant_json["ErrorMsg"]))
+                        b_succ = False
+                    else:
+                        rst = payload_contant_json["ResponseContent"]
+            else:
+                errmsg = ""
+                if "FunctionError" in response:
+                    errmsg = response["FunctionError"]
+                logger.error(f"Invoke lambda function failed: {errmsg}")
+        except Exception as err:
+            logger.error(f"Could not invoke lambda function, error: {err}")
+        return b_succ, rst
+
+    def run_concurrently(logger, func, arg_dict, max_workers):
+        # Call func for each value of arg_dict with bounded parallelism, result is keyed like arg_dict
+        rst = {}
+        if not arg_dict:
+            return rst
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(arg_dict)))) as executor:
+            futures = {executor.submit(func, arg): key for key, arg in arg_dict.items()}
+            for future in as_completed(futures):
+                try:
+                    rst[futures[future]] = future.result()
+                except Exception as err:
+                    logger.error(f"Concurrent call for {futures[future]} failed: {err}")
+                    rst[futures[future]] = None
+        return rst
+
+class Runtime:
+    # Clients and parsed configuration created once per Lambda container and shared by all invocations
+    instance = None
+    client_configs = {
+        "lambda": Config(
+            read_timeout=int(os.getenv("lambda_timeout") or 300),     # seconds to wait for response
+            max_pool_connections=50
+        ),
+        "dynamodb": Config(
+            read_timeout=10,     # seconds to wait for response
+            max_pool_connections=50
+        )
+    }
+
+    def __init__(self):
+        self.clients = {}
+        self.client_lock = threading.Lock()
+        # Pooled HTTPS session for FortiFlex APIs, safe to share between worker threads
+        self.http_session = requests.Session()
+        self.http_session.mount("https://", HTTPAdapter(pool_maxsize=int(os.getenv("fanout_concurrency") or 10)))
+        self.load_config()
+
+    def get():
+        if Runtime.instance is None:
+            Runtime.instance = Runtime()
+        return Runtime.instance
+
+    def refresh():
+        # Drop cached clients and configuration, they will be created again on next use
+        Runtime.instance = Runtime()
+        return Runtime.instance
+
+    def client(self, service_name):
+        with self.client_lock:
+            if service_name not in self.clients:
+                config = Runtime.client_configs.get(service_name, Config(max_pool_connections=50))
+                self.clients[service_name] = boto3.client(service_name, config=config)
+            return self.clients[service_name]
+
+    def load_config(self):
+        self.network_interfaces = json.loads(os.getenv("network_interfaces") or "{}")
+        self.fmg_integration = json.loads(os.getenv("fmg_integration") or "null")
+        self.gwlb_ips = json.loads(os.getenv("gwlb_ips") or "{}")
+        self.az_name_map = json.loads(os.getenv("az_name_map") or "{}")
+        self.user_conf_s3 = json.loads(os.getenv("user_conf_s3") or "{}")
+        self.fortiflex_sn_list = json.loads(os.getenv("fortiflex_sn_list") or "[]")
+        self.fortiflex_configid_list = json.loads(os.getenv("fortiflex_configid_list") or "[]")
+        # Rendered GENEVE blocks of every interface and AZ, they only depend on the configuration above
+        self.geneve_blocks = {}
+        # FortiFlex OAuth token and its absolute expiry time, shared by warm invocations
+        self.fortiflex_oauth = {
+            "oauth_token": "",
+            "expires_at": 0
+        }
+
+class Dynamodb:
+    def __init__(self, logger):
+        self.logger = logger
+        runtime = Runtime.get()
+        self.enable_privatelink_dydb = os.getenv("enable_privatelink_dydb") == "true"
+        self.internal_lambda_name = os.getenv("internal_lambda_name")
+        if self.enable_privatelink_dydb:
+            self.lambda_client = runtime.client("lambda")
+        else:
+            self.dynamodb_client = runtime.client("dynamodb")
+            self.dynamodb_table_name = os.getenv("dynamodb_table_name")
+        self.record_index_name = "record_type-index"
+        self.record_index_prefix = "record_index#"
+        # Batch mode: reads are served from item_cache and writes are buffered in write_buffer until flushed
+        self.batch_mode = False
+        self.item_cache = {}
+        self.write_buffer = {}
+        # Asynchronous internal Lambda function operations, {op_id: operation}
+        self.op_status_prefix = "op_status#"
+        self.pending_ops = {}
+
+    def invoke_internal_lambda(self, operation, parameters, invocation_type=""):
+        payload = {
+            "service" : "dynamodb",
+            "operation" : operation,
+            "parameters" : parameters
+        }
+        op_id = self.track_op(operation) if invocation_type == "Event" else ""
+        if op_id:
+            payload["op_id"] = op_id
+        b_succ, rst = Helper.invoke_lambda(self.logger, self.lambda_client, self.internal_lambda_name, payload, invocation_type)
+        if not b_succ and payload.get("op_id"):
+            # Operation never started, there will be no status record
+            self.pending_ops.pop(payload["op_id"], None)
+        return b_succ, rst
+
+  # Asynchronous operation status
+    def track_op(self, operation):
+        # The internal Lambda function writes the status record of the operation when it is done,
+        # it can only reach the table through PrivateLink, otherwise the operation is not tracked
+        if not self.enable_privatelink_dydb:
+            return ""
+        op_id = uuid.uuid4().hex
+        self.pending_ops[op_id] = operation
+        return op_id
+
+    def wait_ops(self, op_id_list=None, deadline=None, max_workers=10):
+        # Wait for status records of operations until all of them are done or the deadline is reached
+        if op_id_list is None:
+            op_id_list = list(self.pending_ops.keys())
+        rst = {}
+        waiting_list = list(op_id_list)
+        attempt = 0
+        while waiting_list:
+            record_dict = Helper.run_concurrently(
+                self.logger,
+                lambda op_id: self.get_record(self.op_status_prefix + op_id),
+                {op_id: op_id for op_id in waiting_list},
+                max_workers
+            )
+            for op_id in list(waiting_list):
+                record = record_dict.get(op_id) or {}
+                if record.get("state") not in ["succeeded", "failed"]:
+                    continue
+                rst[op_id] = {
+                    "operation": record.get("operation", self.pending_ops.get(op_id, "")),
+                    "state": record["state"],
+                    "error": record.get("error", ""),
+                    "duration": record.get("duration")
+                }
+                waiting_list.remove(op_id)
+                self.pending_ops.pop(op_id, None)
+                self.delete_record(self.op_status_prefix + op_id)
+            if not waiting_list or (deadline and time.time() >= deadline):
+                break
+            time.sleep(min(0.2 * 2 ** attempt, 2))
+            attempt += 1
+        for op_id in waiting_list:
+            rst[op_id] = {
+                "operation": self.pending_ops.get(op_id, ""),
+                "state": "pending",
+                "error": "",
+                "duration": None
+            }
+        return rst
+
+  # Batch operations
+    def begin_batch(self, prefetch_items=None):
+        self.logger.info("Begin Dynamo DB batch.")
+        self.batch_mode = True
+        self.item_cache = {}
+        self.write_buffer = {}
+        if prefetch_items:
+            self.batch_get_items(prefetch_items)
+
+    def end_batch(self):
+        self.logger.info("End Dynamo DB batch.")
+        b_succ = self.flush_batch()
+        self.batch_mode = False
+        self.item_cache = {}
+        self.write_buffer = {}
+        return b_succ
+
+    def flush_batch(self):
+        if not self.write_buffer:
+            return True
+        operation_list = []
+        for category, attribute_dict in self.write_buffer.items():
+            for attribute_name, (action, attribute_content) in attribute_dict.items():
+                operation_list.append({
+                    "category": category,
+                    "attribute_name": attribute_name,
+                    # Serializing the payload converts sets in place, the buffer must stay intact for a retry
+                    "attribute_content": copy.deepcopy(attribute_content),
+                    "action": action
+                })
+        b_succ = self.transact_write_items(operation_list)
+        if b_succ:
+            self.write_buffer = {}
+        else:
+            # Keep buffered operations so the next flush retries them
+            self.logger.error(f"Could not flush {len(operation_list)} buffered Dynamo DB operations.")
+        return b_succ
+
+    def buffer_operation(self, category, attribute_name, attribute_content, action):
+        category_buffer = self.write_buffer.setdefault(category, {})
+        if attribute_name in category_buffer:
+            buffered_action, buffered_content = category_buffer[attribute_name]
+            if action == "PUT":
+                pass
+            elif action == buffered_action:
+                attribute_content = set(buffered_content) | set(attribute_content)
+            else:
+                # One update expression can not touch the same attribute twice, write out what we have first
+                if not self.flush_batch():
+                    return False
+                category_buffer = self.write_buffer.setdefault(category, {})
+        category_buffer[attribute_name] = (action, attribute_content)
+        # Keep cached value consistent with buffered operations
+        category_cache = self.item_cache.setdefault(category, {})
+        if action == "PUT":
+            category_cache[attribute_name] = copy.deepcopy(attribute_content)
+        elif attribute_name in category_cache:
+            cur_value = category_cache.get(attribute_name) or []
+            if action == "ADD":
+                category_cache[attribute_name] = list(set(cur_value) | set(attribute_content))
+            elif action == "DELETE":
+                category_cache[attribute_name] = list(set(cur_value) - set(attribute_content))
+        return True
+
+    def batch_get_items(self, request_items):
+        # request_items: {category: [attribute_name, ...]}
+        rst = {}
+        b_succ = False
+        try:
+            if self.enable_privatelink_dydb:
+                b_succ, rst = self.invoke_internal_lambda("batch_get_item", {"request_items": request_items})
+                if not rst:
+                    rst = {}
+            else:
+                attribute_names = set()
+                for attributes in request_items.values():
+                    attribute_names.update(attributes)
+                expression_attribute_names = {"#c": "Category"}
+                projection_list = ["#c"]
+                for i, attribute_name in enumerate(sorted(attribute_names)):
+                    expression_attribute_names[f"#a{i}"] = attribute_name
+                    projection_list.append(f"#a{i}")
+                keys_and_attributes = {
+                    'Keys': [{'Category': {'S': category}} for category in request_items],
+                    'ProjectionExpression': ", ".join(projection_list),
+                    'ExpressionAttributeNames': expression_attribute_names
+                }
+                unprocessed = {self.dynamodb_table_name: keys_and_attributes}
+                max_loop = 5
+                for i in range(max_loop):
+                    response = self.dynamodb_client.batch_get_item(RequestItems=unprocessed)
+                    for item in response.get("Responses", {}).get(self.dynamodb_table_name, []):
+                        category = item.pop("Category").get("S")
+                        rst[category] = {}
+                        for attr_name in request_items.get(category, []):
+                            if attr_name in item:
+                                rst[category][attr_name] = self.convert_aws_dydb_to_normal_format(item[attr_name])
+                    unprocessed = response.get("UnprocessedKeys")
+                    if not unprocessed:
+                        b_succ = True
+                        break
+                    time.sleep(0.05 * (2 ** i))
+        except Exception as err:
+            self.logger.error(f"Could not batch get items from Dynamo DB table: {err}")
+        if not b_succ:
+            # Nothing is cached, reads fall through to the table instead of seeing missing attributes as empty
+            self.logger.error(f"Could not batch get items {request_items}.")
+            return rst
+        if self.batch_mode:
+            for category, attributes in request_items.items():
+                category_cache = self.item_cache.setdefault(category, {})
+                for attr_name in attributes:
+                    category_cache[attr_name] = copy.deepcopy(rst.get(category, {}).get(attr_name))
+        return rst
+
+    def transact_write_items(self, operation_list):
+        # operation_list: [{"category", "attribute_name", "attribute_content", "action": "PUT"|"ADD"|"DELETE"}]
+        if not operation_list:
+            return True
+        b_succ = False
+        try:
+            if self.enable_privatelink_dydb:
+                b_succ, rst = self.invoke_internal_lambda("transact_write_items", {"operations": operation_list})
+            else:
+                category_dict = {}
+                for operation in operation_list:
+                    category_dict.setdefault(operation["category"], []).append(operation)
+                transact_items = []
+                for category, category_operation_list in category_dict.items():
+                    update_item = self.build_update_item(category, category_operation_list)
+                    if update_item:
+                        transact_items.append({"Update": update_item})
+                # TransactWriteItems accepts at most 100 items
+                for i in range(0, len(transact_items), 100):
+                    self.dynamodb_client.transact_write_items(TransactItems=transact_items[i:i + 100])
+                b_succ = True
+        except Exception as err:
+            self.logger.error(f"Could not write items to Dynamo DB table: {err}")
+        return b_succ
+
+    def build_update_item(self, category, operation_list):
+        set_list = []
+        add_list = []
+        delete_list = []
+        remove_list = []
+        expression_attribute_names = {}
+        expression_attribute_values = {}
+        for i, operation in enumerate(operation_list):
+            name_key = f"#a{i}"
+            value_key = f":v{i}"
+            action = operation["action"]
+            attribute_content = operation["attribute_content"]
+            if action in ["ADD", "DELETE"] and type(attribute_content) is list:
+                attribute_content = set(attribute_content)
+            aws_format_content = self.convert_to_aws_dydb_format(attribute_content)
+            if action == "PUT":
+                if aws_format_content:
+                    set_list.append(f"{name_key} = {value_key}")
+                else:
+                    remove_list.append(name_key)
+            elif not aws_format_content:
+                self.logger.info(f"Attribute content is empty: {attribute_content}")
+                continue
+            elif action == "ADD":
+                add_list.append(f"{name_key} {value_key}")
+            elif action == "DELETE":
+                delete_list.append(f"{name_key} {value_key}")
+            else:
+                self.logger.error(f"Unknown Dynamo DB write action: {action}")
+                continue
+            expression_attribute_names[name_key] = operation["attribute_name"]
+            if aws_format_content:
+                expression_attribute_values[value_key] = aws_format_content
+        update_expression = ""
+        if set_list:
+            update_expression += "SET " + ", ".join(set_list) + " "
+        if add_list:
+            update_expression += "ADD " + ", ".join(add_list) + " "
+        if delete_list:
+            update_expression += "DELETE " + ", ".join(delete_list) + " "
+        if remove_list:
+            update_expression += "REMOVE " + ", ".join(remove_list) + " "
+        if not update_expression:
+            return None
+        update_item = {
+            'TableName': self.dynamodb_table_name,
+            'Key': {
+                'Category': {
+                    'S': category,
+                }
+            },
+            'UpdateExpression': update_expression.strip(),
+            'ExpressionAttributeNames': expression_attribute_names
+        }
+        if expression_attribute_values:
+            update_item['ExpressionAttributeValues'] = expression_attribute_values
+        return update_item
+
+  # Lease lock operations
+    def acquire_lock(self, lock_name, holder, lease_seconds, timeout):
+        # Return fencing token of the lock if acquired, otherwise None
+        if self.enable_privatelink_dydb:
+            parameters = {
+                "lock_name": lock_name,
+                "holder": holder,
+                "lease_seconds": lease_seconds,
+                "timeout": timeout
+            }
+            b_succ, rst = self.invoke_internal_lambda("acquire_lock", parameters)
+            if b_succ and rst:
+                return rst.get("fencing_token")
+            return None
+        deadline = time.time() + timeout
+        wait_time = 0.05
+        while True:
+            cur_time = time.time()
+            try:
+                response = self.dynamodb_client.update_item(
+                    TableName=self.dynamodb_table_name,
+                    Key={
+                        'Category': {
+                            'S': f"lock#{lock_name}",
+                        }
+                    },
+                    UpdateExpression="SET #h = :h, #e = :e ADD #f :one",
+                    ConditionExpression="attribute_not_exists(#h) OR #e < :now",
+                    ExpressionAttributeNames={
+                        "#h": "holder",
+                        "#e": "expires_at",
+                        "#f": "fencing_token"
+                    },
+                    ExpressionAttributeValues={
+                        ":h": {"S": holder},
+                        ":e": {"N": str(cur_time + lease_seconds)},
+                        ":now": {"N": str(cur_time)},
+                        ":one": {"N": "1"}
+                    },
+                    ReturnValues="UPDATED_NEW"
+                )
+                return int(response["Attributes"]["fencing_token"]["N"])
+            except ClientError as e:
+                if e.response['Error']['Code'] != "ConditionalCheckFailedException":
+                    self.logger.error(f"Could not acquire lock {lock_name}: {e}")
+                    return None
+            if time.time() + wait_time > deadline:
+                break
+            # Full jitter backoff so that waiters do not wake up together
+            time.sleep(random.uniform(0, wait_time))
+            wait_time = min(wait_time * 2, 1)
+        self.logger.error(f"Timeout when acquire lock {lock_name}.")
+        return None
+
+    def release_lock(self, lock_name, holder):
+        if self.enable_privatelink_dydb:
+            parameters = {
+                "lock_name": lock_name,
+                "holder": holder
+            }
+            b_succ, rst = self.invoke_internal_lambda("release_lock", parameters)
+            return b_succ
+        b_succ = False
+        try:
+            self.dynamodb_client.update_item(
+                TableName=self.dynamodb_table_name,
+                Key={
+                    'Category': {
+                        'S': f"lock#{lock_name}",
+                    }
+                },
+                UpdateExpression="REMOVE #h, #e",
+                ConditionExpression="#h = :h",
+                ExpressionAttributeNames={
+                    "#h": "holder",
+                    "#e": "expires_at"
+                },
+                ExpressionAttributeValues={
+                    ":h": {"S": holder}
+                }
+            )
+            b_succ = True
+        except ClientError as e:
+            if e.response['Error']['Code'] == "ConditionalCheckFailedException":
+                self.logger.error(f"Lock {lock_name} is not held by {holder}, the lease may have expired.")
+            else:
+                self.logger.error(f"Could not release lock {lock_name}: {e}")
+        return b_succ
+
+    def renew_lock(self, lock_name, holder, fencing_token, lease_seconds):
+        if self.enable_privatelink_dydb:
+            parameters = {
+                "lock_name": lock_name,
+                "holder": holder,
+                "fencing_token": fencing_token,
+                "lease_seconds": lease_seconds
+            }
+            b_succ, rst = self.invoke_internal_lambda("renew_lock", parameters)
+            return b_succ
+        b_succ = False
+        try:
+            self.dynamodb_client.update_item(
+                TableName=self.dynamodb_table_name,
+                Key={
+                    'Category': {
+                        'S': f"lock#{lock_name}",
+                    }
+                },
+                UpdateExpression="SET #e = :e",
+                # Holder and fencing token only stay the same while nobody else has acquired the lock
+                ConditionExpression="#h = :h AND #f = :f",
+                ExpressionAttributeNames={
+                    "#h": "holder",
+                    "#e": "expires_at",
+                    "#f": "fencing_token"
+                },
+                ExpressionAttributeValues={
+                    ":h": {"S": holder},
+                    ":f": {"N": str(fencing_token)},
+                    ":e": {"N": str(time.time() + lease_seconds)}
+                }
+            )
+            b_succ = True
+        except ClientError as e:
+            if e.response['Error']['Code'] == "ConditionalCheckFailedException":
+                self.logger.error(f"Lock {lock_name} has been taken over, could not renew it for {holder}.")
+            else:
+                self.logger.error(f"Could not renew lock {lock_name}: {e}")
+        return b_succ
+
+    def check_lock(self, lock_name, holder, fencing_token):
+        if self.enable_privatelink_dydb:
+            parameters = {
+                "lock_name": lock_name,
+                "holder": holder,
+                "fencing_token": fencing_token
+            }
+            b_succ, rst = self.invoke_internal_lambda("check_lock", parameters)
+            return b_succ
+        b_valid = False
+        try:
+            response = self.dynamodb_client.get_item(
+                TableName=self.dynamodb_table_name,
+                Key={
+                    'Category': {
+                        'S': f"lock#{lock_name}",
+                    }
+                },
+                ConsistentRead=True
+            )
+            item = response.get("Item", {})
+            b_valid = item.get("holder", {}).get("S") == holder and \
+                int(item.get("fencing_token", {}).get("N", "0")) == fencing_token and \
+                float(item.get("expires_at", {}).get("N", "0")) > time.time()
+        except Exception as err:
+            self.logger.error(f"Could not check lock {lock_name}: {err}")
+        return b_valid
+
+  # Record operations, one item per record
+    def put_record(self, category, attribute_dict):
+        # Never overwrite a record that has been updated after this write started
+        if self.enable_privatelink_dydb:
+            parameters = {
+                "category": category,
+                "attribute_dict": attribute_dict
+            }
+            b_succ, rst = self.invoke_internal_lambda("put_record", parameters)
+            return b_succ
+        b_succ = False
+        updated_at = time.time()
+        item = {
+            'Category': {
+                'S': category,
+            },
+            'updated_at': {
+                'N': str(updated_at)
+            }
+        }
+        if "#" in category:
+            # Records of one kind are listed by querying the record type index
+            item['record_type'] = {
+                'S': category[:category.index("#") + 1]
+            }
+        for attribute_name, attribute_content in attribute_dict.items():
+            aws_format_content = self.convert_to_aws_dydb_format(attribute_content)
+            if aws_format_content:
+                item[attribute_name] = aws_format_content
+        try:
+            self.dynamodb_client.put_item(
+                TableName=self.dynamodb_table_name,
+                Item=item,
+                ConditionExpression="attribute_not_exists(#u) OR #u <= :u",
+                ExpressionAttributeNames={
+                    "#u": "updated_at"
+                },
+                ExpressionAttributeValues={
+                    ":u": {"N": str(updated_at)}
+                }
+            )
+            b_succ = True
+        except ClientError as e:
+            if e.response['Error']['Code'] == "ConditionalCheckFailedException":
+                self.logger.info(f"Record {category} has been updated by others, skip this write.")
+            else:
+                self.logger.error(f"Could not put record {category}: {e}")
+        return b_succ
+
+    def get_record(self, category):
+        rst = {}
+        try:
+            if self.enable_privatelink_dydb:
+                b_succ, rst = self.invoke_internal_lambda("get_record", {"category": category})
+            else:
+                response = self.dynamodb_client.get_item(
+                    TableName=self.dynamodb_table_name,
+                    Key={
+                        'Category': {
+                            'S': category,
+                        }
+                    },
+                    ConsistentRead=True
+                )
+                rst = self.convert_aws_dydb_to_normal_format({"M": response.get("Item", {})})
+        except Exception as err:
+            self.logger.error(f"Could not get record {category}: {err}")
+        return rst or {}
+
+    def delete_record(self, category):
+        b_succ = False
+        try:
+            if self.enable_privatelink_dydb:
+                b_succ, rst = self.invoke_internal_lambda("delete_record", {"category": category})
+            else:
+                self.dynamodb_client.delete_item(
+                    TableName=self.dynamodb_table_name,
+                    Key={
+                        'Category': {
+                            'S': category,
+                        }
+                    }
+                )
+                b_succ = True
+        except Exception as err:
+            self.logger.error(f"Could not delete record {category}: {err}")
+        return b_succ
+
+    def scan_records(self, category_prefix):
+        rst = []
+        try:
+            if self.enable_privatelink_dydb:
+                b_succ, rst = self.invoke_internal_lambda("scan_records", {"category_prefix": category_prefix})
+            else:
+                paginator = self.dynamodb_client.get_paginator("scan")
+                page_iterator = paginator.paginate(
+                    TableName=self.dynamodb_table_name,
+                    FilterExpression="begins_with(#c, :p)",
+                    ExpressionAttributeNames={
+                        "#c": "Category"
+                    },
+                    ExpressionAttributeValues={
+                        ":p": {"S": category_prefix}
+                    }
+                )
+                for page in page_iterator:
+                    for item in page.get("Items", []):
+                        rst.append(self.convert_aws_dydb_to_normal_format({"M": item}))
+        except Exception as err:
+            self.logger.error(f"Could not scan records with prefix {category_prefix}: {err}")
+        return rst or []
+
+    def query_records(self, category_prefix):
+        # Return None if the table has no record type index
+        rst = []
+        try:
+            if self.enable_privatelink_dydb:
+                b_succ, rst = self.invoke_internal_lambda("query_records", {"category_prefix": category_prefix})
+                if not b_succ:
+                    return None
+            else:
+                paginator = self.dynamodb_client.get_paginator("query")
+                page_iterator = paginator.paginate(
+                    TableName=self.dynamodb_table_name,
+                    IndexName=self.record_index_name,
+                    KeyConditionExpression="#t = :t",
+                    ExpressionAttributeNames={
+                        "#t": "record_type"
+                    },
+                    ExpressionAttributeValues={
+                        ":t": {"S": category_prefix}
+                    }
+                )
+                for page in page_iterator:
+                    for item in page.get("Items", []):
+                        rst.append(self.convert_aws_dydb_to_normal_format({"M": item}))
+        except Exception as err:
+            self.logger.error(f"Could not query records with prefix {category_prefix}: {err}")
+            return None
+        return rst or []
+
+    def list_records(self, category_prefix):
+        # Records written before they carried record_type are indexed once by writing them again
+        marker_category = self.record_index_prefix + category_prefix
+        if not self.get_record(marker_category):
+            self.logger.info(f"Index records with prefix {category_prefix}.")
+            for record in self.scan_records(category_prefix):
+                category = record.pop("Category", "")
+                if not category or record.pop("record_type", None):
+                    continue
+                record.pop("updated_at", None)
+                self.put_record(category, record)
+            self.put_record(marker_category, {"indexed_at": int(time.time())})
+        rst = self.query_records(category_prefix)
+        if rst is None:
+            # Tables not created by this module may not have the record type index
+            self.logger.info(f"Record type index is not available, scan records with prefix {category_prefix}.")
+            rst = self.scan_records(category_prefix)
+        return rst
+
+  # Map entry operations
+    def set_map_entry(self, category, attribute_name, key, value):
+        # Set one entry of a map attribute without rewriting the whole map
+        if self.batch_mode and type(self.item_cache.get(category, {}).get(attribute_name)) is dict:
+            self.item_cache[category][attribute_name][key] = copy.deepcopy(value)
+        if self.enable_privatelink_dydb:
+            parameters = {
+                "category": category,
+                "attribute_name": attribute_name,
+                "key": key,
+                "value": value
+            }
+            b_succ, rst = self.invoke_internal_lambda("set_map_entry", parameters)
+            return b_succ
+        aws_format_content = self.convert_to_aws_dydb_format(value)
+        try:
+            self.dynamodb_client.update_item(
+                TableName=self.dynamodb_table_name,
+                Key={
+                    'Category': {
+                        'S': category,
+                    }
+                },
+                UpdateExpression="SET #a.#k = :v",
+                ExpressionAttributeNames={
+                    "#a": attribute_name,
+                    "#k": key
+                },
+                ExpressionAttributeValues={
+                    ":v": aws_format_content
+                }
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] != "ValidationException":
+                self.logger.error(f"Could not set {key} of {attribute_name}: {e}")
+                return False
+        # Map attribute does not exist yet
+        try:
+            self.dynamodb_client.update_item(
+                TableName=self.dynamodb_table_name,
+                Key={
+                    'Category': {
+                        'S': category,
+                    }
+                },
+                UpdateExpression="SET #a = :m",
+                ConditionExpression="attribute_not_exists(#a)",
+                ExpressionAttributeNames={
+                    "#a": attribute_name
+                },
+                ExpressionAttributeValues={
+                    ":m": {"M": {key: aws_format_content}}
+                }
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] == "ConditionalCheckFailedException":
+                # Map has been created by others meanwhile
+                return self.set_map_entry(category, attribute_name, key, value)
+            self.logger.error(f"Could not set {key} of {attribute_name}: {e}")
+        return False
+
+    def take_map_entry(self, category, attribute_name, key):
+        # Remove one entry of a map attribute and return its value, only one caller gets the entry
+        if self.batch_mode and type(self.item_cache.get(category, {}).get(attribute_name)) is dict:
+            self.item_cache[category][attribute_name].pop(key, None)
+        if self.enable_privatelink_dydb:
+            parameters = {
+                "category": category,
+                "attribute_name": attribute_name,
+                "key": key
+            }
+            b_succ, rst = self.invoke_internal_lambda("take_map_entry", parameters)
+            return rst if b_succ and rst else None
+        try:
+            response = self.dynamodb_client.update_item(
+                TableName=self.dynamodb_table_name,
+                Key={
+                    'Category': {
+                        'S': category,
+                    }
+                },
+                UpdateExpression="REMOVE #a.#k",
+                ConditionExpression="attribute_exists(#a.#k)",
+                ExpressionAttributeNames={
+                    "#a": attribute_name,
+                    "#k": key
+                },
+                ReturnValues="UPDATED_OLD"
+            )
+            old_value = self.convert_aws_dydb_to_normal_format(response.get("Attributes", {}).get(attribute_name)) or {}
+            return old_value.get(key)
+        except ClientError as e:
+            if e.response['Error']['Code'] == "ConditionalCheckFailedException":
+                self.logger.info(f"Entry {key} of {attribute_name} has been taken by others.")
+            else:
+                self.logger.error(f"Could not take {key} of {attribute_name}: {e}")
+        return None
+
+  # Serial number operations
+    def claim_sn(self, sn, instance_id, from_pool=False):
+        # Move one serial number from available_sn_list, or token_pool, to used_sn_map of the instance in one conditional write
+        # Return True, or the token pool entry if from_pool, when the serial number is claimed by this call
+        if self.batch_mode:
+            # Buffered changes of available_sn_list go out first so the condition sees them
+            self.flush_batch()
+        if self.enable_privatelink_dydb:
+            parameters = {
+                "sn": sn,
+                "instance_id": instance_id,
+                "from_pool": from_pool
+            }
+            b_succ, rst = self.invoke_internal_lambda("claim_sn", parameters)
+            rst = rst if b_succ and rst else None
+        else:
+            rst = self.update_item_claim_sn(sn, instance_id, from_pool)
+        if rst:
+            self.cache_sn_move(sn, instance_id, "token_pool" if from_pool else "available_sn_list", "used_sn_map")
+        return rst
+
+    def update_item_claim_sn(self, sn, instance_id, from_pool):
+        if from_pool:
+            update_expression = "REMOVE #p.#s SET #u.#i = :sn"
+            # Entries still being prepared by a refill have no VM token yet
+            condition_expression = "attribute_exists(#p.#s.vm_token)"
+            attribute_names = {
+                "#p": "token_pool",
+                "#s": sn
+            }
+            attribute_values = {
+                ":sn": {"S": sn}
+            }
+        else:
+            update_expression = "DELETE #a :s SET #u.#i = :sn"
+            condition_expression = "contains(#a, :sn)"
+            attribute_names = {
+                "#a": "available_sn_list"
+            }
+            attribute_values = {
+                ":s": {"SS": [sn]},
+                ":sn": {"S": sn}
+            }
+        attribute_names["#u"] = "used_sn_map"
+        attribute_names["#i"] = instance_id
+        try:
+            response = self.dynamodb_client.update_item(
+                TableName=self.dynamodb_table_name,
+                Key={
+                    'Category': {
+                        'S': "fortiflex",
+                    }
+                },
+                UpdateExpression=update_expression,
+                ConditionExpression=condition_expression,
+                ExpressionAttributeNames=attribute_names,
+                ExpressionAttributeValues=attribute_values,
+                ReturnValues="UPDATED_OLD"
+            )
+        except ClientError as e:
+            error_code = e.response['Error']['Code']
+            if error_code == "ConditionalCheckFailedException":
+                self.logger.info(f"Serial number {sn} has been claimed by others.")
+            elif error_code == "ValidationException" and self.init_map_attribute("fortiflex", "used_sn_map"):
+                # First serial number ever used
+                return self.update_item_claim_sn(sn, instance_id, from_pool)
+            else:
+                self.logger.error(f"Could not claim serial number {sn}: {e}")
+            return None
+        if from_pool:
+            token_pool = self.convert_aws_dydb_to_normal_format(response.get("Attributes", {}).get("token_pool")) or {}
+            return token_pool.get(sn)
+        return True
+
+    def update_pool_sn(self, sn, action, pool_entry=None):
+        # Move one serial number between available_sn_list and token_pool in one conditional write
+        if self.batch_mode:
+            self.flush_batch()
+            # Cached copies are read again instead of being patched
+            for attribute_name in ["available_sn_list", "token_pool"]:
+                self.item_cache.get("fortiflex", {}).pop(attribute_name, None)
+        if self.enable_privatelink_dydb:
+            parameters = {
+                "sn": sn,
+                "action": action,
+                "pool_entry": pool_entry
+            }
+            b_succ, rst = self.invoke_internal_lambda("update_pool_sn", parameters)
+            return b_succ
+        return self.update_item_pool_sn(sn, action, pool_entry)
+
+    def update_item_pool_sn(self, sn, action, pool_entry=None):
+        # reserve: move the serial number from available_sn_list to an entry of token_pool without VM token
+        # fill: set the prepared entry, release: move the entry back to available_sn_list
+        attribute_names = {
+            "#p": "token_pool",
+            "#s": sn
+        }
+        if action == "reserve":
+            update_expression = "DELETE #a :s SET #p.#s = :e"
+            condition_expression = "contains(#a, :sn)"
+            attribute_names["#a"] = "available_sn_list"
+            attribute_values = {
+                ":s": {"SS": [sn]},
+                ":sn": {"S": sn},
+                ":e": self.convert_to_aws_dydb_format({"reserved_at": time.time()})
+            }
+        elif action == "fill":
+            # Entry is gone if the serial number has been dropped from the inventory meanwhile
+            update_expression = "SET #p.#s = :e"
+            condition_expression = "attribute_exists(#p.#s)"
+            attribute_values = {
+                ":e": self.convert_to_aws_dydb_format(pool_entry)
+            }
+        elif action == "release":
+            update_expression = "REMOVE #p.#s ADD #a :s"
+            condition_expression = "attribute_exists(#p.#s)"
+            attribute_names["#a"] = "available_sn_list"
+            attribute_values = {
+                ":s": {"SS": [sn]}
+            }
+        else:
+            self.logger.error(f"Unknown token pool action: {action}")
+            return False
+        try:
+            self.dynamodb_client.update_item(
+                TableName=self.dynamodb_table_name,
+                Key={
+                    'Category': {
+                        'S': "fortiflex",
+                    }
+                },
+                UpdateExpression=update_expression,
+                ConditionExpression=condition_expression,
+                ExpressionAttributeNames=attribute_names,
+                ExpressionAttributeValues=attribute_values
+            )
+            return True
+        except ClientError as e:
+            error_code = e.response['Error']['Code']
+            if error_code == "ConditionalCheckFailedException":
+                self.logger.info(f"Could not {action} serial number {sn} of token pool, it has been moved by others.")
+            elif error_code == "ValidationException" and action == "reserve" and self.init_map_attribute("fortiflex", "token_pool"):
+                # First serial number ever put into the pool
+                return self.update_item_pool_sn(sn, action, pool_entry)
+            else:
+                self.logger.error(f"Could not {action} serial number {sn} of token pool: {e}")
+        return False
+
+    def release_sn(self, instance_id, sn):
+        # Move the serial number of the instance from used_sn_map back to available_sn_list in one conditional write
+        if self.batch_mode:
+            self.flush_batch()
+        if self.enable_privatelink_dydb:
+            parameters = {
+                "instance_id": instance_id,
+                "sn": sn
+            }
+            b_succ, rst = self.invoke_internal_lambda("release_sn", parameters)
+        else:
+            b_succ = self.update_item_release_sn(instance_id, sn)
+        if b_succ:
+            self.cache_sn_move(sn, instance_id, "used_sn_map", "available_sn_list")
+        return b_succ
+
+    def update_item_release_sn(self, instance_id, sn):
+        try:
+            self.dynamodb_client.update_item(
+                TableName=self.dynamodb_table_name,
+                Key={
+                    'Category': {
+                        'S': "fortiflex",
+                    }
+                },
+                UpdateExpression="REMOVE #u.#i ADD #a :s",
+                ConditionExpression="#u.#i = :sn",
+                ExpressionAttributeNames={
+                    "#u": "used_sn_map",
+                    "#i": instance_id,
+                    "#a": "available_sn_list"
+                },
+                ExpressionAttributeValues={
+                    ":s": {"SS": [sn]},
+                    ":sn": {"S": sn}
+                }
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] == "ConditionalCheckFailedException":
+                self.logger.info(f"Serial number {sn} of instance {instance_id} has been released by others.")
+            else:
+                self.logger.error(f"Could not release serial number {sn}: {e}")
+        return False
+
+    def cache_sn_move(self, sn, instance_id, from_attribute, to_attribute):
+        # Keep cached fortiflex item consistent with a serial number moved by a conditional write
+        category_cache = self.item_cache.get("fortiflex")
+        if not self.batch_mode or category_cache is None:
+            return
+        for attribute_name, is_source in [(from_attribute, True), (to_attribute, False)]:
+            if attribute_name not in category_cache:
+                continue
+            if attribute_name == "available_sn_list":
+                cur_value = set(category_cache.get(attribute_name) or [])
+                category_cache[attribute_name] = list(cur_value - {sn} if is_source else cur_value | {sn})
+            elif attribute_name == "used_sn_map":
+                cur_value = category_cache.get(attribute_name) or {}
+                if is_source:
+                    cur_value.pop(instance_id, None)
+                else:
+                    cur_value[instance_id] = sn
+                category_cache[attribute_name] = cur_value
+            elif type(category_cache.get(attribute_name)) is dict:
+                category_cache[attribute_name].pop(sn, None)
+
+    def init_map_attribute(self, category, attribute_name):
+        # Return True only if the empty map is created by this call
+        try:
+            self.dynamodb_client.update_item(
+                TableName=self.dynamodb_table_name,
+                Key={
+                    'Category': {
+                        'S': category,
+                    }
+                },
+                UpdateExpression="SET #a = :m",
+                ConditionExpression="attribute_not_exists(#a)",
+                ExpressionAttributeNames={
+                    "#a": attribute_name
+                },
+                ExpressionAttributeValues={
+                    ":m": {"M": {}}
+                }
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] != "ConditionalCheckFailedException":
+                self.logger.error(f"Could not create map attribute {attribute_name}: {e}")
+        return False
+
+  # Single item operations
+    def get_item_from_dydb(self, category, attributes):
+        if self.batch_mode:
+            category_cache = self.item_cache.get(category, {})
+            missed_attributes = [attr_name for attr_name in attributes if attr_name not in category_cache]
+            if missed_attributes:
+                # Buffered ADD/DELETE on an attribute that was never read must reach the table before reading it
+                if any(attr_name in self.write_buffer.get(category, {}) for attr_name in missed_attributes):
+                    self.flush_batch()
+                self.batch_get_items({category: missed_attributes})
+                category_cache = self.item_cache.get(category, {})
+                missed_attributes = [attr_name for attr_name in missed_attributes if attr_name not in category_cache]
+            rst = {}
+            for attr_name in attributes:
+                if category_cache.get(attr_name) is not None:
+                    rst[attr_name] = copy.deepcopy(category_cache[attr_name])
+            if missed_attributes:
+                # Batch read failed, read the table without caching the result
+                rst.update(self.read_item(category, missed_attributes))
+            return rst
+        return self.read_item(category, attributes)
+
+    def read_item(self, category, attributes):
+        rst = {}
+        try:
+            if self.enable_privatelink_dydb:
+                parameters = {
+                    "category" : category,
+                    "attributes": attributes
+                }
+                b_succ, rst = self.invoke_internal_lambda("get_item", parameters)
+            else:
+                response = self.dynamodb_client.get_item(
+                    TableName=self.dynamodb_table_name,
+                    Key={
+                        'Category': {
+                            'S': category,
+                        }
+                    },
+                    AttributesToGet=attributes)
+                resp_content = response.get("Item")
+                for attr_name in attributes:
+                    if attr_name in resp_content:
+                        rst[attr_name] = self.convert_aws_dydb_to_normal_format(resp_content[attr_name])
+        except Exception as err:
+            self.logger.error(f"Could not get item from Dynamo DB table: {err}")
+        return rst
+
+    def put_items_to_dydb(self, category, attribute_dict, flush=False):
+        if self.batch_mode:
+            for attribute_name, attribute_content in attribute_dict.items():
+                if not self.buffer_operation(category, attribute_name, attribute_content, "PUT"):
+                    return False
+            if flush:
+                return self.flush_batch()
+            return True
+        operation_list = []
+        for attribute_name, attribute_content in attribute_dict.items():
+            operation_list.append({
+                "category": category,
+                "attribute_name": attribute_name,
+                "attribute_content": attribute_content,
+                "action": "PUT"
+            })
+        return self.transact_write_items(operation_list)
+
+    def put_item_to_dydb(self, category, attribute_name, attribute_content):
+        if self.batch_mode:
+            return self.buffer_operation(category, attribute_name, attribute_content, "PUT")
+        b_succ= False
+        try:
+            if self.enable_privatelink_dydb:
+                parameters = {
+                    "category" : category,
+                    "attribute_name": attribute_name,
+                    "attribute_content": attribute_content
+                }
+                b_succ, rst = self.invoke_internal_lambda("put_item", parameters, "Event")
+            else:
+                aws_format_content = self.convert_to_aws_dydb_format(attribute_content)
+                if not aws_format_content:
+                    self.logger.info(f"Attribute content is empty: {attribute_content}")
+                    return self.remove_item_from_dydb(category, attribute_name, attribute_content)
+                response = self.dynamodb_client.update_item(
+                    TableName=self.dynamodb_table_name,
+                    Key={
+                        'Category': {
+                            'S': category,
+                        }
+                    },
+                    AttributeUpdates={
+                        attribute_name: {
+                            'Value': aws_format_content
+                        }
+                    })
+                b_succ = True
+        except Exception as err:
+            self.logger.error(f"Could not update item in Dynamo DB table: {err}")
+        return b_succ
+
+    def add_item_to_dydb(self, category, attribute_name, attribute_content):
+        if self.batch_mode:
+            if type(attribute_content) is not set:
+                self.logger.error(f"Could not do the ADD operation for attribute type: {type(attribute_content)}")
+                return False
+            return self.buffer_operation(category, attribute_name, attribute_content, "ADD")
+        b_succ= False
+        try:
+            if self.enable_privatelink_dydb:
+                parameters = {
+                    "category" : category,
+                    "attribute_name": attribute_name,
+                    "attribute_content": attribute_content
+                }
+                b_succ, rst = self.invoke_internal_lambda("add_item", parameters, "Event")
+            else:
+                if type(attribute_content) not in [set, int, float]:
+                    self.logger.error(f"Could not do the ADD operation for attribute type: {type(attribute_content)}")
+                    return False
+                aws_format_content = self.convert_to_aws_dydb_format(attribute_content)
+                if not aws_format_content:
+                    self.logger.info(f"Attribute content is empty: {attribute_content}")
+                    return False
+                response = self.dynamodb_client.update_item(
+                    TableName=self.dynamodb_table_name,
+                    Key={
+                        'Category': {
+                            'S': category,
+                        }
+                    },
+                    AttributeUpdates={
+                        attribute_name: {
+                            'Value': aws_format_content,
+                            'Action': 'ADD'
+                        }
+                    })
+                b_succ = True
+        except Exception as err:
+            self.logger.error(f"Could not add item in Dynamo DB table: {err}")
+        return b_succ
+
+    def remove_item_from_dydb(self, category, attribute_name, attribute_content):
+        if self.batch_mode and type(attribute_content) is set:
+            return self.buffer_operation(category, attribute_name, attribute_content, "DELETE")
+        b_succ= False
+        try:
+            if self.enable_privatelink_dydb:
+                parameters = {
+                    "category" : category,
+                    "attribute_name": attribute_name,
+                    "attribute_content": attribute_content
+                }
+                b_succ, rst = self.invoke_internal_lambda("remove_item", parameters, "Event")
+            else:
+                aws_format_content = self.convert_to_aws_dydb_format(attribute_content)
+                if not aws_format_content:
+                    self.logger.info(f"Attribute content is empty: {attribute_content}")
+                    return False
+                attribute_value = {
+                    'Action': 'DELETE'
+                }
+                if aws_format_content:
+                    attribute_value["Value"] = aws_format_content
+                response = self.dynamodb_client.update_item(
+                    TableName=self.dynamodb_table_name,
+                    Key={
+                        'Category': {
+                            'S': category,
+                        }
+                    },
+                    AttributeUpdates={
+                        attribute_name: attribute_value
+                    }
+                )
+                b_succ = True
+        except Exception as err:
+            self.logger.error(f"Could not remove item in Dynamo DB table: {err}")
+        return b_succ
+
+    def convert_to_aws_dydb_format(self, input_value):
+        rst = {}
+        if input_value == None:
+            return rst
+        aws_datatype = ""
+        content = input_value
+        input_type = type(input_value)
+        if input_type is str:
+            aws_datatype = "S"
+        elif input_type is int or input_type is float:
+            aws_datatype = "N"
+            content = str(input_value)
+        elif input_type is bool:
+            aws_datatype = "BOOL"
+        elif input_type is set:
+            if not input_value:
+                return rst
+            for ele in input_value:
+                ele_type = type(ele)
+                break
+            if ele_type is str:
+                aws_datatype = "SS"
+                content = list(input_value)
+            elif ele_type is int or ele_type is float:
+                aws_datatype = "NS"
+                content = [str(e) for e in input_value]
+        elif input_type is list:
+            if not input_value:
+                return {
+                    "L": []
+                }
+            aws_datatype = "L"
+            content = [self.convert_to_aws_dydb_format(e) for e in input_value]
+        elif input_type is dict:
+            if not input_value:
+                return {
+                    "M": {}
+                }
+            aws_datatype = "M"
+            content = {}
+            for k, v in input_value.items():
+                content[k] = self.convert_to_aws_dydb_format(v)
+
+        rst = {
+            aws_datatype: content
+        }
+        return rst
+
+    def convert_aws_dydb_to_normal_format(self, input_dict):
+        if not input_dict:
+            return input_dict
+        rst = None
+        for v_type, v_content in input_dict.items():
+            if v_type == "M":
+                rst = {}
+                for k, v in v_content.items():
+                    rst[k] = self.convert_aws_dydb_to_normal_format(v)
+            elif v_type == "L":
+                rst = [self.convert_aws_dydb_to_normal_format(e) for e in v_content]
+            elif v_type == "NULL" and v_content:
+                rst = None
+            else:
+                rst = v_content
+            break
+        return rst
+
+class DydbLock:
+    def __init__(self, logger, dydb, lock_name, lease_seconds=30, timeout=40):
+        self.logger = logger
+        self.dydb = dydb
+        self.lock_name = lock_name
+        self.lease_seconds = lease_seconds
+        self.timeout = timeout
+        self.holder = f"{os.getenv('AWS_LAMBDA_LOG_STREAM_NAME', '')}#{uuid.uuid4()}"
+        self.fencing_token = None
+        self.renewed_at = 0
+
+    def acquire(self):
+        self.fencing_token = self.dydb.acquire_lock(self.lock_name, self.holder, self.lease_seconds, self.timeout)
+        if self.fencing_token is None:
+            return False
+        self.renewed_at = time.time()
+        self.logger.info(f"Acquired lock {self.lock_name}, fencing token: {self.fencing_token}")
+        return True
+
+    def renew(self):
+        # Extend the lease, fails if the lock has been acquired by others in the meantime
+        if self.fencing_token is None:
+            return False
+        cur_time = time.time()
+        if not self.dydb.renew_lock(self.lock_name, self.holder, self.fencing_token, self.lease_seconds):
+            self.fencing_token = None
+            return False
+        self.renewed_at = cur_time
+        return True
+
+    def keep_alive(self):
+        # Renew only when half of the lease is gone, for long running work under the lock
+        if self.fencing_token is not None and time.time() - self.renewed_at < self.lease_seconds / 2:
+            return True
+        return self.renew()
+
+    def release(self):
+        if self.fencing_token is None:
+            return False
+        b_succ = self.dydb.release_lock(self.lock_name, self.holder)
+        self.fencing_token = None
+        return b_succ
+
+    def is_held(self):
+        if self.fencing_token is None:
+            return False
+        return self.dydb.check_lock(self.lock_name, self.holder, self.fencing_token)
+
+class InstanceSnapshot:
+    # EC2 instances of the auto scaling group, described once per invocation and shared by all consumers
+    def __init__(self, logger):
+        self.logger = logger
+        self.ec2_client = Runtime.get().client("ec2")
+        self.asg_name = os.getenv("asg_name")
+        self.instance_dict = None
+
+    def load(self):
+        self.logger.info(f"Describe instances of auto scaling group {self.asg_name}.")
+        self.instance_dict = {}
+        paginator = self.ec2_client.get_paginator("describe_instances")
+        page_iterator = paginator.paginate(
+            Filters=[
+                {
+                    'Name': 'tag:aws:autoscaling:groupName',
+                    'Values': [self.asg_name]
+                }
+            ]
+        )
+        for page in page_iterator:
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    self.instance_dict[instance.get('InstanceId')] = instance
+
+    def get_instance(self, instance_id):
+        if self.instance_dict is None:
+            self.load()
+        if instance_id not in self.instance_dict:
+            # Instance is not tagged yet or has been purged from the listing, describe it directly
+            instance = None
+            try:
+                instance_detail = self.ec2_client.describe_instances(InstanceIds=[instance_id])
+                if instance_detail['Reservations'] and instance_detail['Reservations'][0]['Instances']:
+                    instance = instance_detail['Reservations'][0]['Instances'][0]
+            except ClientError as err:
+                # Only a missing instance is cached as gone, other errors like throttling are raised to the caller
+                if not err.response['Error']['Code'].startswith("InvalidInstanceID"):
+                    raise
+                self.logger.info(f"Could not find instance {instance_id}: {err}")
+            self.instance_dict[instance_id] = instance
+        return self.instance_dict[instance_id]
+
+    def get_instance_dict(self, state_name_list):
+        if self.instance_dict is None:
+            self.load()
+        rst = {}
+        for instance_id, instance in self.instance_dict.items():
+            if instance and instance.get('State', {}).get('Name') in state_name_list:
+                rst[instance_id] = instance
+        return rst
+
+    def is_gone(self, instance_id):
+        instance = self.get_instance(instance_id)
+        return not instance or instance.get('State', {}).get('Name') in ["terminated", "shutting-down"]
+
+    def invalidate(self, instance_id=None):
+        if instance_id is None:
+            self.instance_dict = None
+        elif self.instance_dict is not None:
+            self.instance_dict.pop(instance_id, None)
+
 class NetworkInterface:
-    def __init__(self, logger, fgt_vm_id=""):
+    def __init__(self, logger, fgt_vm_id="", instance_snapshot=None):
         self.logger = logger
-        self.ec2_client = boto3.client("ec2")
-        self.s3_client = boto3.client("s3")
+        self.runtime = Runtime.get()
+        self.ec2_client = self.runtime.client("ec2")
+        self.s3_client = self.runtime.client("s3")
         self.s3_bucket_name = os.getenv("lic_s3_name")
         self.intf_track_file_name = "intf_track.json"
+        self.intf_record_prefix = "intf_track#"
         self.fgt_vm_id = fgt_vm_id
+        self.dydb = Dynamodb(logger)
+        self.instance_snapshot = instance_snapshot if instance_snapshot else InstanceSnapshot(logger)
 
     def set_vm_id(self, vm_id):
         self.fgt_vm_id = vm_id
-        self.instance_detail = self.ec2_client.describe_instances(InstanceIds=[self.fgt_vm_id])
+        self.instance = self.instance_snapshot.get_instance(self.fgt_vm_id)
         self.fgt_vm_intfs = {}
-        if self.instance_detail and len(self.instance_detail['Reservations']) > 0 and len(self.instance_detail['Reservations'][0]['Instances']) > 0:
-            for intf in self.instance_detail['Reservations'][0]['Instances'][0]['NetworkInterfaces']:
+        if self.instance:
+            for intf in self.instance['NetworkInterfaces']:
                 cur_device_index = str(intf.get("Attachment").get("DeviceIndex"))
                 self.fgt_vm_intfs[cur_device_index] = intf
 
@@ -67,30 +1520,49 @@ class NetworkInterface:
         
     def do_launch(self):
         self.logger.info(f"Do launch fgt vm instance: {self.fgt_vm_id}")
-        intf_setting = json.loads(os.getenv('network_interfaces'))
-        fgt_az = self.instance_detail['Reservations'][0]['Instances'][0]['Placement']['AvailabilityZone']
-        for intf_name, intf_conf in intf_setting.items():
-            # Ignore if the interface already exist
-            if str(intf_conf["device_index"]) in self.fgt_vm_intfs:
-                continue
-            # Create interface
-            cur_intf_id = self.create_interface(intf_name, intf_conf, fgt_az)
-            if cur_intf_id == None:
-                continue
-            # Attach the interface to FortiGate VM instance
-            attach_id = self.attach_intf(cur_intf_id, intf_conf["device_index"])
-            if attach_id == None:
-                self.delete_interface(cur_intf_id)
-                continue
-            self.set_delete_on_termination(cur_intf_id, attach_id)
-            # Create and associate Public IP if needed
-            if "enable_public_ip" in intf_conf and intf_conf["enable_public_ip"] :
-                self.associate_pub_ip(cur_intf_id, intf_conf)
-
-    def do_terminate(self):
+        intf_setting = self.runtime.network_interfaces
+        fgt_az = self.instance['Placement']['AvailabilityZone']
+        # Ignore if the interface already exist
+        new_intf_list = [
+            (intf_name, intf_conf) for intf_name, intf_conf in intf_setting.items()
+            if str(intf_conf["device_index"]) not in self.fgt_vm_intfs
+        ]
+        if not new_intf_list:
+            return
+        with ThreadPoolExecutor(max_workers=len(new_intf_list) * 2) as executor:
+            # Create all interfaces and allocate Public IPs in parallel
+            create_futures = {}
+            eip_futures = {}
+            for intf_name, intf_conf in new_intf_list:
+                create_futures[intf_name] = executor.submit(self.create_interface, intf_name, intf_conf, fgt_az)
+                if "enable_public_ip" in intf_conf and intf_conf["enable_public_ip"] :
+                    eip_futures[intf_name] = executor.submit(self.allocate_pub_ip, intf_conf)
+            # Attach the interfaces to FortiGate VM instance one by one in device index order,
+            # while DeleteOnTermination and Public IP association of attached ones run in the background
+            post_attach_futures = []
+            for intf_name, intf_conf in sorted(new_intf_list, key=lambda item: int(item[1]["device_index"])):
+                cur_intf_id = create_futures[intf_name].result()
+                attach_id = None
+                if cur_intf_id != None:
+                    attach_id = self.attach_intf(cur_intf_id, intf_conf["device_index"])
+                    if attach_id == None:
+                        self.delete_interface(cur_intf_id)
+                if attach_id == None:
+                    # Roll back the Public IP allocated for this interface only
+                    if intf_name in eip_futures:
+                        self.release_pub_ip(intf_conf, eip_futures[intf_name].result())
+                    continue
+                post_attach_futures.append(executor.submit(self.set_delete_on_termination, cur_intf_id, attach_id))
+                if intf_name in eip_futures:
+                    post_attach_futures.append(executor.submit(self.associate_pub_ip, cur_intf_id, intf_conf, eip_futures[intf_name]))
+            for future in post_attach_futures:
+                future.result()
+        # Interfaces of the instance changed, describe it again on next use
+        self.instance_snapshot.invalidate(self.fgt_vm_id)
+
+    def do_terminate(self, intf_record=None):
         self.logger.info(f"Do terminate fgt vm instance: {self.fgt_vm_id}")
-        intf_track_dict = self.get_intf()
-        cur_fgt_intf_dict = intf_track_dict.get(self.fgt_vm_id, {})
+        cur_fgt_intf_dict = intf_record if intf_record is not None else self.get_intf()
         # Merge intfs info
         for d_index, intf in cur_fgt_intf_dict.items():
             if d_index not in self.fgt_vm_intfs:
@@ -123,16 +1595,19 @@ class NetworkInterface:
             if not (intf.get("Attachment").get("DeleteOnTermination")):
                 attach_id = intf.get("Attachment").get("AttachmentId")
                 intf_id = intf.get("NetworkInterfaceId")
-                response = self.ec2_client.detach_network_interface(AttachmentId = attach_id)
+                cur_intf_des = self.ec2_client.describe_network_interfaces(NetworkInterfaceIds=[intf_id]).get("NetworkInterfaces")[0]
                 max_try = 10
-                detached = False
-                for i in range(max_try):
-                    self.logger.info(f"Check interface status try: {i} times.")
-                    cur_intf_des = self.ec2_client.describe_network_interfaces(NetworkInterfaceIds=[intf_id]).get("NetworkInterfaces")[0]
-                    if "Attachment" not in cur_intf_des or cur_intf_des.get("Attachment").get("Status") == "detached":
-                        detached = True
-                        break
-                    time.sleep(1)
+                # Interface of a terminated instance may already be detached
+                detached = "Attachment" not in cur_intf_des or cur_intf_des.get("Attachment").get("Status") == "detached"
+                if not detached:
+                    response = self.ec2_client.detach_network_interface(AttachmentId = attach_id)
+                    for i in range(max_try):
+                        self.logger.info(f"Check interface status try: {i} times.")
+                        cur_intf_des = self.ec2_client.describe_network_interfaces(NetworkInterfaceIds=[intf_id]).get("NetworkInterfaces")[0]
+                        if "Attachment" not in cur_intf_des or cur_intf_des.get("Attachment").get("Status") == "detached":
+                            detached = True
+                            break
+                        time.sleep(1)
                 if detached:
                     self.delete_interface(intf_id)
                 else:
@@ -141,37 +1616,81 @@ class NetworkInterface:
             self.logger.info(f"Failed in delete interface: {e}")
             
     def save_intf(self):
-        self.lock_intf_track_file()
-        try:
-            intf_track_dict = self.get_intf_track_dict()
-            if intf_track_dict != None:
-                intf_track_dict[self.fgt_vm_id] = self.fgt_vm_intfs
-                self.update_intf_track_file(intf_track_dict)
-        except Exception as e:
-            self.logger.error(f"Exception when save interface track file: {e}")
-        self.unlock_intf_track_file()
+        self.logger.info(f"Save interface record of instance: {self.fgt_vm_id}")
+        attribute_dict = {
+            "instance_id": self.fgt_vm_id,
+            "interfaces": json.dumps(self.fgt_vm_intfs, default=str)
+        }
+        b_succ = self.dydb.put_record(self.intf_record_prefix + self.fgt_vm_id, attribute_dict)
+        if not b_succ:
+            self.logger.error(f"Could not save interface record of instance: {self.fgt_vm_id}")
+        return b_succ
 
     def remove_intf(self):
-        self.lock_intf_track_file()
-        try:
-            intf_track_dict = self.get_intf_track_dict()
-            if intf_track_dict != None:
-                intf_track_dict.pop(self.fgt_vm_id, None)
-                self.update_intf_track_file(intf_track_dict)
-        except Exception as e:
-            self.logger.error(f"Exception when remove instance record from interface track file: {e}")
-        self.unlock_intf_track_file()
+        self.logger.info(f"Remove interface record of instance: {self.fgt_vm_id}")
+        b_succ = self.dydb.delete_record(self.intf_record_prefix + self.fgt_vm_id)
+        if not b_succ:
+            self.logger.error(f"Could not remove interface record of instance: {self.fgt_vm_id}")
+        return b_succ
 
     def get_intf(self):
-        self.lock_intf_track_file()
+        record = self.dydb.get_record(self.intf_record_prefix + self.fgt_vm_id)
+        if record and record.get("interfaces"):
+            return json.loads(record["interfaces"])
+        # Instances launched before per-instance records still keep their interfaces in the legacy track file
+        migrated_dict = self.migrate_intf_track_file()
+        return migrated_dict.get(self.fgt_vm_id, {})
+
+    def migrate_intf_track_file(self):
+        # Move entries of the legacy track file to per-instance records, return {instance_id: interfaces} moved
+        migrated_dict = {}
+        if not self.s3_bucket_name:
+            return migrated_dict
+        intf_track_dict, etag = self.get_intf_track_dict(with_etag=True)
+        if not intf_track_dict:
+            return migrated_dict
+        self.logger.info(f"Migrate interface track file, instances: {list(intf_track_dict.keys())}")
+        remaining_dict = {}
+        for instance_id, intf_dict in intf_track_dict.items():
+            category = self.intf_record_prefix + instance_id
+            # A record written by the instance itself is newer than the legacy entry
+            if self.dydb.get_record(category):
+                continue
+            attribute_dict = {
+                "instance_id": instance_id,
+                "interfaces": json.dumps(intf_dict, default=str)
+            }
+            if self.dydb.put_record(category, attribute_dict):
+                migrated_dict[instance_id] = intf_dict
+            else:
+                remaining_dict[instance_id] = intf_dict
         try:
-            intf_track_dict = self.get_intf_track_dict()
-            if intf_track_dict == None:
-                intf_track_dict = {}
-        except Exception as e:
-            self.logger.error(f"Exception when get interface track file: {e}")
-        self.unlock_intf_track_file()
-        return intf_track_dict
+            # The file itself is managed by Terraform, only its entries are removed
+            self.s3_client.put_object(
+                Bucket=self.s3_bucket_name,
+                Key=self.intf_track_file_name,
+                Body=json.dumps(remaining_dict),
+                IfMatch=etag
+            )
+        except ClientError as e:
+            # Entries left in the file are migrated again next time, records already written are kept
+            self.logger.error(f"Could not update file {self.intf_track_file_name}: {e}")
+        return migrated_dict
+
+    def list_intf_records(self):
+        self.logger.info("List interface records of all instances.")
+        rst = {}
+        # Instances only known by the legacy track file must be found by reconciliation too
+        self.migrate_intf_track_file()
+        for record in self.dydb.list_records(self.intf_record_prefix):
+            instance_id = record.get("instance_id")
+            if not instance_id:
+                continue
+            try:
+                rst[instance_id] = json.loads(record.get("interfaces") or "{}")
+            except ValueError as err:
+                self.logger.error(f"Could not parse interface record of instance {instance_id}: {err}")
+        return rst
 
     def create_interface(self, intf_name, intf_conf, fgt_az):
         self.logger.info(f"Create interface: {intf_name}")
@@ -192,7 +1711,7 @@ class NetworkInterface:
             if not subnet_id:
                 self.logger.error(f"Could not get the Subnet ID of AZ: {fgt_az}")
                 return None
-            security_groups = intf_conf.get("security_groups", [])
+            security_groups = list(intf_conf.get("security_groups", []))
             if mgmt_intf_index and mgmt_intf_index == intf_conf.get("device_index", ""):
                 security_groups.append(sg_allow_lambda)
             intf = self.ec2_client.create_network_interface(
@@ -234,8 +1753,7 @@ class NetworkInterface:
         except ClientError as e:
             self.logger.error(f"Error attaching network interface {cur_intf_id}: {e.response['Error']['Code']}")
 
-    def associate_pub_ip(self, cur_intf_id, intf_conf):
-        self.logger.info(f"Associate public ip: {cur_intf_id}.")
+    def allocate_pub_ip(self, intf_conf):
         eip_id = ""
         if "existing_eip_id" in intf_conf:
             eip_id = intf_conf["existing_eip_id"]
@@ -254,6 +1772,23 @@ class NetworkInterface:
             except ClientError as e:
                 self.logger.error(f"Error creating Elastic IP address : {e.response['Error']['Code']}")
                 return None
+        return eip_id
+
+    def release_pub_ip(self, intf_conf, eip_id):
+        # Existing Elastic IP is owned by the user, only release the one allocated here
+        if not eip_id or "existing_eip_id" in intf_conf:
+            return
+        self.logger.info(f"Release Elastic IP: {eip_id}.")
+        try:
+            self.ec2_client.release_address(AllocationId = eip_id)
+        except ClientError as e:
+            self.logger.error(f"Error releasing Elastic IP {eip_id} : {e.response['Error']['Code']}")
+
+    def associate_pub_ip(self, cur_intf_id, intf_conf, eip_future=None):
+        self.logger.info(f"Associate public ip: {cur_intf_id}.")
+        eip_id = eip_future.result() if eip_future else self.allocate_pub_ip(intf_conf)
+        if not eip_id:
+            return None
         try:
             associate_pub_ip = self.ec2_client.associate_address(
                 AllocationId       = eip_id,
@@ -263,7 +1798,7 @@ class NetworkInterface:
             return associate_pub_ip_id
         except ClientError as e:
             self.logger.error(f"Error associate network interface {cur_intf_id} and Elastic IP {eip_id} : {e.response['Error']['Code']}")
-            self.ec2_client.release_address(AllocationId = eip_id)
+            self.release_pub_ip(intf_conf, eip_id)
             return None
 
     def delete_interface(self, cur_intf_id):
@@ -274,200 +1809,163 @@ class NetworkInterface:
         except ClientError as e:
             self.logger.error(f"Error deleting network interface {cur_intf_id}: {e.response['Error']['Code']}, response: {response}")
 
-
-    def lock_intf_track_file(self):
-        self.logger.info("Lock interface track file from S3 bucket.")
-        self.lock_id = str(uuid.uuid1())
-        b_succ = False
-        # Get tagging
-        max_loop = 60
-        go_next = False
-        for i in range(max_loop):
-            try:
-                b_exist = self.check_object_exist()
-                if not b_exist:
-                    self.create_intf_track_file()
-                    break
-                response = self.s3_client.get_object_tagging(Bucket=self.s3_bucket_name, Key=self.intf_track_file_name)
-                intf_track_tags = response.get("TagSet")
-
-                locked_by_other = False
-                for tag in intf_track_tags:
-                    if tag["Key"] == 'lock_id' and tag["Value"]:
-                        locked_by_other = True
-                        break
-                if locked_by_other:
-                    time.sleep(2)
-                    continue
-                go_next = True
-                break
-            except botocore.exceptions.ClientError as e:
-                self.logger.info(f"Could not get tags of  file {self.intf_track_file_name}: {e}")
-                self.create_intf_track_file()
-                break
-        
-        # Update tagging
-        if go_next:
-            try:
-                response = self.s3_client.put_object_tagging(
-                    Bucket=self.s3_bucket_name, 
-                    Key=self.intf_track_file_name,
-                    Tagging={
-                        'TagSet': [
-                            {
-                                'Key': 'lock_id',
-                                'Value': self.lock_id
-                            },
-                        ]
-                    })
-            except botocore.exceptions.ClientError as e:
-                self.logger.info(f"Could not get tags of  file {self.intf_track_file_name}: {e}")
-        # Check lock success
-        b_succ = self.check_lock_status("lock")
-        if b_succ:
-            self.logger.info(f"Lock interface track file sussess: {self.lock_id}")
-
-        return b_succ
-
-    def unlock_intf_track_file(self):
-        self.logger.info("Unlock interface track file from S3 bucket.")
-        b_succ = False
-        # Get tagging
-        go_next = True
-        try:
-            response = self.s3_client.get_object_tagging(Bucket=self.s3_bucket_name, Key=self.intf_track_file_name)
-            intf_track_tags = response.get("TagSet")
-            if not intf_track_tags:
-                self.logger.error(f"Can not find lock info in tags.")
-            else:
-                locked_by_other = False
-                for tag in intf_track_tags:
-                    if tag["Key"] == 'lock_id':
-                        if not tag["Value"] or tag["Value"] != self.lock_id:
-                            vl = tag["Value"]
-                            self.logger.info(f"Interface track file is not locked or locked by others: {vl}")
-                            go_next = False
-                            break
-        except botocore.exceptions.ClientError as e:
-            self.logger.info(f"Could not get tags of file {self.intf_track_file_name}: {e}")
-            go_next = False
-        
-        # Update tagging
-        if go_next:
-            try:
-                response = self.s3_client.put_object_tagging(
-                    Bucket=self.s3_bucket_name, 
-                    Key=self.intf_track_file_name,
-                    Tagging={
-                        'TagSet': [
-                            {
-                                'Key': 'lock_id',
-                                'Value': ""
-                            },
-                        ]
-                    })
-                b_succ = True
-            except botocore.exceptions.ClientError as e:
-                self.logger.info(f"Could not get tags of file {self.intf_track_file_name}: {e}")
-        # Check unlock success
-        b_succ = self.check_lock_status("unlock")
-        if b_succ:
-            self.logger.info(f"Unlock interface track file sussess: {self.lock_id}")
-        return b_succ
-
-    def check_lock_status(self, status):
-        status_value = ""
-        if status == "lock":
-            status_value = self.lock_id
-        b_succ = False
-        try:
-            response = self.s3_client.get_object_tagging(Bucket=self.s3_bucket_name, Key=self.intf_track_file_name)
-            intf_track_tags = response.get("TagSet")
-            if not intf_track_tags:
-                self.logger.error(f"Did not lock the file.")
-            else:
-                for tag in intf_track_tags:
-                    if tag["Key"] == 'lock_id':
-                        if tag["Value"] == status_value:
-                            b_succ = True
-                            break
-        except botocore.exceptions.ClientError as e:
-            self.logger.info(f"Could not get tags of file {self.intf_track_file_name}: {e}")
-        return b_succ
-
-    def create_intf_track_file(self):
-        self.logger.info("Create interface track file on S3 bucket.")
-        intf_track_dict = {}
-
-        return self.update_intf_track_file(intf_track_dict)
-
-    def update_intf_track_file(self, intf_track_dict):
-        self.logger.info("Update interface track file.")
-        file_body = json.dumps(intf_track_dict, default=str)
-        b_succ = False
-        try:
-            response = self.s3_client.put_object(
-                Bucket=self.s3_bucket_name, 
-                Key=self.intf_track_file_name, 
-                Body=file_body,
-                Tagging=f"lock_id={self.lock_id}"
-                )
-            b_succ = True
-        except Exception as err:
-            self.logger.error(f"Could not save S3 object: {err}")
-        return b_succ
-
-    def get_intf_track_dict(self):
+    def get_intf_track_dict(self, with_etag=False):
         self.logger.info("Get interface track file from S3 bucket.")
         intf_track_dict = {}
+        etag = None
         try:
             response = self.s3_client.get_object(Bucket=self.s3_bucket_name, Key=self.intf_track_file_name)
+            etag = response.get("ETag")
             intf_track_dict = json.loads(response.get("Body").read())
             if intf_track_dict == None or intf_track_dict == "":
                 self.logger.info(f"File {self.intf_track_file_name} not been created.")
-                return None
+                intf_track_dict = None
         except botocore.exceptions.ClientError as e:
             self.logger.info(f"Could not get file {self.intf_track_file_name}: {e}")
+        if with_etag:
+            return intf_track_dict, etag
         return intf_track_dict
 
-    def check_object_exist(self):
-        b_exist = True
+class CliTemplate:
+    # FortiOS CLI fragments, whitespace normalized once per container and rendered with str.format
+    sources = {
+        "geneve": """
+            config system geneve
+                edit {geneve_name}
+                    set interface port{port_index}
+                    set type ppp
+                    set remote-ip {gwlb_ip}
+                next
+            end
+            config router static
+                edit 0
+                    set dst {gwlb_ip}/32
+                    set device port{port_index}
+                    set dynamic-gateway enable
+                next
+            end
+            """,
+        "fmg_vdom_exception": """
+            config system vdom-exception
+                edit 0
+                    set object system.central-management
+                next
+            end
+            """,
+        "fmg_central_management": """
+            config system central-management
+                set type fortimanager
+                set fmg {fmg_ip}
+                set serial-number {fmg_sn}
+            """,
+        "fmg_vrf_select": "set vrf-select {fmg_vrf_select}\n",
+        "fmg_end": "end\n",
+        "autoscale_primary": """
+            config system auto-scale
+                set status enable
+                set sync-interface "{sync_interface}"
+                set role primary
+                set psksecret "{psksecret}"
+            end
+            """,
+        "autoscale_secondary": """
+            config system auto-scale
+                set status enable
+                set sync-interface "{sync_interface}"
+                set role secondary
+                set primary-ip {primary_ip}
+                set psksecret "{psksecret}"
+            end
+            """,
+        "probe_response": """
+                config system probe-response
+                    set mode http-probe
+                    set port "{health_check_port}"
+                end
+            """
+    }
+    compiled = {}
+
+    def get(name):
+        if name not in CliTemplate.compiled:
+            CliTemplate.compiled[name] = re.sub(r"([\n ])\1*", r"\1", CliTemplate.sources[name])
+        return CliTemplate.compiled[name]
+
+    @functools.lru_cache(maxsize=1024)
+    def render(name, **values):
+        return CliTemplate.get(name).format(**values)
+
+class ContentCache:
+    # Content kept in memory and in /tmp of the Lambda container, each entry carries the version it was validated with
+    cache_dir = "/tmp/fgt_asg_cache"
+    entries = {}
+    lock = threading.Lock()
+
+    def get_path(key):
+        return os.path.join(ContentCache.cache_dir, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    def get(key):
+        with ContentCache.lock:
+            if key in ContentCache.entries:
+                return ContentCache.entries[key]
         try:
-            response = self.s3_client.get_object(Bucket=self.s3_bucket_name, Key=self.intf_track_file_name)
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == "404":
-                b_exist = False
-        return b_exist
+            with open(ContentCache.get_path(key), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        with ContentCache.lock:
+            ContentCache.entries[key] = entry
+        return entry
+
+    def put(key, version, content):
+        entry = {
+            "version": version,
+            "content": content
+        }
+        with ContentCache.lock:
+            ContentCache.entries[key] = entry
+        try:
+            os.makedirs(ContentCache.cache_dir, exist_ok=True)
+            path = ContentCache.get_path(key)
+            temp_path = f"{path}.{uuid.uuid4()}"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(temp_path, path)
+        except OSError:
+            pass
 
 class FgtConf:
-    def __init__(self, logger, fgt_vm_id=""):
+    def __init__(self, logger, fgt_vm_id="", instance_snapshot=None):
         self.logger = logger
-        self.ec2_client = boto3.client("ec2")
-        self.s3_client = boto3.client("s3")
-        self.lambda_client = boto3.client(
-            "lambda",
-            config=Config(
-                read_timeout=100     # seconds to wait for response
-            )
-        )
+        self.runtime = Runtime.get()
+        self.ec2_client = self.runtime.client("ec2")
+        self.s3_client = self.runtime.client("s3")
+        self.lambda_client = self.runtime.client("lambda")
 
         self.logger.info(f"Do FGT config.")
         self.fgt_vm_id = fgt_vm_id
         self.cookie = {}
         self.lic_track_file_name = "asg-fgt-lic-track.json"
+        self.config_digest_prefix = "config_digest#"
+        self.staged_payload_prefix = "staged/"
+        # Staged S3 objects of asynchronous invocations, deleted once the operation is done, {op_id: [key, ...]}
+        self.staged_ops = {}
+        # Lambda payload limits are 256 KB for Event and 6 MB for RequestResponse invocation
+        self.payload_limit = {
+            "Event": 250000,
+            "RequestResponse": 6000000
+        }
         self.s3_bucket_name = os.getenv("lic_s3_name")
         self.need_license = os.getenv("need_license") == "true"
         self.enable_privatelink_dydb = os.getenv("enable_privatelink_dydb") == "true"
-        self.fmg_integration = json.loads(os.getenv("fmg_integration"))
+        self.fmg_integration = self.runtime.fmg_integration
         self.fgt_lic_mgmt = self.fmg_integration.get("fgt_lic_mgmt", "") if self.fmg_integration else ""
-        if not self.enable_privatelink_dydb:
-            self.dynamodb_client = boto3.client(
-                "dynamodb",
-                config=Config(
-                    read_timeout=10     # seconds to wait for response
-                )
-            )
-            self.dynamodb_table_name = os.getenv("dynamodb_table_name")
+        self.dydb = Dynamodb(logger)
+        self.instance_snapshot = instance_snapshot if instance_snapshot else InstanceSnapshot(logger)
+        self.track_file_lock = None
+        # ETag of the license track file when it was read, the next write only succeeds if nobody changed it since
+        self.lic_track_etag = None
+        self.deadline = None
         self.enable_fgt_system_autoscale = os.getenv("enable_fgt_system_autoscale") == "true"
         self.fgt_system_autoscale_psksecret = os.getenv("fgt_system_autoscale_psksecret")
         self.fgt_login_port_number = os.getenv("fgt_login_port_number")
@@ -477,22 +1975,36 @@ class FgtConf:
         self.primary_scalein_protection = os.getenv("primary_scalein_protection") == "true"
         self.health_check_port = os.getenv("health_check_port")
         self.health_check_protocol = os.getenv("health_check_protocol")
+        self.fanout_concurrency = int(os.getenv("fanout_concurrency") or 10)
+        self.sn_inventory_ttl = int(os.getenv("sn_inventory_ttl") or 3600)
+        self.token_pool_size = int(os.getenv("fortiflex_token_pool_size") or 0)
 
     def set_vm_id(self, vm_id):
         self.fgt_vm_id = vm_id
 
+    def set_deadline(self, remaining_time_in_millis):
+        self.deadline = time.time() + remaining_time_in_millis / 1000
+
     def main(self, detail_type):
-        if detail_type == "EC2 Instance Launch Successful":
-            self.do_launch()
-        elif detail_type == "EC2 Instance-terminate Lifecycle Action":
-            self.do_terminate()
-        else:
+        if detail_type not in ["EC2 Instance Launch Successful", "EC2 Instance-terminate Lifecycle Action"]:
             self.logger.debug(f"Can not identify detail-type: {detail_type}")
             return
+        # Read all Dynamo DB attributes of this event in one round trip, and write them back in one transaction
+        self.dydb.begin_batch(self.get_prefetch_items(detail_type))
+        try:
+            if detail_type == "EC2 Instance Launch Successful":
+                self.do_launch()
+            else:
+                self.do_terminate()
+        finally:
+            self.dydb.end_batch()
     
     def do_launch(self):
         self.logger.info("Do launch event.")
-        instance_detail = self.ec2_client.describe_instances(InstanceIds=[self.fgt_vm_id])
+        instance = self.instance_snapshot.get_instance(self.fgt_vm_id)
+        if not instance:
+            self.logger.error(f"Can not find instance {self.fgt_vm_id}.")
+            return
         # Add name for the instance
         self.update_tags(
             [self.fgt_vm_id], 
@@ -502,61 +2014,93 @@ class FgtConf:
             }]
         )
         # Get private IP
-        fgt_private_ip = self.get_private_ip(instance_detail['Reservations'][0]['Instances'][0])
+        fgt_private_ip = self.get_private_ip(instance)
         if not fgt_private_ip:
             self.logger.error("Can not find private IP.")
             return
-        # Change password
-        b_succ = self.change_password(fgt_private_ip, self.fgt_vm_id)
-        if not b_succ:
+        # Password, license and configuration are sent to the FortiGate instance by one internal Lambda function call
+        parameters = {
+            "private_ip" : fgt_private_ip,
+            "fgt_vm_id": self.fgt_vm_id
+        }
+        b_license_ready = True
+        if self.need_license and self.fgt_lic_mgmt != "fmg":
+            # Update Serial numbers if the cached inventory is stale or has nothing left to claim
+            if not self.ensure_sn_inventory(need_available=True):
+                self.logger.warning("Could not sync serial number inventory, claim from the current inventory.")
+            license_parameters = self.claim_license(self.fgt_vm_id)
+            if license_parameters:
+                parameters.update(license_parameters)
+            else:
+                b_license_ready = False
+
+        # Configure the FortiGate instance
+        if self.fgt_lic_mgmt != "fmg" and b_license_ready:
+            self.intf_setting = self.runtime.network_interfaces
+            self.fgt_az = instance['Placement']['AvailabilityZone']
+            self.fgt_primary_ip, self.fgt_primary_port = self.get_primary_ip(instance)
+            # Only sections that have not been applied are sent, so a retried event does not push them again
+            config_content, digest_dict = self.get_changed_config(self.fgt_vm_id, self.gen_config_sections(self.fgt_vm_id))
+            if config_content:
+                parameters["config_content"] = config_content
+
+        # Persist the claimed license before the long running call
+        self.dydb.flush_batch()
+        step_dict = self.provision_instance(parameters)
+
+        if not step_dict.get("change_password", {}).get("success"):
             self.logger.error(f"Change password failed.")
+            if "license_type" in parameters:
+                self.release_claimed_license(self.fgt_vm_id, parameters["license_type"])
             return
         
         # Update in Dynamo DB
         self.add_asg_instance_dydb(self.fgt_vm_id)
 
-        # Upload license
-        if self.need_license and self.fgt_lic_mgmt != "fmg":
-            # Update Serial numbers
-            b_succ = self.update_all_sn_list()
-            b_succ = self.upload_license(fgt_private_ip, self.fgt_vm_id)
-            if not b_succ:
-                return
-
-        # Configure the FortiGate instance
-        if self.fgt_lic_mgmt != "fmg":
-            time.sleep(10)
-            self.intf_setting = json.loads(os.getenv('network_interfaces'))
-            self.fgt_az = instance_detail['Reservations'][0]['Instances'][0]['Placement']['AvailabilityZone']
-            self.fgt_primary_ip, self.fgt_primary_port = self.get_primary_ip(instance_detail['Reservations'][0]['Instances'][0])
-
-            config_content = self.gen_config_content(self.fgt_vm_id)
-            b_succ = self.upload_config(config_content, fgt_private_ip)
+        if "license_type" in parameters and not step_dict.get("upload_license", {}).get("success"):
+            self.logger.error(f"Could not active license!")
+            self.release_claimed_license(self.fgt_vm_id, parameters["license_type"])
+            return
+        if "config_content" in parameters:
+            if step_dict.get("upload_config", {}).get("success"):
+                self.save_config_digests(self.fgt_vm_id, digest_dict)
+            else:
+                self.logger.error(f"Could not upload configuration to FortiGate instance.")
 
+    def provision_instance(self, parameters):
+        self.logger.info("Provision FortiGate instance.")
+        payload = {
+            "service" : "fgt_vm",
+            "operation" : "provision_instance",
+            "parameters" : parameters
+        }
+        b_succ, response = self.invoke_lambda(payload, "fgt")
+        step_dict = {}
+        if b_succ and response:
+            for step in response.get("steps", []):
+                self.logger.info(f"Provision step {step.get('step')}, success: {step.get('success')}, duration: {step.get('duration')} sec, error: {step.get('error')}")
+                step_dict[step.get("step")] = step
+        return step_dict
         
     def do_terminate(self):
         self.logger.info("Do terminate event.")
         # Upload license
         if self.need_license and self.fgt_lic_mgmt != "fmg":
-            # Update Serial numbers
-            b_succ = self.update_all_sn_list()
+            # Update Serial numbers if the cached inventory is stale
+            if not self.ensure_sn_inventory():
+                self.logger.warning("Could not sync serial number inventory, release with the current inventory.")
             # Update license record 
             b_updated = self.release_lic(self.fgt_vm_id)
             if not b_updated:
-                used_sn_map = self.get_used_sn_map()
-                if self.fgt_vm_id in used_sn_map:
-                    sn = used_sn_map.pop(self.fgt_vm_id)
-                    self.update_used_sn_map(used_sn_map)
-                    self.add_available_sn({sn})
+                sn = self.get_used_sn_map().get(self.fgt_vm_id)
+                if sn:
                     # Deactive current token
-                    oauth_token = self.get_fortiflex_oauth_token()
-                    if oauth_token:
-                        self.stop_sn(sn, oauth_token)
+                    self.release_active_sn(self.fgt_vm_id, sn)
         # Update instance info on Dynamo DB
         self.remove_asg_instance_dydb(self.fgt_vm_id)
+        self.dydb.delete_record(self.config_digest_prefix + self.fgt_vm_id)
         if self.enable_fgt_system_autoscale:
-            instance_detail = self.ec2_client.describe_instances(InstanceIds=[self.fgt_vm_id])
-            if instance_detail['Reservations'] and instance_detail['Reservations'][0]['Instances']:
+            if self.instance_snapshot.get_instance(self.fgt_vm_id):
                 self.update_tags(
                     [self.fgt_vm_id], 
                     [{
@@ -606,88 +2150,135 @@ class FgtConf:
 
 # Invoke lambda function
     def invoke_lambda(self, payload, target_lambda, invocation_type=""):
-        b_succ= False
-        rst = {}
         if target_lambda == "fgt":
             fucnName = self.internal_lambda_name
         else:
             self.logger.error(f"Unknown target lambda function name: {target_lambda}")
-            return
-        if invocation_type == "":
-            invocation_type = 'RequestResponse'
+            return False, {}
+        if self.deadline and invocation_type != "Event" and "parameters" in payload:
+            # Let the internal Lambda function give up before this function times out
+            payload["parameters"]["deadline"] = self.deadline - 10
+        op_id = self.dydb.track_op(payload.get("operation", "")) if invocation_type == "Event" else ""
+        if op_id:
+            payload["op_id"] = op_id
+        staged_key_list = []
+        payload = self.stage_payload(payload, invocation_type, staged_key_list)
+        b_succ, rst = Helper.invoke_lambda(self.logger, self.lambda_client, fucnName, payload, invocation_type) if payload else (False, {})
+        if not b_succ and op_id:
+            self.dydb.pending_ops.pop(op_id, None)
+        if b_succ and op_id and staged_key_list:
+            # The internal Lambda function reads staged objects later, they are deleted when the operation is confirmed
+            self.staged_ops[op_id] = staged_key_list
+        else:
+            self.delete_staged_objects(staged_key_list)
+        return b_succ, rst
+
+    def delete_staged_objects(self, key_list):
+        if not key_list:
+            return True
+        b_succ = False
         try:
-            Helper.set_to_list(payload)
-            response = self.lambda_client.invoke(
-                FunctionName = fucnName,
-                InvocationType = invocation_type,
-                Payload = json.dumps(payload)
+            self.s3_client.delete_objects(
+                Bucket=self.s3_bucket_name,
+                Delete={
+                    "Objects": [{"Key": key} for key in key_list],
+                    "Quiet": True
+                }
             )
-            if "StatusCode" in response and response["StatusCode"] in [200, 202, 204]:
-                b_succ = True
-                payload_contant = response["Payload"].read()
-                if payload_contant:
-                    payload_contant_json = json.loads(payload_contant.decode("utf-8"))
-                    if payload_contant_json["ErrorMsg"]:
-                        self.logger.error("Invoke lambda function response error msg: {}".format(payload_contant_json["ErrorMsg"]))
-                        b_succ = False
-                    else:
-                        rst = payload_contant_json["ResponseContent"]
-            else:
-                errmsg = ""
-                if "FunctionError" in response:
-                    errmsg = response["FunctionError"]
-                self.logger.error(f"Invoke lambda function failed: {errmsg}")
+            b_succ = True
         except Exception as err:
-            self.logger.error(f"Could not invoke lambda function, error: {err}")
-        return b_succ, rst
+            self.logger.error(f"Could not delete staged S3 objects {key_list}: {err}")
+        return b_succ
+
+    def stage_payload(self, payload, invocation_type="", staged_key_list=None):
+        # Serialize payload once, move large contents to S3 bucket if payload is over the limit of invocation type
+        Helper.set_to_list(payload)
+        rst = json.dumps(payload)
+        payload_limit = self.payload_limit.get(invocation_type or "RequestResponse")
+        if len(rst) <= payload_limit:
+            return rst
+        parameters = payload.get("parameters", {})
+        for parameter_name in ["config_content", "license_content"]:
+            content = parameters.get(parameter_name)
+            if not content or type(content) is not str:
+                continue
+            # Key is unique per invocation, so deleting it after use never affects another invocation
+            key_name = self.staged_payload_prefix + uuid.uuid4().hex
+            self.logger.info(f"Stage {parameter_name} of {len(content)} bytes to S3 object {key_name}.")
+            try:
+                self.s3_client.put_object(
+                    Bucket=self.s3_bucket_name,
+                    Key=key_name,
+                    Body=content.encode("utf-8")
+                )
+            except Exception as err:
+                self.logger.error(f"Could not stage {parameter_name} to S3 bucket: {err}")
+                return None
+            if staged_key_list is not None:
+                staged_key_list.append(key_name)
+            del parameters[parameter_name]
+            parameters[parameter_name + "_s3"] = {
+                "bucket": self.s3_bucket_name,
+                "key": key_name
+            }
+        rst = json.dumps(payload)
+        if len(rst) > payload_limit:
+            self.logger.error(f"Payload size {len(rst)} is over the limit {payload_limit} of invocation.")
+            return None
+        return rst
     
 # License
     def upload_license(self, fgt_private_ip, fgt_vm_id):
-        # Get license, license_type: "token", "file"; license_content：token if license_type is token, file name if license_type is file
         self.logger.info("Upload license.")
+        license_parameters = self.claim_license(fgt_vm_id)
+        if not license_parameters:
+            return False
+
+        # Upload license
+        license_parameters["private_ip"] = fgt_private_ip
+        payload = {
+            "service" : "fgt_vm",
+            "operation" : "upload_license",
+            "parameters" : license_parameters
+        }
+        b_succ, response = self.invoke_lambda(payload, "fgt")
+        if b_succ:
+            self.logger.info("Upload license success.")
+        else:
+            self.logger.error(f"Could not active license!")
+            self.release_claimed_license(fgt_vm_id, license_parameters["license_type"])
+        return b_succ
+
+    def claim_license(self, fgt_vm_id):
+        # Get license, license_type: "token", "file"; license_content：token if license_type is token, file name if license_type is file
         license_type, license_content, sn_or_file_name = self.get_license(fgt_vm_id)
         if license_type == "":
             self.logger.error(f"Could not get license!")
-            return False
+            return None
+        # Serial number of a token has been recorded as used by the claim, it is given back if activation failed
+        if license_type != "token":
+            license_content = self.get_lic_file_content(license_content)
+        return {
+            "license_type": license_type,
+            "license_content": license_content
+        }
 
-        # Upload license
+    def release_claimed_license(self, fgt_vm_id, license_type):
         if license_type == "token":
-            payload = {
-                "service" : "fgt_vm",
-                "operation" : "upload_license",
-                "parameters" : {
-                    "private_ip" : fgt_private_ip,
-                    "license_type": license_type,
-                    "license_content": license_content
-                }
-            }
-            b_succ, response = self.invoke_lambda(payload, "fgt")
-            if b_succ:
-                used_sn_map = self.get_used_sn_map()
-                used_sn_map[fgt_vm_id] = sn_or_file_name
-                self.update_used_sn_map(used_sn_map)
-            else:
-                self.add_available_sn({sn_or_file_name})
-                self.logger.error("Could not activate the token on FortiGate instance.")
-        elif license_type == "file":
-            lic_file_content = self.get_lic_file_content(license_content)
-            payload = {
-                "service" : "fgt_vm",
-                "operation" : "upload_license",
-                "parameters" : {
-                    "private_ip" : fgt_private_ip,
-                    "license_type": license_type,
-                    "license_content": lic_file_content
-                }
-            }
-            b_succ, response = self.invoke_lambda(payload, "fgt")
-            # Update license track file if upload license successfully
-            if b_succ:
-                self.logger.info("Upload license file success.")
-            else:
-                self.logger.error(f"Could not active license!")
-                self.release_lic(fgt_vm_id)
-        return b_succ
+            sn = self.get_used_sn_map().get(fgt_vm_id)
+            if sn:
+                self.release_active_sn(fgt_vm_id, sn)
+        else:
+            self.release_lic(fgt_vm_id)
+
+    def release_active_sn(self, fgt_vm_id, sn, oauth_token=None):
+        # Serial numbers in available_sn_list are kept stopped, the next claim reactivates them.
+        # Stop first, the serial number can be claimed and reactivated by others once it is released
+        if not oauth_token:
+            oauth_token = self.get_fortiflex_oauth_token()
+        if oauth_token:
+            self.stop_sn(sn, oauth_token)
+        return self.dydb.release_sn(fgt_vm_id, sn)
 
     def get_license(self, fgt_vm_id):
         self.logger.info("Get next available license.")
@@ -722,6 +2313,12 @@ class FgtConf:
             if b_find:
                 return license_type, license_content, lic_track_dict
             self.logger.info("Could not get license file, try FortiFlex token.")
+        # Token prepared by the pool needs no FortiFlex call
+        if self.token_pool_size:
+            vm_token, cur_sn = self.claim_pool_token(fgt_vm_id)
+            self.trigger_token_pool_refill()
+            if vm_token:
+                return "token", vm_token, cur_sn
         # Get FortiFlex token
         # Check FortiFlex OAuth token
         oauth_token = self.get_fortiflex_oauth_token()
@@ -733,13 +2330,19 @@ class FgtConf:
         available_sn_list = dydb_items.get("available_sn_list", [])
         if available_sn_list:
             for cur_sn in available_sn_list:
-                b_succ = self.reactivate_sn(cur_sn, oauth_token)
-                if not b_succ:
+                # Claim first, so no other launch activates the same serial number
+                if not self.dydb.claim_sn(cur_sn, fgt_vm_id):
                     continue
-                vm_token = self.generate_vm_token(cur_sn, oauth_token)
+                vm_token = ""
+                b_reactivated = self.reactivate_sn(cur_sn, oauth_token)
+                if b_reactivated:
+                    vm_token = self.generate_vm_token(cur_sn, oauth_token)
                 if vm_token:
-                    self.remove_available_sn({cur_sn})
                     return "token", vm_token, cur_sn
+                if b_reactivated:
+                    self.release_active_sn(fgt_vm_id, cur_sn, oauth_token)
+                else:
+                    self.dydb.release_sn(fgt_vm_id, cur_sn)
         else:
             self.logger.info("Could not get available serial number.")
 
@@ -747,37 +2350,52 @@ class FgtConf:
 
     def update_lic_track_file(self, lic_track_dict):
         self.logger.info("Update license track file.")
+        # Renewing the lease also verifies nobody else acquired the lock after an expired lease
+        if not self.track_file_lock or not self.track_file_lock.renew():
+            self.logger.error("License track file lock is not held, skip updating.")
+            return False
         file_body = json.dumps(lic_track_dict)
         b_succ = False
         try:
+            if self.lic_track_etag:
+                condition = {"IfMatch": self.lic_track_etag}
+            else:
+                condition = {"IfNoneMatch": "*"}
             response = self.s3_client.put_object(
                 Bucket=self.s3_bucket_name, 
                 Key=self.lic_track_file_name, 
                 Body=file_body,
-                Tagging=f"lock_id={self.lock_id}"
+                **condition
                 )
+            self.lic_track_etag = response.get("ETag")
             b_succ = True
+        except ClientError as e:
+            if e.response['Error']['Code'] in ["PreconditionFailed", "ConditionalRequestConflict", "412"]:
+                self.logger.error(f"License track file has been changed by others since it was read, skip updating.")
+            else:
+                self.logger.error(f"Could not save S3 object: {e}")
         except Exception as err:
             self.logger.error(f"Could not save S3 object: {err}")
         return b_succ
         
-    def get_lic_track_dict(self):
+    def get_lic_track_dict(self, refresh=True):
+        # Refreshing could write the file, callers that do not hold the lock read without refresh
         self.logger.info("Get license track file from S3 bucket.")
         lic_track_dict = {}
         try:
             response = self.s3_client.get_object(Bucket=self.s3_bucket_name, Key=self.lic_track_file_name)
+            self.lic_track_etag = response.get("ETag")
             lic_track_dict = json.loads(response.get("Body").read())
             if not lic_track_dict:
-                self.logger.info(f"File {self.lic_track_file_name} not been created.")
-                return
-            else:
+                self.logger.info(f"File {self.lic_track_file_name} not been initialized.")
+                lic_track_dict = self.new_lic_track_dict()
+            if refresh:
                 lic_track_dict = self.refresh_lic_track_dic(lic_track_dict)
         except botocore.exceptions.ClientError as e:
             self.logger.info(f"Could not get file {self.lic_track_file_name}: {e}")
         return lic_track_dict
 
-    def create_lic_track_file(self):
-        self.logger.info("Create license track file on S3 bucket.")
+    def new_lic_track_dict(self):
         lic_track_dict = {
             "token": {
                 "available": [],
@@ -786,81 +2404,100 @@ class FgtConf:
             "file": {
                 "available": [],
                 "used": {}
-            }
+            },
+            # S3 objects already indexed: {key: {"etag": etag, "tokens": [token, ...]}}
+            "index": {}
         }
+        return lic_track_dict
 
+    def create_lic_track_file(self):
+        self.logger.info("Create license track file on S3 bucket.")
+        lic_track_dict = self.new_lic_track_dict()
+        # Only create the file if it still does not exist
+        self.lic_track_etag = None
         return self.update_lic_track_file(lic_track_dict)
 
+    def list_lic_objects(self):
+        # Return {key: etag} of all license files and token lists in the bucket
+        object_dict = {}
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.s3_bucket_name):
+            for item in page.get("Contents", []):
+                file_name = item["Key"]
+                if file_name in [self.lic_track_file_name, "intf_track.json"] or file_name.startswith(self.staged_payload_prefix):
+                    continue
+                if file_name.endswith(".lic") or file_name.endswith(".json"):
+                    object_dict[file_name] = item.get("ETag", "")
+        return object_dict
+
+    def get_token_list(self, file_name):
+        token_list = []
+        try:
+            response = self.s3_client.get_object(Bucket=self.s3_bucket_name, Key=file_name)
+            for token in Helper.iter_json_list(response.get("Body")):
+                if type(token) is str:
+                    token_list.append(token)
+        except ValueError as err:
+            self.logger.info(f"File {file_name} is not a token list: {err}")
+        except botocore.exceptions.ClientError as e:
+            self.logger.error(f"Could not get file {file_name}: {e}")
+        return token_list
+
     def refresh_lic_track_dic(self, lic_track_dict):
         self.logger.info(f"Refresh lic track file.")
         try:
-            response = self.s3_client.list_objects(Bucket=self.s3_bucket_name)
-        except botocore.exceptions.NoSuchBucket as e:
-            self.logger.error(f"Could not get S3 bucket: {e}")
+            object_dict = self.list_lic_objects()
+        except botocore.exceptions.ClientError as e:
+            self.logger.error(f"Could not list S3 bucket: {e}")
             return {}
 
+        old_index = lic_track_dict.get("index", {})
+        new_index = {}
+        file_list = []
+        token_list = []
+        for file_name, etag in object_dict.items():
+            if file_name.endswith(".lic"):
+                new_index[file_name] = {"etag": etag}
+                file_list.append(file_name)
+                continue
+            # Only download token lists that changed since they were indexed
+            index_entry = old_index.get(file_name)
+            if not index_entry or index_entry.get("etag") != etag:
+                # Downloading many token lists could outlast the lease
+                if self.track_file_lock:
+                    self.track_file_lock.keep_alive()
+                self.logger.info(f"Index token file: {file_name}")
+                index_entry = {
+                    "etag": etag,
+                    "tokens": self.get_token_list(file_name)
+                }
+            new_index[file_name] = index_entry
+            token_list.extend(index_entry.get("tokens", []))
+
         new_lic_track_dict = {
-            "token": {
-                "available": [],
-                "used": {}
-            },
-            "file": {
-                "available": [],
-                "used": {}
-            }
+            "index": new_index
         }
-        file_list = response["Contents"]
-        has_change = False
-        unknow_file_list = []
-        for item in file_list:
-            file_name = item["Key"]
-            if file_name == self.lic_track_file_name:
-                continue
-            if file_name.endswith(".lic"):
-                bfind = False
-                file_available = lic_track_dict["file"]["available"]
-                file_used = lic_track_dict["file"]["used"]
-                if file_used:
-                    for k, v in file_used.items():
-                        if v == file_name:
-                            new_lic_track_dict["file"]["used"][k] = v
-                            file_used.pop(k)
-                            bfind = True
-                            break
-                if not bfind:
-                    new_lic_track_dict["file"]["available"].append(file_name)
-                    if file_available and file_name in file_available:
-                        file_available.remove(file_name)
-                    else:
-                        has_change = True
-
-            elif file_name.endswith(".json"):
-                response = self.s3_client.get_object(Bucket=self.s3_bucket_name, Key=file_name)
-                file_content = json.loads(response.get("Body").read())
-                if type(file_content) is list:
-                    for token in file_content:
-                        bfind = False
-                        token_available = lic_track_dict["token"]["available"]
-                        token_used = lic_track_dict["token"]["used"]
-                        if token_used:
-                            for k, v in token_used.items():
-                                if v == token:
-                                    new_lic_track_dict["token"]["used"][k] = v
-                                    token_used.pop(k)
-                                    bfind = True
-                                    break
-                        if not bfind:
-                            new_lic_track_dict["token"]["available"].append(token)
-                            if token_available and token in token_available:
-                                token_available.remove(token)
-                            else:
-                                has_change = True
-            else:
-                unknow_file_list.append(file_name)
+        for lic_type, all_list in [("file", file_list), ("token", token_list)]:
+            old_content = lic_track_dict.get(lic_type, {})
+            all_set = set(all_list)
+            used = {}
+            for k, v in old_content.get("used", {}).items():
+                if v in all_set:
+                    used[k] = v
+            used_set = set(used.values())
+            # Keep the existing order of available licenses, then append new ones
+            available = []
+            available_set = set()
+            for v in old_content.get("available", []) + all_list:
+                if v in all_set and v not in used_set and v not in available_set:
+                    available.append(v)
+                    available_set.add(v)
+            new_lic_track_dict[lic_type] = {
+                "available": available,
+                "used": used
+            }
 
-        if has_change or lic_track_dict["token"]["available"] or lic_track_dict["token"]["used"] or lic_track_dict["file"]["available"] or lic_track_dict["file"]["used"]:
-            has_change = True
-        if has_change:
+        if new_lic_track_dict != lic_track_dict:
             self.update_lic_track_file(new_lic_track_dict)
         return new_lic_track_dict
 
@@ -878,165 +2515,58 @@ class FgtConf:
 
     def release_lic(self, fgt_vm_id):
         self.logger.info("Release license.")
+        released_id_set = self.release_lics([fgt_vm_id])
+        return fgt_vm_id in released_id_set
+
+    def release_lics(self, fgt_vm_id_list):
+        # Release licenses of several instances with one lock and one write of the license track file
+        released_id_set = set()
         b_locked = self.lock_lic_track_file()
         if not b_locked:
-            return False
-        b_updated = False
+            return released_id_set
         try:
             # Get license track file
             lic_track_dict = self.get_lic_track_dict()
             if lic_track_dict:
                 # Update license track file
-                for content_dic in lic_track_dict.values():
-                    if fgt_vm_id in content_dic["used"]:
-                        b_updated = True
-                        lic_content = content_dic["used"].pop(fgt_vm_id)
-                        content_dic["available"].append(lic_content)
-                        break
+                for fgt_vm_id in fgt_vm_id_list:
+                    for lic_type in ["token", "file"]:
+                        content_dic = lic_track_dict.get(lic_type, {})
+                        if fgt_vm_id in content_dic.get("used", {}):
+                            released_id_set.add(fgt_vm_id)
+                            lic_content = content_dic["used"].pop(fgt_vm_id)
+                            content_dic["available"].append(lic_content)
+                            break
+                    if fgt_vm_id not in released_id_set:
+                        self.logger.info(f"Did not find instance id in license track file: {fgt_vm_id}")
                 # Upload license track file to S3 bucket
-                if not b_updated:
-                    self.logger.info(f"Did not find instance id in license track file: {fgt_vm_id}")
-                else:
+                if released_id_set:
                     self.update_lic_track_file(lic_track_dict)
         except Exception as e:
             self.logger.error(f"Exception when release instance to available in interface track file: {e}")
+            released_id_set = set()
         self.unlock_lic_track_file()
-        return b_updated
+        return released_id_set
 
     def lock_lic_track_file(self):
-        self.logger.info("Lock license track file from S3 bucket.")
-        self.lock_id = str(uuid.uuid1())
-        b_succ = False
-        # Get tagging
-        max_loop = 60
-        go_next = False
-        for i in range(max_loop):
-            try:
-                b_exist = self.check_object_exist()
-                if not b_exist:
-                    self.create_lic_track_file()
-                    break
-                response = self.s3_client.get_object_tagging(Bucket=self.s3_bucket_name, Key=self.lic_track_file_name)
-                lic_track_tags = response.get("TagSet")
-                lock_tag = None
-                for tag in lic_track_tags:
-                    if tag["Key"] == 'lock_id':
-                        lock_tag = tag
-                if not lock_tag:
-                    self.logger.info(f"Lic track file tags is empty: {lic_track_tags}")
-                    self.create_lic_track_file()
-                    break
-                else:
-                    locked_by_other = False
-                    if lock_tag["Value"]:
-                        locked_by_other = True
-                        break
-                    if locked_by_other:
-                        time.sleep(2)
-                        continue
-                    go_next = True
-                    break
-            except botocore.exceptions.ClientError as e:
-                self.logger.info(f"Could not get tags of  file {self.lic_track_file_name}: {e}")
-                self.create_lic_track_file()
-                break
-        
-        # Update tagging
-        if go_next:
-            try:
-                response = self.s3_client.put_object_tagging(
-                    Bucket=self.s3_bucket_name, 
-                    Key=self.lic_track_file_name,
-                    Tagging={
-                        'TagSet': [
-                            {
-                                'Key': 'lock_id',
-                                'Value': self.lock_id
-                            },
-                        ]
-                    })
-            except botocore.exceptions.ClientError as e:
-                self.logger.info(f"Could not get tags of file {self.lic_track_file_name}: {e}")
-        # Check lock success
-        b_succ = self.check_lock_status("lock")
-        if b_succ:
-            self.logger.info(f"Lock license track file sussess: {self.lock_id}")
-
+        self.logger.info("Lock license track file.")
+        self.track_file_lock = DydbLock(self.logger, self.dydb, "lic_track")
+        b_succ = self.track_file_lock.acquire()
+        if b_succ and not self.check_object_exist():
+            self.create_lic_track_file()
         return b_succ
 
     def unlock_lic_track_file(self):
-        self.logger.info("Unlock license track file from S3 bucket.")
-        b_succ = False
-        # Get tagging
-        go_next = True
-        try:
-            response = self.s3_client.get_object_tagging(Bucket=self.s3_bucket_name, Key=self.lic_track_file_name)
-            lic_track_tags = response.get("TagSet")
-            if not lic_track_tags:
-                self.logger.error(f"Can not find lock info in tags.")
-            else:
-                locked_by_other = False
-                for tag in lic_track_tags:
-                    if tag["Key"] == 'lock_id':
-                        if not tag["Value"] or tag["Value"] != self.lock_id:
-                            vl = tag["Value"]
-                            self.logger.info(f"Lic track file is not locked or locked by others: {vl}")
-                            go_next = False
-                            break
-        except botocore.exceptions.ClientError as e:
-            self.logger.info(f"Could not get tags of file {self.lic_track_file_name}: {e}")
-            go_next = False
-        
-        # Update tagging
-        if go_next:
-            try:
-                response = self.s3_client.put_object_tagging(
-                    Bucket=self.s3_bucket_name, 
-                    Key=self.lic_track_file_name,
-                    Tagging={
-                        'TagSet': [
-                            {
-                                'Key': 'lock_id',
-                                'Value': ""
-                            },
-                        ]
-                    })
-                b_succ = True
-            except botocore.exceptions.ClientError as e:
-                self.logger.info(f"Could not get tags of file {self.lic_track_file_name}: {e}")
-        # Check unlock success
-        b_succ = self.check_lock_status("unlock")
-        if b_succ:
-            self.logger.info(f"Unlock license track file sussess: {self.lock_id}")
-        return b_succ
-
-    def check_lock_status(self, status):
-        status_value = ""
-        if status == "lock":
-            status_value = self.lock_id
-        b_succ = False
-        try:
-            response = self.s3_client.get_object_tagging(Bucket=self.s3_bucket_name, Key=self.lic_track_file_name)
-            lic_track_tags = response.get("TagSet")
-            if not lic_track_tags:
-                self.logger.error(f"Did not lock the file.")
-            else:
-                for tag in lic_track_tags:
-                    if tag["Key"] == 'lock_id':
-                        if tag["Value"] == status_value:
-                            b_succ = True
-                            break
-        except botocore.exceptions.ClientError as e:
-            self.logger.info(f"Could not get tags of file {self.lic_track_file_name}: {e}")
+        self.logger.info("Unlock license track file.")
+        b_succ = self.track_file_lock.release()
         return b_succ
 
     def check_object_exist(self):
         b_exist = True
         try:
-            # s3.Object(self.s3_bucket_name, self.lic_track_file_name).load()
-            response = self.s3_client.get_object(Bucket=self.s3_bucket_name, Key=self.lic_track_file_name)
+            response = self.s3_client.head_object(Bucket=self.s3_bucket_name, Key=self.lic_track_file_name)
         except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == "404":
+            if e.response['Error']['Code'] in ["404", "NoSuchKey"]:
                 b_exist = False
         return b_exist
 
@@ -1051,7 +2581,7 @@ class FgtConf:
             "Content-Type": "application/json",
             "Authorization": f"Bearer {oauth_token}"
         }
-        response = requests.get(url, headers=header, verify=False, timeout=10)
+        response = self.runtime.http_session.get(url, headers=header, verify=False, timeout=10)
         if response.status_code == 200:
             response_json = response.json()
             if response_json:
@@ -1075,7 +2605,7 @@ class FgtConf:
             "grant_type":"refresh_token",
             "refresh_token": oauth_refresh_token
         }
-        response = requests.post(url, headers=header, json=body, verify=False, timeout=10)
+        response = self.runtime.http_session.post(url, headers=header, json=body, verify=False, timeout=10)
         if response.status_code == 200:
             response_json = response.json()
             if response_json:
@@ -1084,8 +2614,7 @@ class FgtConf:
                     return ""
                 new_oauth_token = response_json["access_token"]
                 new_refresh_token = response_json["refresh_token"]
-                b_succ = self.update_fortiflex_oauth_token(new_oauth_token)
-                b_succ = self.update_fortiflex_refresh_token(new_refresh_token)
+                b_succ = self.update_fortiflex_tokens(new_oauth_token, new_refresh_token, response_json.get("expires_in", 0))
             else:
                 self.logger.info("Could not get http return status")
         response.close()
@@ -1095,15 +2624,61 @@ class FgtConf:
    # Token related
     def get_fortiflex_oauth_token(self):
         self.logger.info("Get FortiFlex OAuth token.")
-        dydb_items = self.get_item_from_dydb("fortiflex", ["oauth_token"])
-        oauth_token = dydb_items.get("oauth_token", "")
+        # Token cached by this container is used until it is close to expiry
+        if self.is_oauth_token_fresh(self.runtime.fortiflex_oauth):
+            return self.runtime.fortiflex_oauth["oauth_token"]
+        dydb_items = self.get_item_from_dydb("fortiflex", ["oauth_token", "oauth_expires_at"])
+        oauth_token = self.check_oauth_token(dydb_items)
         if oauth_token:
+            return oauth_token
+        # Only one Lambda function refreshes the token, the refresh token is single use
+        refresh_lock = DydbLock(self.logger, self.dydb, "fortiflex_oauth")
+        if not refresh_lock.acquire():
+            # Refreshing without the lock could spend the refresh token another holder is using, take what it stored
+            fortiflex_record = self.dydb.get_record("fortiflex")
+            oauth_token = fortiflex_record.get("oauth_token", "")
+            expires_at = float(fortiflex_record.get("oauth_expires_at") or 0)
+            if oauth_token and (not expires_at or expires_at > time.time()):
+                return oauth_token
+            self.logger.error("Could not refresh FortiFlex OAuth token, the refresh lock is held by others.")
+            return ""
+        try:
+            # Token could have been refreshed by the previous lock holder
+            fortiflex_record = self.dydb.get_record("fortiflex")
+            oauth_token = self.check_oauth_token(fortiflex_record, verify=False)
+            if oauth_token:
+                return oauth_token
+            return self.refresh_fortiflex_oauth_token(fortiflex_record.get("oauth_refresh_token") or self.get_fortiflex_refresh_token())
+        finally:
+            refresh_lock.release()
+
+    def is_oauth_token_fresh(self, token_dict, margin=300):
+        return bool(token_dict.get("oauth_token")) and float(token_dict.get("expires_at") or 0) - time.time() > margin
+
+    def check_oauth_token(self, dydb_items, verify=True):
+        # Return the stored token if it is not close to expiry, tokens stored without expiry time are verified once
+        oauth_token = dydb_items.get("oauth_token", "")
+        if not oauth_token:
+            return ""
+        token_dict = {
+            "oauth_token": oauth_token,
+            "expires_at": float(dydb_items.get("oauth_expires_at") or 0)
+        }
+        if not token_dict["expires_at"] and verify:
             b_valid, expires_in = self.verify_oauth_token(oauth_token)
-            if b_valid:
-                if expires_in > 120:
-                    return oauth_token
+            if b_valid and expires_in > 120:
+                token_dict["expires_at"] = time.time() + expires_in
+                self.put_item_to_dydb("fortiflex", "oauth_expires_at", token_dict["expires_at"])
+                self.runtime.fortiflex_oauth = token_dict
+                return oauth_token
+            return ""
+        if not self.is_oauth_token_fresh(token_dict):
+            return ""
+        self.runtime.fortiflex_oauth = token_dict
+        return oauth_token
+
+    def refresh_fortiflex_oauth_token(self, oauth_refresh_token):
         # If oauth_token not exist or will/already expired
-        oauth_refresh_token = self.get_fortiflex_refresh_token()
         new_oauth_token = ""
         if oauth_refresh_token:
             new_oauth_token = self.refresh_oauth_token(oauth_refresh_token)
@@ -1128,6 +2703,21 @@ class FgtConf:
     def update_fortiflex_refresh_token(self, oauth_refresh_token):
         b_succ = self.put_item_to_dydb("fortiflex", "oauth_refresh_token", oauth_refresh_token)
         return b_succ
+
+    def update_fortiflex_tokens(self, oauth_token, oauth_refresh_token, expires_in=0):
+        # The refresh token is single use, write the new pair out immediately even in batch mode
+        expires_at = time.time() + expires_in if expires_in else 0
+        attribute_dict = {
+            "oauth_token": oauth_token,
+            "oauth_refresh_token": oauth_refresh_token,
+            "oauth_expires_at": expires_at
+        }
+        b_succ = self.dydb.put_items_to_dydb("fortiflex", attribute_dict, flush=True)
+        self.runtime.fortiflex_oauth = {
+            "oauth_token": oauth_token,
+            "expires_at": expires_at
+        }
+        return b_succ
     
     def generate_refresh_token(self):
         self.logger.info("Generate OAuth token and refresh token by API username and password.")
@@ -1148,15 +2738,14 @@ class FgtConf:
             "client_id": "flexvm",
             "grant_type":"password"
         }
-        response = requests.post(url, headers=header, json=body, verify=False, timeout=10)
+        response = self.runtime.http_session.post(url, headers=header, json=body, verify=False, timeout=10)
         if response.status_code == 200:
             response_json = response.json()
             if response_json:
                 if "access_token" in response_json and "refresh_token" in response_json:
                     oauth_token = response_json["access_token"]
                     refresh_token = response_json["refresh_token"]
-                    self.update_fortiflex_oauth_token(oauth_token)
-                    self.update_fortiflex_refresh_token(refresh_token)
+                    self.update_fortiflex_tokens(oauth_token, refresh_token, response_json.get("expires_in", 0))
             else:
                 self.logger.info("Could not get http return status")
         response.close()
@@ -1173,7 +2762,7 @@ class FgtConf:
         body = {
             "serialNumber": sn
         }
-        response = requests.post(url, headers=header, json=body, verify=False, timeout=10)
+        response = self.runtime.http_session.post(url, headers=header, json=body, verify=False, timeout=10)
         if response.status_code == 200:
             response_json = response.json()
             if response_json:
@@ -1199,7 +2788,7 @@ class FgtConf:
         body = {
             "serialNumber": sn
         }
-        response = requests.post(url, headers=header, json=body, verify=False, timeout=10)
+        response = self.runtime.http_session.post(url, headers=header, json=body, verify=False, timeout=10)
         response_json = response.json()
         if response.status_code == 200:
             if response_json:
@@ -1229,7 +2818,7 @@ class FgtConf:
         body = {
             "serialNumber": sn
         }
-        response = requests.post(url, headers=header, json=body, verify=False, timeout=10)
+        response = self.runtime.http_session.post(url, headers=header, json=body, verify=False, timeout=10)
         if response.status_code == 200:
             response_json = response.json()
             if response_json:
@@ -1245,24 +2834,42 @@ class FgtConf:
         return b_succ
 
    # Serial number related
+    def ensure_sn_inventory(self, need_available=False):
+        # Serial number inventory is synced by the scheduled refresh, lifecycle events only sync it when it is stale or empty
+        dydb_items = self.get_item_from_dydb("fortiflex", ["sn_inventory_refreshed_at", "all_sn_list", "available_sn_list", "token_pool"])
+        refreshed_at = float(dydb_items.get("sn_inventory_refreshed_at") or 0)
+        if time.time() - refreshed_at >= self.sn_inventory_ttl:
+            self.logger.info("Serial number inventory is stale.")
+        elif not dydb_items.get("all_sn_list"):
+            self.logger.info("Serial number inventory is empty.")
+        elif need_available and not dydb_items.get("available_sn_list") and not dydb_items.get("token_pool"):
+            self.logger.info("No available serial number in inventory.")
+        else:
+            self.logger.info(f"Use serial number inventory refreshed at {refreshed_at}.")
+            return True
+        return self.update_all_sn_list()
+
     def update_all_sn_list(self):
         self.logger.info("Update all serial number list")
         # get SN list given by user
-        config_sn_list = json.loads(os.getenv("fortiflex_sn_list"))
-        if not config_sn_list:
-            config_sn_list = []
+        config_sn_list = list(self.runtime.fortiflex_sn_list or [])
         # get config ID list given by user, and get all available SNs under the config IDs
-        configid_list = json.loads(os.getenv("fortiflex_configid_list"))
-        if not configid_list:
-            configid_list = []
-        for configid in configid_list:
-            cur_sn_list = self.get_sn_by_configid(configid)
-            config_sn_list.extend(cur_sn_list)
+        configid_list = self.runtime.fortiflex_configid_list
+        sn_inventory = {}
+        if configid_list:
+            sn_inventory = self.get_sn_inventory(configid_list)
+            if sn_inventory is None:
+                # Partial discovery would drop serial numbers, keep the inventory stale so it is synced again
+                self.logger.error("Could not discover serial numbers, skip updating serial number lists.")
+                return False
+            config_sn_list.extend(sn_inventory.keys())
 
         # get used SN list
         used_sn_map = self.get_used_sn_map()
         used_sn_set = set(used_sn_map.values())
         config_sn_list.extend(used_sn_set)
+        # Serial numbers in the token pool are neither used nor available
+        token_pool = self.get_item_from_dydb("fortiflex", ["token_pool"]).get("token_pool") or {}
         if not config_sn_list:
             return False
         all_sn_list = set(config_sn_list)
@@ -1274,9 +2881,21 @@ class FgtConf:
         if all_sn_list != dydb_all_sn_list:
             # Update all_sn_list
             self.put_item_to_dydb("fortiflex", "all_sn_list", all_sn_list)
-        # Update available_sn_list
-        new_available_sn_list = all_sn_list - used_sn_set
+        # Update available_sn_list, only serial numbers new to the inventory are added,
+        # known ones are moved between lists by conditional writes and a snapshot could be outdated
+        new_available_sn_list = all_sn_list - dydb_all_sn_list - used_sn_set - set(token_pool)
         removed_sn_list = dydb_all_sn_list - all_sn_list
+        # Pooled serial numbers are active, the ones that left the inventory are stopped once taken out of the pool
+        taken_sn_list = [sn for sn in removed_sn_list & set(token_pool) if self.dydb.take_map_entry("fortiflex", "token_pool", sn)]
+        if taken_sn_list:
+            oauth_token = self.get_fortiflex_oauth_token()
+            if oauth_token:
+                Helper.run_concurrently(
+                    self.logger,
+                    lambda sn: self.stop_sn(sn, oauth_token),
+                    {sn: sn for sn in taken_sn_list},
+                    self.fanout_concurrency
+                )
         if new_available_sn_list:
             self.add_available_sn(new_available_sn_list)
         if removed_sn_list:
@@ -1284,21 +2903,70 @@ class FgtConf:
             for instance_id, sn in used_sn_map.items():
                 if sn in removed_sn_list:
                     self.logger.info(f"Change license for instance {instance_id}")
-                    instance_detail = self.ec2_client.describe_instances(InstanceIds=[instance_id])
-                    cur_private_ip = self.get_private_ip(instance_detail['Reservations'][0]['Instances'][0]) 
+                    instance = self.instance_snapshot.get_instance(instance_id)
+                    cur_private_ip = self.get_private_ip(instance) if instance else None
                     if not cur_private_ip:
                         self.logger.info(f"Can not find private IP for instance: {instance_id}")
                         continue
                     self.upload_license(cur_private_ip, instance_id)
+        attribute_dict = {
+            "sn_inventory_refreshed_at": time.time()
+        }
+        if sn_inventory:
+            attribute_dict["sn_inventory"] = sn_inventory
+        self.dydb.put_items_to_dydb("fortiflex", attribute_dict)
         return True
 
-    def get_sn_by_configid(self, configid):
-        self.logger.info("Get serial numbers by config id.")
+    def get_sn_inventory(self, configid_list):
+        # Return {sn: {"config_id", "status", "token_status", "stopped"}} of serial numbers usable by the ASG,
+        # None if serial numbers of any config ID could not be listed
+        self.logger.info(f"Get serial numbers by config IDs {configid_list}.")
         oauth_token = self.get_fortiflex_oauth_token()
         if not oauth_token:
             self.logger.info(f"Could not get valid OAuth token.")
-            return []
-        sn_list = []
+            return None
+        entitlements_dict = Helper.run_concurrently(
+            self.logger,
+            lambda configid: self.list_entitlements(configid, oauth_token),
+            {configid: configid for configid in configid_list},
+            self.fanout_concurrency
+        )
+        failed_configid_list = [configid for configid in configid_list if entitlements_dict.get(configid) is None]
+        if failed_configid_list:
+            self.logger.error(f"Could not list serial numbers of config IDs {failed_configid_list}.")
+            return None
+        sn_inventory = {}
+        for configid in configid_list:
+            for ele in entitlements_dict[configid]:
+                if ele["status"] not in {"ACTIVE", "STOPPED", "PENDING"}:
+                    continue
+                if ele["status"] == "ACTIVE" and ele["tokenStatus"] != "NOTUSED":
+                    continue
+                sn_inventory[ele["serialNumber"]] = {
+                    "config_id": configid,
+                    "status": ele["status"],
+                    "token_status": ele["tokenStatus"],
+                    "stopped": ele["status"] != "ACTIVE"
+                }
+        # Active serial numbers that have not been used are stopped until an instance needs them,
+        # serial numbers claimed by instances or waiting in the token pool are active on purpose
+        fortiflex_record = self.dydb.get_record("fortiflex")
+        active_sn_set = set((fortiflex_record.get("used_sn_map") or {}).values()) | set(fortiflex_record.get("token_pool") or {})
+        stop_sn_list = [sn for sn, sn_info in sn_inventory.items() if not sn_info["stopped"] and sn not in active_sn_set]
+        stop_rst = Helper.run_concurrently(
+            self.logger,
+            lambda sn: self.stop_sn(sn, oauth_token),
+            {sn: sn for sn in stop_sn_list},
+            self.fanout_concurrency
+        )
+        for sn in stop_sn_list:
+            sn_inventory[sn]["stopped"] = bool(stop_rst.get(sn))
+        self.logger.info(f"Serial number inventory: {sn_inventory}")
+        return sn_inventory
+
+    def list_entitlements(self, configid, oauth_token):
+        # Return None if the list could not be got, an empty list means the config ID has no serial number
+        entitlement_list = None
         url = "https://support.fortinet.com/ES/api/fortiflex/v2/entitlements/list"
         header = {
             "Content-Type": "application/json",
@@ -1307,7 +2975,7 @@ class FgtConf:
         body = {
             "configId": configid
         }
-        response = requests.post(url, headers=header, json=body, verify=False, timeout=10)
+        response = self.runtime.http_session.post(url, headers=header, json=body, verify=False, timeout=10)
         if response.status_code == 200:
             response_json = response.json()
             if response_json:
@@ -1315,18 +2983,105 @@ class FgtConf:
                     if "error" in response_json and not response_json["error"]:
                         err_msg = response_json["error"]
                         self.logger.error(f"Could not get sefial numbers by config id {configid}, error msg: {err_msg}")
+                    response.close()
                     return []
-                for ele in response_json["entitlements"]:
-                    cur_sn = ele["serialNumber"]
-                    if ele["status"] in {"ACTIVE"} and ele["tokenStatus"] == "NOTUSED":
-                        sn_list.append(cur_sn)
-                        self.stop_sn(cur_sn, oauth_token)
-                    elif ele["status"] in {"STOPPED", "PENDING"}:
-                        sn_list.append(cur_sn)
+                entitlement_list = response_json["entitlements"]
             else:
                 self.logger.info("Could not get http return status")
         response.close()
-        return sn_list
+        return entitlement_list
+
+   # FortiFlex VM token pool
+    def claim_pool_token(self, fgt_vm_id):
+        # Move one prepared VM token to the instance by one conditional write, return (vm_token, sn)
+        token_pool = self.get_item_from_dydb("fortiflex", ["token_pool"]).get("token_pool") or {}
+        # Entries reserved by a running refill have no VM token yet
+        for sn in [sn for sn, pool_entry in token_pool.items() if pool_entry.get("vm_token")]:
+            pool_entry = self.dydb.claim_sn(sn, fgt_vm_id, from_pool=True)
+            if pool_entry and pool_entry.get("vm_token"):
+                self.logger.info(f"Claimed VM token of serial number {sn} from token pool.")
+                return pool_entry["vm_token"], sn
+            if pool_entry:
+                self.release_active_sn(fgt_vm_id, sn)
+        self.logger.info("Token pool is empty.")
+        return "", ""
+
+    def trigger_token_pool_refill(self):
+        # Refill runs in another invocation of this function, the launch does not wait for FortiFlex
+        payload = {
+            "operation": "refill_token_pool"
+        }
+        b_succ, rst = Helper.invoke_lambda(self.logger, self.lambda_client, os.getenv("AWS_LAMBDA_FUNCTION_NAME"), payload, "Event")
+        return b_succ
+
+    def refill_token_pool(self):
+        self.logger.info(f"Refill token pool to {self.token_pool_size} VM tokens.")
+        # One refill at a time, others skip since the holder fills the pool for them
+        refill_lock = DydbLock(self.logger, self.dydb, "token_pool", lease_seconds=120, timeout=1)
+        if not refill_lock.acquire():
+            self.logger.info("Token pool is being refilled by others.")
+            return True
+        try:
+            dydb_items = self.dydb.get_record("fortiflex")
+            token_pool = dydb_items.get("token_pool") or {}
+            # Entries without VM token older than the lease were reserved by a refill that did not finish
+            stale_sn_list = [
+                sn for sn, pool_entry in token_pool.items()
+                if not pool_entry.get("vm_token") and time.time() - float(pool_entry.get("reserved_at") or 0) > refill_lock.lease_seconds
+            ]
+            missing_count = self.token_pool_size - len(token_pool) + len(stale_sn_list)
+            if missing_count <= 0:
+                return True
+            available_sn_list = [sn for sn in dydb_items.get("available_sn_list") or [] if sn not in token_pool]
+            if not available_sn_list and not stale_sn_list:
+                self.logger.info("No available serial number for token pool.")
+                return False
+            oauth_token = self.get_fortiflex_oauth_token()
+            if not oauth_token:
+                self.logger.info(f"Could not get valid OAuth token.")
+                return False
+            for sn in stale_sn_list:
+                self.release_pool_sn(sn, oauth_token, b_reactivated=True)
+            # Serial numbers are moved out of available_sn_list one by one, one that was claimed meanwhile is skipped
+            reserved_sn_list = []
+            for sn in available_sn_list:
+                if len(reserved_sn_list) >= missing_count:
+                    break
+                if self.dydb.update_pool_sn(sn, "reserve"):
+                    reserved_sn_list.append(sn)
+            rst = Helper.run_concurrently(
+                self.logger,
+                lambda sn: self.prepare_pool_token(sn, oauth_token),
+                {sn: sn for sn in reserved_sn_list},
+                self.fanout_concurrency
+            )
+            return all(rst.get(sn) for sn in reserved_sn_list)
+        finally:
+            refill_lock.release()
+
+    def prepare_pool_token(self, sn, oauth_token):
+        if not self.reactivate_sn(sn, oauth_token):
+            self.release_pool_sn(sn, oauth_token)
+            return False
+        vm_token = self.generate_vm_token(sn, oauth_token)
+        if not vm_token:
+            self.release_pool_sn(sn, oauth_token, b_reactivated=True)
+            return False
+        pool_entry = {
+            "vm_token": vm_token,
+            "created_at": time.time()
+        }
+        if not self.dydb.update_pool_sn(sn, "fill", pool_entry):
+            # Serial number has been dropped from the inventory meanwhile
+            self.stop_sn(sn, oauth_token)
+            return False
+        return True
+
+    def release_pool_sn(self, sn, oauth_token, b_reactivated=False):
+        # Stop first, the serial number can be claimed by others once it is back in available_sn_list
+        if b_reactivated:
+            self.stop_sn(sn, oauth_token)
+        return self.dydb.update_pool_sn(sn, "release")
 
     def get_next_available_sn(self):
         self.logger.info("Get next available serial number.")
@@ -1355,256 +3110,63 @@ class FgtConf:
         used_sn_map = dydb_items.get("used_sn_map", {})
         return used_sn_map
 
-    def update_used_sn_map(self, sn_map):
-        self.logger.info(f"Update used serial number {sn_map} on Dynamo DB.")
-        b_succ = self.put_item_to_dydb("fortiflex", "used_sn_map", sn_map)
-        return b_succ
-
    # Tag related
     def update_tags(self, resource_list, tag_list):
         b_succ= False
         if not resource_list or not tag_list:
             return b_succ
         try:
-            response = self.ec2_client.create_tags(
-                Resources=resource_list,
-                Tags=tag_list
-            )
-            b_succ = True
-        except Exception as err:
-            self.logger.error(f"Could not update item tags for {resource_list}, error: {err}")
-        return b_succ
-
-   # Set scale-in protection
-    def set_primary_scalein_protection(self, fgt_vm_id):
-        self.logger.info("Set primary instance scale in protection.")
-        asg_client = boto3.client("autoscaling")
-        b_succ= False
-        if not fgt_vm_id:
-            return b_succ
-        try:
-            response = asg_client.set_instance_protection(
-                InstanceIds=[fgt_vm_id],
-                AutoScalingGroupName=self.asg_name,
-                ProtectedFromScaleIn=True
-            )
-            b_succ = True
-        except Exception as err:
-            self.logger.error(f"Could not set scale-in protection for {fgt_vm_id}, error: {err}")
-        return b_succ
-
-  # AWS Dynamo DB operations
-    def get_item_from_dydb(self, category, attributes):
-        rst = {}
-        try:
-            if self.enable_privatelink_dydb:
-                payload = {
-                    "service" : "dynamodb",
-                    "operation" : "get_item",
-                    "parameters" : {
-                        "category" : category,
-                        "attributes": attributes
-                    }
-                }
-                b_succ, rst = self.invoke_lambda(payload, "fgt")
-            else:
-                response = self.dynamodb_client.get_item(
-                    TableName=self.dynamodb_table_name,
-                    Key={
-                        'Category': {
-                            'S': category,
-                        }
-                    },
-                    AttributesToGet=attributes)
-                resp_content = response.get("Item")
-                for attr_name in attributes:
-                    if attr_name in resp_content:
-                        rst[attr_name] = self.convert_aws_dydb_to_normal_format(resp_content[attr_name])                
-        except Exception as err:
-            self.logger.error(f"Could not get item from Dynamo DB table: {err}")
-        return rst
-
-    def put_item_to_dydb(self, category, attribute_name, attribute_content):
-        b_succ= False
-        try:
-            if self.enable_privatelink_dydb:
-                payload = {
-                    "service" : "dynamodb",
-                    "operation" : "put_item",
-                    "parameters" : {
-                        "category" : category,
-                        "attribute_name": attribute_name,
-                        "attribute_content": attribute_content
-                    }
-                }
-                b_succ, rst = self.invoke_lambda(payload, "fgt", "Event")
-            else:
-                aws_format_content = self.convert_to_aws_dydb_format(attribute_content)
-                if not aws_format_content:
-                    self.logger.info(f"Attribute content is empty: {attribute_content}")
-                    return self.remove_item_from_dydb(category, attribute_name, attribute_content)
-                response = self.dynamodb_client.update_item(
-                    TableName=self.dynamodb_table_name,
-                    Key={
-                        'Category': {
-                            'S': category,
-                        }
-                    },
-                    AttributeUpdates={
-                        attribute_name: {
-                            'Value': aws_format_content
-                        }
-                    })
-                b_succ = True
-        except Exception as err:
-            self.logger.error(f"Could not update item in Dynamo DB table: {err}")
-        return b_succ
-
-    def add_item_to_dydb(self, category, attribute_name, attribute_content):
-        b_succ= False
-        try:
-            if self.enable_privatelink_dydb:
-                payload = {
-                    "service" : "dynamodb",
-                    "operation" : "add_item",
-                    "parameters" : {
-                        "category" : category,
-                        "attribute_name": attribute_name,
-                        "attribute_content": attribute_content
-                    }
-                }
-                b_succ, rst = self.invoke_lambda(payload, "fgt", "Event")
-            else:
-                if type(attribute_content) not in [set, int, float]:
-                    self.logger.error(f"Could not do the ADD operation for attribute type: {type(attribute_content)}")
-                    return False
-                aws_format_content = self.convert_to_aws_dydb_format(attribute_content)
-                if not aws_format_content:
-                    self.logger.info(f"Attribute content is empty: {attribute_content}")
-                    return False
-                response = self.dynamodb_client.update_item(
-                    TableName=self.dynamodb_table_name,
-                    Key={
-                        'Category': {
-                            'S': category,
-                        }
-                    },
-                    AttributeUpdates={
-                        attribute_name: {
-                            'Value': aws_format_content,
-                            'Action': 'ADD'
-                        }
-                    })
-                b_succ = True
+            response = self.ec2_client.create_tags(
+                Resources=resource_list,
+                Tags=tag_list
+            )
+            b_succ = True
         except Exception as err:
-            self.logger.error(f"Could not add item in Dynamo DB table: {err}")
+            self.logger.error(f"Could not update item tags for {resource_list}, error: {err}")
         return b_succ
 
-    def remove_item_from_dydb(self, category, attribute_name, attribute_content):
+   # Set scale-in protection
+    def set_primary_scalein_protection(self, fgt_vm_id):
+        self.logger.info("Set primary instance scale in protection.")
+        asg_client = self.runtime.client("autoscaling")
         b_succ= False
+        if not fgt_vm_id:
+            return b_succ
         try:
-            if self.enable_privatelink_dydb:
-                payload = {
-                    "service" : "dynamodb",
-                    "operation" : "remove_item",
-                    "parameters" : {
-                        "category" : category,
-                        "attribute_name": attribute_name,
-                        "attribute_content": attribute_content
-                    }
-                }
-                b_succ, rst = self.invoke_lambda(payload, "fgt", "Event")
-            else:
-                aws_format_content = self.convert_to_aws_dydb_format(attribute_content)
-                if not aws_format_content:
-                    self.logger.info(f"Attribute content is empty: {attribute_content}")
-                    return False
-                attribute_value = {
-                    'Action': 'DELETE'
-                }
-                if aws_format_content:
-                    attribute_value["Value"] = aws_format_content
-                response = self.dynamodb_client.update_item(
-                    TableName=self.dynamodb_table_name,
-                    Key={
-                        'Category': {
-                            'S': category,
-                        }
-                    },
-                    AttributeUpdates={
-                        attribute_name: attribute_value
-                    }
-                )
-                b_succ = True
+            response = asg_client.set_instance_protection(
+                InstanceIds=[fgt_vm_id],
+                AutoScalingGroupName=self.asg_name,
+                ProtectedFromScaleIn=True
+            )
+            b_succ = True
         except Exception as err:
-            self.logger.error(f"Could not remove item in Dynamo DB table: {err}")
+            self.logger.error(f"Could not set scale-in protection for {fgt_vm_id}, error: {err}")
         return b_succ
 
-    def convert_to_aws_dydb_format(self, input_value):
-        rst = {}
-        if input_value == None:
-            return rst
-        aws_datatype = ""
-        content = input_value
-        input_type = type(input_value)
-        if input_type is str:
-            aws_datatype = "S"
-        elif input_type is int or input_type is float:
-            aws_datatype = "N"
-            content = str(input_value)
-        elif input_type is bool:
-            aws_datatype = "BOOL"
-        elif input_type is set:
-            if not input_value:
-                return rst
-            for ele in input_value:
-                ele_type = type(ele)
-                break
-            if ele_type is str:
-                aws_datatype = "SS"
-                content = list(input_value)
-            elif ele_type is int or ele_type is float:
-                aws_datatype = "NS"
-                content = [str(e) for e in input_value]
-        elif input_type is list:
-            if not input_value:
-                return {
-                    "L": []
-                }
-            aws_datatype = "L"
-            content = [self.convert_to_aws_dydb_format(e) for e in input_value]
-        elif input_type is dict:
-            if not input_value:
-                return {
-                    "M": {}
-                }
-            aws_datatype = "M"
-            content = {}
-            for k, v in input_value.items():
-                content[k] = self.convert_to_aws_dydb_format(v)
+  # AWS Dynamo DB operations
+    def get_item_from_dydb(self, category, attributes):
+        return self.dydb.get_item_from_dydb(category, attributes)
 
-        rst = {
-            aws_datatype: content
-        }
-        return rst
+    def put_item_to_dydb(self, category, attribute_name, attribute_content):
+        return self.dydb.put_item_to_dydb(category, attribute_name, attribute_content)
 
-    def convert_aws_dydb_to_normal_format(self, input_dict):
-        if not input_dict:
-            return input_dict
-        rst = None
-        for v_type, v_content in input_dict.items():
-            if v_type == "M":
-                rst = {}
-                for k, v in v_content.items():
-                    rst[k] = self.convert_aws_dydb_to_normal_format(v)
-            elif v_type == "L":
-                rst = [self.convert_aws_dydb_to_normal_format(e) for e in v_content]
-            elif v_type == "NULL" and v_content:
-                rst = None
-            else:
-                rst = v_content
-            break
-        return rst
+    def add_item_to_dydb(self, category, attribute_name, attribute_content):
+        return self.dydb.add_item_to_dydb(category, attribute_name, attribute_content)
+
+    def remove_item_from_dydb(self, category, attribute_name, attribute_content):
+        return self.dydb.remove_item_from_dydb(category, attribute_name, attribute_content)
+
+    def get_prefetch_items(self, detail_type):
+        # Every Dynamo DB attribute that one launch or terminate event reads
+        prefetch_items = {
+            "asg_instances": ["instance_list"],
+            "primary_instance": ["primary_instance_id", "primary_ip"]
+        }
+        if self.need_license and self.fgt_lic_mgmt != "fmg":
+            prefetch_items["fortiflex"] = ["oauth_token", "oauth_expires_at", "oauth_refresh_token", "available_sn_list", "all_sn_list", "used_sn_map", "sn_inventory_refreshed_at", "token_pool"]
+        if detail_type == "EC2 Instance Launch Successful":
+            prefetch_items["user_config"] = ["version"]
+        return prefetch_items
 
 # FortiGate instances infomation of ASG
     def get_asg_instance_list_dydb(self):
@@ -1636,11 +3198,14 @@ class FgtConf:
         return b_succ
 
     def remove_asg_instance_dydb(self, instance_id):
-        self.logger.info("Remove instance ID from Dynamo DB table.")
-        cur_list = self.get_asg_instance_list_dydb()
-        for instance_dict in cur_list:
-            if instance_id in instance_dict.values():
-                cur_list.remove(instance_dict)
+        return self.remove_asg_instances_dydb([instance_id])
+
+    def remove_asg_instances_dydb(self, instance_id_list):
+        self.logger.info(f"Remove instance IDs {instance_id_list} from Dynamo DB table.")
+        cur_list = [
+            instance_dict for instance_dict in self.get_asg_instance_list_dydb()
+            if not set(instance_dict.values()) & set(instance_id_list)
+        ]
         b_succ= False
         try:
             b_succ = self.put_item_to_dydb("asg_instances", "instance_list", cur_list)
@@ -1650,18 +3215,52 @@ class FgtConf:
 
     def get_instance_dict(self, state_name_list):
         self.logger.info(f"Get instance ID list with state of {state_name_list}.")
-        instance_detail = self.ec2_client.describe_instances(Filters=[
-                                {
-                                    'Name': 'instance-state-name',
-                                    'Values': state_name_list
-                                }
-                            ])
-        running_instance_dict = {}
-        for reservation in instance_detail['Reservations']:
-            for instance in reservation['Instances']:
-                cur_vm_id = instance.get('InstanceId')
-                running_instance_dict[cur_vm_id] = instance
-        return running_instance_dict
+        return self.instance_snapshot.get_instance_dict(state_name_list)
+
+# Reconciliation of resources left by terminated instances
+    def get_resource_owner_set(self):
+        # Instance IDs that still own an ASG record, a configuration digest, a license or a serial number
+        owner_id_set = set()
+        for instance_dict in self.get_asg_instance_list_dydb():
+            owner_id_set.update(instance_dict.values())
+        for record in self.dydb.list_records(self.config_digest_prefix):
+            if record.get("instance_id"):
+                owner_id_set.add(record["instance_id"])
+        if self.need_license and self.fgt_lic_mgmt != "fmg":
+            owner_id_set.update(self.get_used_sn_map().keys())
+            # Read only, reconciliation does not hold the license track file lock
+            lic_track_dict = self.get_lic_track_dict(refresh=False)
+            if lic_track_dict:
+                for lic_type in ["token", "file"]:
+                    owner_id_set.update(lic_track_dict.get(lic_type, {}).get("used", {}).keys())
+        return owner_id_set
+
+    def release_orphans(self, orphan_id_list, max_workers):
+        self.logger.info(f"Release licenses and records of orphaned instances: {orphan_id_list}")
+        primary_instance_id, primary_ip = self.get_primary()
+        if self.need_license and self.fgt_lic_mgmt != "fmg":
+            self.release_lics(orphan_id_list)
+            used_sn_map = self.get_used_sn_map()
+            orphan_sn_dict = {vm_id: used_sn_map[vm_id] for vm_id in orphan_id_list if vm_id in used_sn_map}
+            if orphan_sn_dict:
+                # Deactive the tokens concurrently, before the serial numbers can be claimed by new instances
+                oauth_token = self.get_fortiflex_oauth_token()
+                if oauth_token:
+                    Helper.run_concurrently(
+                        self.logger,
+                        lambda sn: self.stop_sn(sn, oauth_token),
+                        {sn: sn for sn in orphan_sn_dict.values()},
+                        max_workers
+                    )
+                # Releases update the batch cache, one at a time
+                for vm_id, sn in orphan_sn_dict.items():
+                    self.dydb.release_sn(vm_id, sn)
+        self.remove_asg_instances_dydb(orphan_id_list)
+        for vm_id in orphan_id_list:
+            self.dydb.delete_record(self.config_digest_prefix + vm_id)
+        # Elect a new primary once, only when the primary instance is gone
+        if self.enable_fgt_system_autoscale and primary_instance_id in orphan_id_list:
+            self.check_primary(primary_instance_id)
     
 # FortiGate auto-scaling primary ip
     def get_primary(self):
@@ -1677,12 +3276,36 @@ class FgtConf:
             self.logger.error(f"Could not get primary instance information: {err}")
         return primary_instance_id, primary_ip
 
+    def wait_ops(self, max_wait_seconds=20):
+        # Confirm asynchronous operations fired by this invocation instead of assuming them successful
+        if not self.dydb.pending_ops:
+            return True
+        deadline = time.time() + max_wait_seconds
+        if self.deadline:
+            deadline = min(deadline, self.deadline - 5)
+        b_succ = True
+        for op_id, op_status in self.dydb.wait_ops(deadline=deadline, max_workers=self.fanout_concurrency).items():
+            if op_status["state"] != "pending":
+                # Staged objects of operations that are still pending are left to the bucket lifecycle rule
+                self.delete_staged_objects(self.staged_ops.pop(op_id, []))
+            if op_status["state"] == "succeeded":
+                continue
+            b_succ = False
+            if op_status["state"] == "failed":
+                self.logger.error(f"Asynchronous operation {op_status['operation']} {op_id} failed: {op_status['error']}")
+            else:
+                self.logger.warning(f"Asynchronous operation {op_status['operation']} {op_id} is not confirmed before deadline.")
+        return b_succ
+
     def update_primary(self, instance_id, primary_ip):
         self.logger.info("Update primary instance infomation.")
         b_succ= False
         try:
-            b_succ = self.put_item_to_dydb("primary_instance", "primary_instance_id", instance_id)
-            b_succ = self.put_item_to_dydb("primary_instance", "primary_ip", primary_ip)
+            attribute_dict = {
+                "primary_instance_id": instance_id,
+                "primary_ip": primary_ip
+            }
+            b_succ = self.dydb.put_items_to_dydb("primary_instance", attribute_dict, flush=True)
         except Exception as err:
             self.logger.error(f"Could not update primary instance information: {err}")
         return b_succ
@@ -1692,9 +3315,6 @@ class FgtConf:
         # FortiGate instance auto-scaling configuration
         primary_instance_id, primary_ip = self.get_primary()
         if not primary_instance_id or primary_instance_id == fgt_vm_id:
-            fgt_port = ""
-            if self.fgt_login_port_number:
-                fgt_port = ":" + self.fgt_login_port_number
             # Get next primary instance
             state_name_list = ["running"]
             running_instance_dict = self.get_instance_dict(state_name_list)
@@ -1703,60 +3323,30 @@ class FgtConf:
             fgt_instanceid_list = []
             for instance_dict in fgt_instanceid_list_dict:
                 fgt_instanceid_list.extend(instance_dict.values())
+            candidate_ip_dict = {}
             for cur_vm_id in fgt_instanceid_list:
-                if cur_vm_id not in running_instance_dict:
+                if cur_vm_id not in running_instance_dict or cur_vm_id == fgt_vm_id:
+                    continue
+                cur_private_ip = self.get_private_ip(running_instance_dict[cur_vm_id])
+                if not cur_private_ip:
+                    self.logger.info(f"Can not find private IP for instance: {cur_vm_id}")
+                    continue
+                candidate_ip_dict[cur_vm_id] = cur_private_ip
+
+            # Probe all candidates at once, the new primary is chosen from the healthy ones in ASG instance list order
+            health_dict = Helper.run_concurrently(self.logger, self.check_health, candidate_ip_dict, self.fanout_concurrency)
+            new_primary_id = ""
+            for cur_vm_id in candidate_ip_dict:
+                if not health_dict.get(cur_vm_id):
+                    self.logger.info(f"FortiGate {cur_vm_id} is not healthy, skip it as primary.")
                     continue
                 instance = running_instance_dict[cur_vm_id]
-                fgt_vm_id = cur_vm_id
                 self.fgt_primary_ip, self.fgt_primary_port = self.get_primary_ip(instance)
-                fgt_private_ip = self.get_private_ip(instance)
-                if not fgt_private_ip:
-                    self.logger.info(f"Can not find private IP for instance: {fgt_vm_id}")
-                    continue
-                # Update FortiGate instance configuration
-                temp_str = ""
-                if self.fmg_integration:
-                    if self.fmg_integration.get("primary_only", False):
-                        temp_str += """
-                        config system vdom-exception
-                            edit 0
-                                set object system.central-management
-                            next
-                        end
-                        """
-                    fmg_ip = self.fmg_integration.get("ip", "")
-                    fmg_sn = self.fmg_integration.get("sn", "")
-                    fmg_vrf_select = self.fmg_integration.get("vrf_select", "")
-                    if fmg_ip and fmg_sn:
-                        temp_str += f"""
-                        config system central-management
-                            set type fortimanager
-                            set fmg {fmg_ip}
-                            set serial-number {fmg_sn}
-                        """
-                        if fmg_vrf_select:
-                            temp_str += f"set vrf-select {fmg_vrf_select}\n"
-                        temp_str += "end\n"
-                temp_str += f"""
-                config system auto-scale
-                    set status enable
-                    set sync-interface "{self.fgt_primary_port}"
-                    set role primary
-                    set psksecret "{self.fgt_system_autoscale_psksecret}"
-                end
-                """
-                if self.health_check_port != 0 and self.health_check_protocol == "HTTP":
-                    temp_str += f"""
-                    config system probe-response
-                        set mode http-probe
-                        set port "{self.health_check_port}"
-                    end
-                """
-                config_content = re.sub(r"([\n ])\1*", r"\1", temp_str)
-                b_succ = self.upload_config(config_content, fgt_private_ip)
+                b_succ = self.push_config_sections(cur_vm_id, candidate_ip_dict[cur_vm_id], self.gen_primary_autoscale_config())
                 if b_succ:
+                    new_primary_id = cur_vm_id
                     self.update_tags(
-                        [fgt_vm_id], 
+                        [cur_vm_id], 
                         [{
                             'Key': 'Autoscale Role',
                             'Value': 'Primary'
@@ -1764,39 +3354,32 @@ class FgtConf:
                     )
                     break
                 else:
-                    self.logger.error(f"Could not http connect to FortiGate {fgt_private_ip}")
-                    continue
+                    self.logger.error(f"Could not set FortiGate {cur_vm_id} as primary.")
 
             # Update primary track Dynamo DB
             if b_succ:
-                self.update_primary(fgt_vm_id, self.fgt_primary_ip)
+                self.update_primary(new_primary_id, self.fgt_primary_ip)
                 if self.primary_scalein_protection:
-                    self.set_primary_scalein_protection(fgt_vm_id)
+                    self.set_primary_scalein_protection(new_primary_id)
             else:
                 self.update_primary("", "")
+                return
 
-            # Update secondary FortiGate instance configuration
+            # Update secondary FortiGate instance configuration concurrently, unhealthy candidates would only time out
+            secondary_ip_dict = {
+                cur_vm_id: cur_private_ip for cur_vm_id, cur_private_ip in candidate_ip_dict.items()
+                if cur_vm_id != new_primary_id and health_dict.get(cur_vm_id)
+            }
+            sections = self.gen_secondary_autoscale_config(self.fgt_primary_ip)
+            result_dict = Helper.run_concurrently(
+                self.logger,
+                lambda cur_vm_id: self.push_config_sections(cur_vm_id, secondary_ip_dict[cur_vm_id], sections),
+                {cur_vm_id: cur_vm_id for cur_vm_id in secondary_ip_dict},
+                self.fanout_concurrency
+            )
             secondary_resource_list = []
-            for cur_vm_id, instance in running_instance_dict.items():
-                if cur_vm_id not in fgt_instanceid_list or cur_vm_id == fgt_vm_id:
-                    continue
-                cur_private_ip = self.get_private_ip(instance)
-                if not cur_private_ip:
-                    self.logger.info(f"Can not find private IP for instance: {fgt_vm_id}")
-                    continue
-                # Update FortiGate instance configuration
-                temp_str = f"""
-                config system auto-scale
-                    set status enable
-                    set sync-interface "{self.fgt_primary_port}"
-                    set role secondary
-                    set primary-ip {self.fgt_primary_ip}
-                    set psksecret "{self.fgt_system_autoscale_psksecret}"
-                end
-                """
-                config_content = re.sub(r"([\n ])\1*", r"\1", temp_str)
-                b_succ = self.upload_config(config_content, cur_private_ip)
-                if b_succ:
+            for cur_vm_id in secondary_ip_dict:
+                if result_dict.get(cur_vm_id):
                     secondary_resource_list.append(cur_vm_id)
                 else:
                     self.logger.error(f"Could not update system auto-scale for FortiGate {cur_vm_id}")
@@ -1809,17 +3392,117 @@ class FgtConf:
                 }]
             )
 
+    def broadcast_config(self, config_content, instance_id_list=None):
+        # Push one configuration to the running instances of the ASG by one internal Lambda function call
+        self.logger.info("Broadcast configuration to FortiGate instances.")
+        running_instance_dict = self.get_instance_dict(["running"])
+        target_ip_dict = {}
+        for instance_dict in self.get_asg_instance_list_dydb():
+            for cur_vm_id in instance_dict.values():
+                if instance_id_list and cur_vm_id not in instance_id_list:
+                    continue
+                if cur_vm_id not in running_instance_dict:
+                    continue
+                cur_private_ip = self.get_private_ip(running_instance_dict[cur_vm_id])
+                if not cur_private_ip:
+                    self.logger.info(f"Can not find private IP for instance: {cur_vm_id}")
+                    continue
+                target_ip_dict[cur_vm_id] = cur_private_ip
+        rst = {}
+        if not target_ip_dict:
+            self.logger.info("No FortiGate instance to broadcast configuration to.")
+            return rst
+        payload = {
+            "service" : "fgt_vm",
+            "operation" : "broadcast_config",
+            "parameters" : {
+                "private_ip_list": list(target_ip_dict.values()),
+                "config_content": config_content,
+                "max_workers": self.fanout_concurrency
+            }
+        }
+        b_succ, response = self.invoke_lambda(payload, "fgt")
+        for cur_vm_id, cur_private_ip in target_ip_dict.items():
+            result = (response or {}).get(cur_private_ip) if b_succ else None
+            if not result:
+                result = {
+                    "success": False,
+                    "duration": None,
+                    "error": "No result from internal Lambda function."
+                }
+            self.logger.info(f"Broadcast to {cur_vm_id}, success: {result['success']}, duration: {result['duration']} sec, error: {result['error']}")
+            rst[cur_vm_id] = result
+        return rst
+
+    def check_health(self, fgt_private_ip):
+        payload = {
+            "service" : "fgt_vm",
+            "operation" : "check_health",
+            "parameters" : {
+                "private_ip" : fgt_private_ip
+            }
+        }
+        b_succ, response = self.invoke_lambda(payload, "fgt")
+        return b_succ
+
+    def gen_fmg_config(self, primary):
+        rst = ""
+        if self.fmg_integration:
+            primary_only = self.fmg_integration.get("primary_only", False)
+            if primary_only and not primary:
+                return rst
+            if primary_only:
+                rst += CliTemplate.render("fmg_vdom_exception")
+            fmg_ip = self.fmg_integration.get("ip", "")
+            fmg_sn = self.fmg_integration.get("sn", "")
+            fmg_vrf_select = self.fmg_integration.get("vrf_select", "")
+            if fmg_ip and fmg_sn:
+                rst += CliTemplate.render("fmg_central_management", fmg_ip=fmg_ip, fmg_sn=fmg_sn)
+                if fmg_vrf_select:
+                    rst += CliTemplate.render("fmg_vrf_select", fmg_vrf_select=fmg_vrf_select)
+                rst += CliTemplate.render("fmg_end")
+        return rst
+
+    def gen_primary_autoscale_config(self):
+        rst = CliTemplate.render(
+            "autoscale_primary",
+            sync_interface=self.fgt_primary_port,
+            psksecret=self.fgt_system_autoscale_psksecret
+        )
+        if self.health_check_port != 0 and self.health_check_protocol == "HTTP":
+            rst += CliTemplate.render("probe_response", health_check_port=self.health_check_port)
+        return {
+            "fmg": self.gen_fmg_config(primary=True),
+            "autoscale": rst
+        }
+
+    def gen_secondary_autoscale_config(self, primary_ip, with_fmg=False):
+        sections = {}
+        if with_fmg:
+            sections["fmg"] = self.gen_fmg_config(primary=False)
+        sections["autoscale"] = CliTemplate.render(
+            "autoscale_secondary",
+            sync_interface=self.fgt_primary_port,
+            primary_ip=primary_ip,
+            psksecret=self.fgt_system_autoscale_psksecret
+        )
+        return sections
+
 # FortiGate configuration
     def gen_config_content(self, fgt_vm_id):
-        gwlb_ips = json.loads(os.getenv('gwlb_ips'))
+        return "".join(self.gen_config_sections(fgt_vm_id).values())
+
+    def gen_config_sections(self, fgt_vm_id):
+        # Configuration script split into sections, each section is tracked by its own digest
+        gwlb_ips = self.runtime.gwlb_ips
         user_conf = self.get_user_config_from_dydb()
-        user_conf_s3 = json.loads(os.getenv('user_conf_s3'))
+        user_conf_s3 = self.runtime.user_conf_s3
         fgt_multi_vdom = os.getenv('fgt_multi_vdom') == 'true'
         create_geneve_for_all_az = os.getenv('create_geneve_for_all_az') == 'true'
-        az_name_map = json.loads(os.getenv('az_name_map'))
-        rst = ""
+        sections = {}
 
         # unset auth-lockout-duration 
+        rst = ""
         if fgt_multi_vdom:
             rst += "config global\n"
         rst += "config user setting\n"
@@ -1827,7 +3510,9 @@ class FgtConf:
         rst += "end\n"
         if fgt_multi_vdom:
             rst += "end\n"
+        sections["base"] = rst
         # Geneve tunnel
+        rst = ""
         for intf_name, intf_conf in self.intf_setting.items():
             vdom = intf_conf.get("vdom", "root")
             if fgt_multi_vdom:
@@ -1835,44 +3520,19 @@ class FgtConf:
             
             if intf_conf.get("to_gwlb") and gwlb_ips:
                 az_list = intf_conf["subnet_id_map"].keys() if create_geneve_for_all_az else [self.fgt_az]
-                intf_device_index = intf_conf.get("device_index")
+                geneve_blocks = self.get_geneve_blocks(intf_name, intf_conf)
                 for az_name in az_list:
-                    subnet_id = intf_conf["subnet_id_map"].get(az_name)
-                    if not subnet_id:
-                        self.logger.error(f"Could not get the Subnet ID of AZ: {az_name}")
-                        if fgt_multi_vdom:
-                            rst += f"end\n"
-                        continue
-                    gwlb_ip = gwlb_ips.get(subnet_id)
-                    if not gwlb_ip:
-                        self.logger.error(f"Could not get the GWLB ip for subnet: {subnet_id}")
+                    geneve_block, err_msg = geneve_blocks.get(az_name, (None, f"Could not get the Subnet ID of AZ: {az_name}"))
+                    if err_msg:
+                        self.logger.error(err_msg)
                         if fgt_multi_vdom:
                             rst += f"end\n"
                         continue
-                    
-                    geneve_name = az_name
-                    if az_name in az_name_map:
-                        geneve_name = az_name_map[az_name]
-                    temp_str = f"""
-                    config system geneve
-                        edit {geneve_name}
-                            set interface port{intf_device_index + 1}
-                            set type ppp
-                            set remote-ip {gwlb_ip}
-                        next
-                    end
-                    config router static
-                        edit 0
-                            set dst {gwlb_ip}/32
-                            set device port{intf_device_index + 1}
-                            set dynamic-gateway enable
-                        next
-                    end
-                    """
-                    rst += re.sub(r"([\n ])\1*", r"\1", temp_str)
+                    rst += geneve_block
 
                 if fgt_multi_vdom:
                     rst += f"end\n"
+        sections["geneve"] = rst
 
         # FortiGate instance auto-scaling configuration
         if self.enable_fgt_system_autoscale:
@@ -1885,71 +3545,10 @@ class FgtConf:
                     self.set_primary_scalein_protection(fgt_vm_id)
             autoscale_role = "Primary"
             if primary_instance_id == fgt_vm_id:
-                temp_str = ""
-                if self.fmg_integration:
-                    if self.fmg_integration.get("primary_only", False):
-                        temp_str += """
-                        config system vdom-exception
-                            edit 0
-                                set object system.central-management
-                            next
-                        end
-                        """
-                    fmg_ip = self.fmg_integration.get("ip", "")
-                    fmg_sn = self.fmg_integration.get("sn", "")
-                    fmg_vrf_select = self.fmg_integration.get("vrf_select", "")
-                    if fmg_ip and fmg_sn:
-                        temp_str += f"""
-                        config system central-management
-                            set type fortimanager
-                            set fmg {fmg_ip}
-                            set serial-number {fmg_sn}
-                        """
-                        if fmg_vrf_select:
-                            temp_str += f"set vrf-select {fmg_vrf_select}\n"
-                        temp_str += "end\n"
-                temp_str += f"""
-                config system auto-scale
-                    set status enable
-                    set sync-interface "{self.fgt_primary_port}"
-                    set role primary
-                    set psksecret "{self.fgt_system_autoscale_psksecret}"
-                end
-                """
-                if self.health_check_port != 0 and self.health_check_protocol == "HTTP":
-                    temp_str += f"""
-                    config system probe-response
-                        set mode http-probe
-                        set port "{self.health_check_port}"
-                    end
-                """
+                sections.update(self.gen_primary_autoscale_config())
             else:
                 autoscale_role = "Secondary"
-                temp_str = ""
-                if self.fmg_integration and not self.fmg_integration.get("primary_only", False):
-                    fmg_ip = self.fmg_integration.get("ip", "")
-                    fmg_sn = self.fmg_integration.get("sn", "")
-                    fmg_vrf_select = self.fmg_integration.get("vrf_select", "")
-                    if fmg_ip and fmg_sn:
-                        temp_str += f"""
-                        config system central-management
-                            set type fortimanager
-                            set fmg {fmg_ip}
-                            set serial-number {fmg_sn}
-                        """
-                        if fmg_vrf_select:
-                            temp_str += f"set vrf-select {fmg_vrf_select}\n"
-                        temp_str += "end\n"
-                temp_str += f"""
-                config system auto-scale
-                    set status enable
-                    set sync-interface "{self.fgt_primary_port}"
-                    set role secondary
-                    set primary-ip {primary_ip}
-                    set psksecret "{self.fgt_system_autoscale_psksecret}"
-                end
-                """
-            rst += re.sub(r"([\n ])\1*", r"\1", temp_str)
+                sections.update(self.gen_secondary_autoscale_config(primary_ip, with_fmg=True))
             self.update_tags(
                 [fgt_vm_id], 
                 [{
@@ -1959,22 +3558,89 @@ class FgtConf:
             )
 
         # User configuration
+        rst = ""
         if user_conf:
             rst += user_conf
             rst += "\n"
         
         if user_conf_s3:
-            for bucket_name, key_list in user_conf_s3.items():
-                for key_name in key_list:
-                    cur_user_conf = self.get_s3_file_content(bucket_name, key_name)
-                    if cur_user_conf:
-                        rst += cur_user_conf
-                        rst += "\n"
+            for cur_user_conf in self.get_s3_file_contents(user_conf_s3):
+                if cur_user_conf:
+                    rst += cur_user_conf
+                    rst += "\n"
+        sections["user_config"] = rst
                         
-        return rst
+        return sections
+
+    def get_geneve_blocks(self, intf_name, intf_conf):
+        # GENEVE block of every AZ of the interface, rendered once per container
+        if intf_name not in self.runtime.geneve_blocks:
+            gwlb_ips = self.runtime.gwlb_ips
+            az_name_map = self.runtime.az_name_map
+            geneve_blocks = {}
+            for az_name, subnet_id in intf_conf["subnet_id_map"].items():
+                if not subnet_id:
+                    geneve_blocks[az_name] = (None, f"Could not get the Subnet ID of AZ: {az_name}")
+                    continue
+                gwlb_ip = gwlb_ips.get(subnet_id)
+                if not gwlb_ip:
+                    geneve_blocks[az_name] = (None, f"Could not get the GWLB ip for subnet: {subnet_id}")
+                    continue
+                geneve_block = CliTemplate.render(
+                    "geneve",
+                    geneve_name=az_name_map.get(az_name, az_name),
+                    port_index=intf_conf.get("device_index") + 1,
+                    gwlb_ip=gwlb_ip
+                )
+                geneve_blocks[az_name] = (geneve_block, None)
+            self.runtime.geneve_blocks[intf_name] = geneve_blocks
+        return self.runtime.geneve_blocks[intf_name]
 
-    def upload_config(self, config_content, fgt_private_ip):
-        self.logger.info("Upload configuration to FortiGate instance.")
+# Digest of the configuration applied on each instance
+    def get_config_digests(self, fgt_vm_id):
+        record = self.dydb.get_record(self.config_digest_prefix + fgt_vm_id)
+        try:
+            return json.loads(record.get("digests") or "{}")
+        except ValueError as err:
+            self.logger.error(f"Could not parse configuration digest of instance {fgt_vm_id}: {err}")
+        return {}
+
+    def save_config_digests(self, fgt_vm_id, digest_dict):
+        attribute_dict = {
+            "instance_id": fgt_vm_id,
+            "digests": json.dumps(digest_dict, sort_keys=True)
+        }
+        return self.dydb.put_record(self.config_digest_prefix + fgt_vm_id, attribute_dict)
+
+    def get_changed_config(self, fgt_vm_id, sections):
+        # Returns the configuration of the sections that are not applied yet, and the digests after it is applied
+        digest_dict = self.get_config_digests(fgt_vm_id)
+        config_content = ""
+        changed_list = []
+        for section_name, section_content in sections.items():
+            if not section_content:
+                continue
+            section_digest = hashlib.sha256(section_content.encode("utf-8")).hexdigest()
+            if digest_dict.get(section_name) == section_digest:
+                continue
+            digest_dict[section_name] = section_digest
+            config_content += section_content
+            changed_list.append(section_name)
+        self.logger.info(f"Changed configuration sections of instance {fgt_vm_id}: {changed_list}")
+        return config_content, digest_dict
+
+    def push_config_sections(self, fgt_vm_id, fgt_private_ip, sections):
+        config_content, digest_dict = self.get_changed_config(fgt_vm_id, sections)
+        if not config_content:
+            return True
+        b_succ = self.upload_config(config_content, fgt_private_ip, confirm=True)
+        if b_succ:
+            self.save_config_digests(fgt_vm_id, digest_dict)
+        return b_succ
+
+    def upload_config(self, config_content, fgt_private_ip, confirm=False):
+        # Without confirm, the upload is fire and forget and only the invocation is checked
+        self.logger.info(f"Upload configuration to FortiGate instance {fgt_private_ip}.")
         payload = {
             "service" : "fgt_vm",
             "operation" : "upload_config",
@@ -1983,44 +3649,63 @@ class FgtConf:
                 "config_content": config_content
             }
         }
-        b_succ, response = self.invoke_lambda(payload, "fgt", "Event")
+        b_succ, response = self.invoke_lambda(payload, "fgt", "" if confirm else "Event")
         return b_succ
 
     def get_s3_file_content(self, bucket_name, key_name):
         self.logger.info(f"Get S3 object content of bucket: {bucket_name}, key_name: {key_name}.")
         s3_file_content = ""
+        cache_key = f"s3://{bucket_name}/{key_name}"
+        cached = ContentCache.get(cache_key)
         try:
-            response = self.s3_client.get_object(
-                Bucket=bucket_name,
-                Key=key_name
-            )
+            kwargs = {
+                "Bucket": bucket_name,
+                "Key": key_name
+            }
+            if cached:
+                kwargs["IfNoneMatch"] = cached["version"]
+            response = self.s3_client.get_object(**kwargs)
             s3_file_content = response.get("Body").read().decode('utf-8') 
+            if response.get("ETag"):
+                ContentCache.put(cache_key, response["ETag"], s3_file_content)
         except ClientError as e:
-            self.logger.error(f"Could not get S3 object: {e}")
+            if cached and e.response['Error']['Code'] in ["304", "NotModified"]:
+                self.logger.info(f"S3 object {cache_key} not modified, use cached content.")
+                s3_file_content = cached["content"]
+            else:
+                self.logger.error(f"Could not get S3 object: {e}")
         return s3_file_content
 
-    def change_password(self, fgt_private_ip, fgt_vm_id):
-        self.logger.info("Change password.")
-        payload = {
-            "service" : "fgt_vm",
-            "operation" : "change_password",
-            "parameters" : {
-                "private_ip" : fgt_private_ip,
-                "fgt_vm_id": fgt_vm_id
-            }
-        }
-        b_succ, response = self.invoke_lambda(payload, "fgt")
-        return b_succ
+    def get_s3_file_contents(self, user_conf_s3):
+        # Fetch all user configuration files concurrently, the content keeps the configured order
+        s3_object_dict = {}
+        for bucket_name, key_list in user_conf_s3.items():
+            for key_name in key_list:
+                s3_object_dict[(bucket_name, key_name)] = (bucket_name, key_name)
+        content_dict = Helper.run_concurrently(
+            self.logger,
+            lambda s3_object: self.get_s3_file_content(*s3_object),
+            s3_object_dict,
+            self.fanout_concurrency
+        )
+        return [content_dict.get(s3_object) for s3_object in s3_object_dict]
 
     def get_user_config_from_dydb(self):
         self.logger.info("Get user configuration from DynamoDB.")
         rst = ""
         try:
+            # Content is only read when its version differs from the cached one
+            version = self.get_item_from_dydb("user_config", ["version"]).get("version")
+            cached = ContentCache.get("dynamodb/user_config") if version else None
+            if cached and cached["version"] == version:
+                return cached["content"]
             response = self.get_item_from_dydb("user_config", ["content"])
             if response:
                 rst = response.get('content')
                 if rst:
                     rst = base64.b64decode(rst).decode('utf-8') 
+            if version:
+                ContentCache.put("dynamodb/user_config", version, rst)
         except Exception as err:
             self.logger.error(f"Could not get instance list of ASG: {err}")
         return rst
@@ -2048,9 +3733,73 @@ def clean_terminated_vms(logger, intf_object, fgtconf_object):
         fgtconf_object.set_vm_id(vm_id)
         fgtconf_object.do_terminate()
 
+def clean_orphan_intfs(logger, instance_snapshot, vm_id, intf_record):
+    intf_object = NetworkInterface(logger, instance_snapshot=instance_snapshot)
+    intf_object.set_vm_id(vm_id)
+    intf_object.do_terminate(intf_record)
+
+def refresh_sn_inventory(logger):
+    logger.info("Refresh serial number inventory.")
+    fgtconf_object = FgtConf(logger)
+    if not fgtconf_object.need_license or fgtconf_object.fgt_lic_mgmt == "fmg":
+        logger.info("Licenses are not managed by the Lambda function, skip it.")
+        return
+    fgtconf_object.dydb.begin_batch(fgtconf_object.get_prefetch_items("refresh_sn_inventory"))
+    try:
+        if not fgtconf_object.update_all_sn_list():
+            logger.info("No serial number found.")
+    finally:
+        fgtconf_object.dydb.end_batch()
+    if fgtconf_object.token_pool_size:
+        fgtconf_object.refill_token_pool()
+
+def refill_token_pool(logger):
+    fgtconf_object = FgtConf(logger)
+    if not fgtconf_object.token_pool_size:
+        logger.info("Token pool is disabled, skip it.")
+        return
+    fgtconf_object.refill_token_pool()
+
+def reconcile(logger):
+    logger.info("Reconcile resources of terminated instances.")
+    max_workers = int(os.getenv("reconcile_concurrency") or 4)
+    instance_snapshot = InstanceSnapshot(logger)
+    intf_object = NetworkInterface(logger, instance_snapshot=instance_snapshot)
+    fgtconf_object = FgtConf(logger, instance_snapshot=instance_snapshot)
+    fgtconf_object.dydb.begin_batch(fgtconf_object.get_prefetch_items("reconcile"))
+    try:
+        # Collect every instance that still owns an interface record, ASG record, license or serial number in one pass
+        intf_records = intf_object.list_intf_records()
+        owner_id_set = set(intf_records) | fgtconf_object.get_resource_owner_set()
+        orphan_id_list = []
+        for vm_id in sorted(owner_id_set):
+            try:
+                if instance_snapshot.is_gone(vm_id):
+                    orphan_id_list.append(vm_id)
+            except ClientError as err:
+                logger.error(f"Could not check state of instance {vm_id}, skip it: {err}")
+        if not orphan_id_list:
+            logger.info("No orphaned instance found.")
+            return
+        logger.info(f"Found orphaned instances: {orphan_id_list}")
+        # Release interfaces and Elastic IPs of orphaned instances concurrently
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(clean_orphan_intfs, logger, instance_snapshot, vm_id, intf_records[vm_id]): vm_id
+                for vm_id in orphan_id_list if vm_id in intf_records
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as err:
+                    logger.error(f"Could not clean up interfaces of instance {futures[future]}: {err}")
+        fgtconf_object.release_orphans(orphan_id_list, max_workers)
+    finally:
+        fgtconf_object.dydb.end_batch()
+
 def complete_lifecycle(logger, event_detail):
     logger.info("Complete lifecycle action.")
-    asg_client = boto3.client('autoscaling')
+    asg_client = Runtime.get().client("autoscaling")
     try:
         asg_client.complete_lifecycle_action(
             LifecycleHookName=event_detail.get('LifecycleHookName', ""),
@@ -2064,16 +3813,43 @@ def complete_lifecycle(logger, event_detail):
 def lambda_handler(event, context):
     logger = logging.getLogger("fgt_asg_lambda")
     logger.setLevel(logging.INFO)
+    if event.get("refresh_runtime"):
+        logger.info("Refresh runtime clients and configuration.")
+        Runtime.refresh()
+    # Scheduled operations
+    operation = event.get("operation")
+    if operation == "reconcile":
+        reconcile(logger)
+        return {}
+    elif operation == "refresh_sn_inventory":
+        refresh_sn_inventory(logger)
+        return {}
+    elif operation == "refill_token_pool":
+        refill_token_pool(logger)
+        return {}
+    elif operation == "broadcast_config":
+        if not event.get("config_content"):
+            logger.error("Could not find config_content for broadcast_config operation.")
+            return {}
+        fgtconf_object = FgtConf(logger)
+        fgtconf_object.set_deadline(context.get_remaining_time_in_millis())
+        return fgtconf_object.broadcast_config(event["config_content"], event.get("instance_ids"))
+    elif operation:
+        logger.error(f"Unknown operation: {operation}")
+        return {}
     event_detail = event["detail"]
     fgt_vm_id = event["detail"]["EC2InstanceId"]
     detail_type = event["detail-type"]
 
-    # Initiate objects
-    intf_object = NetworkInterface(logger)
-    fgtconf_object = FgtConf(logger)
+    # Initiate objects, instances are described once and shared by both of them
+    instance_snapshot = InstanceSnapshot(logger)
+    intf_object = NetworkInterface(logger, instance_snapshot=instance_snapshot)
+    fgtconf_object = FgtConf(logger, instance_snapshot=instance_snapshot)
+    fgtconf_object.set_deadline(context.get_remaining_time_in_millis())
 
-    # If detail_type is launch related, check and clean the VMs before main operation
-    if detail_type in ["EC2 Instance-launch Lifecycle Action", "EC2 Instance Launch Successful"]:
+    # Without the scheduled reconciler, check and clean the VMs before launch related operation
+    enable_reconcile = os.getenv("enable_reconcile") == "true"
+    if not enable_reconcile and detail_type in ["EC2 Instance-launch Lifecycle Action", "EC2 Instance Launch Successful"]:
         clean_terminated_vms(logger, intf_object, fgtconf_object)
 
     ## Network Interface operations
@@ -2084,9 +3860,11 @@ def lambda_handler(event, context):
     fgtconf_object.set_vm_id(fgt_vm_id)
     fgtconf_object.main(detail_type)
 
-    # If detail_type is terminate related, check and clean the VMs after main operation
-    if detail_type == "EC2 Instance-terminate Lifecycle Action":
+    # Without the scheduled reconciler, check and clean the VMs after terminate related operation
+    if not enable_reconcile and detail_type == "EC2 Instance-terminate Lifecycle Action":
         clean_terminated_vms(logger, intf_object, fgtconf_object)
+    # Confirm asynchronous writes and uploads before the lifecycle action is completed
+    fgtconf_object.wait_ops()
     if detail_type in ["EC2 Instance-launch Lifecycle Action", "EC2 Instance-terminate Lifecycle Action"]:
         complete_lifecycle(logger, event_detail)
     return {}
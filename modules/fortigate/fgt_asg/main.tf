@@ -318,6 +318,20 @@ resource "aws_dynamodb_table" "track_table" {
     name = "Category"
     type = "S"
   }
+  attribute {
+    name = "record_type"
+    type = "S"
+  }
+  # Per-instance records are listed by record type instead of scanning the table
+  global_secondary_index {
+    name            = "record_type-index"
+    hash_key        = "record_type"
+    projection_type = "ALL"
+  }
+  ttl {
+    attribute_name = "expire_at"
+    enabled        = true
+  }
   tags = merge(
     lookup(var.tags, "general", {}),
     lookup(var.tags, "dynamodb", {})
@@ -332,7 +346,8 @@ resource "aws_dynamodb_table_item" "user_config" {
   item       = <<ITEM
 {
   "Category": {"S": "user_config"},
-  "content": {"S": "${base64encode(var.user_conf)}"}
+  "content": {"S": "${base64encode(var.user_conf)}"},
+  "version": {"S": "${md5(var.user_conf)}"}
 }
 ITEM
   depends_on = [aws_dynamodb_table.track_table]
@@ -351,6 +366,16 @@ resource "aws_vpc_endpoint" "dynamodb" {
   ))
 }
 
+# Route from the VPC of the internal Lambda function to S3 for staged payloads
+resource "aws_vpc_endpoint" "s3" {
+  count = var.s3_gateway_endpoint == null ? 0 : 1
+
+  vpc_id            = var.s3_gateway_endpoint.vpc_id
+  service_name      = "com.amazonaws.${var.s3_gateway_endpoint.region}.s3"
+  route_table_ids   = var.s3_gateway_endpoint.route_table_ids
+  vpc_endpoint_type = "Gateway"
+}
+
 resource "aws_s3_bucket" "fgt_lic" {
   count = var.lic_s3_name != null ? 0 : 1
 
@@ -366,6 +391,22 @@ resource "aws_s3_bucket" "fgt_lic" {
   }
 }
 
+resource "aws_s3_bucket_lifecycle_configuration" "fgt_lic" {
+  count = var.lic_s3_name != null ? 0 : 1
+
+  bucket = aws_s3_bucket.fgt_lic[0].id
+  rule {
+    id     = "expire-staged-payloads"
+    status = "Enabled"
+    filter {
+      prefix = "staged/"
+    }
+    expiration {
+      days = 1
+    }
+  }
+}
+
 resource "aws_s3_object" "fgt_lic" {
   for_each = local.lic_file_set
 
@@ -464,6 +505,12 @@ resource "aws_lambda_function" "fgt_asg_lambda" {
       primary_scalein_protection     = var.enable_fgt_system_autoscale && var.primary_scalein_protection
       health_check_port              = var.health_check_port
       health_check_protocol          = var.health_check_protocol
+      enable_reconcile               = var.reconcile_schedule_expression != ""
+      reconcile_concurrency          = var.reconcile_concurrency
+      sn_inventory_ttl               = var.sn_inventory_ttl
+      fortiflex_token_pool_size      = var.fortiflex_token_pool_size
+      lambda_timeout                 = var.lambda_timeout
+      fanout_concurrency             = var.fanout_concurrency
     }
   }
 
@@ -588,3 +635,45 @@ resource "aws_cloudwatch_event_target" "fgt_asg_terminate" {
   target_id = "${local.asg_name}_fgt_asg_terminate_target"
   arn       = aws_lambda_function.fgt_asg_lambda.arn
 }
+
+resource "aws_cloudwatch_event_rule" "fgt_asg_reconcile" {
+  count               = var.reconcile_schedule_expression != "" ? 1 : 0
+  name                = "${local.asg_name}_fgt_asg_reconcile"
+  description         = "Cloudwatch event rule for FortiGate Auto Scaling Group scheduled clean up of terminated instances."
+  schedule_expression = var.reconcile_schedule_expression
+  tags = merge(
+    lookup(var.tags, "general", {}),
+    lookup(var.tags, "cloudwatch", {})
+  )
+}
+
+resource "aws_cloudwatch_event_target" "fgt_asg_reconcile" {
+  count     = var.reconcile_schedule_expression != "" ? 1 : 0
+  rule      = aws_cloudwatch_event_rule.fgt_asg_reconcile[0].name
+  target_id = "${local.asg_name}_fgt_asg_reconcile_target"
+  arn       = aws_lambda_function.fgt_asg_lambda.arn
+  input = jsonencode({
+    operation = "reconcile"
+  })
+}
+
+resource "aws_cloudwatch_event_rule" "fgt_asg_sn_inventory" {
+  count               = var.sn_inventory_schedule_expression != "" && length(var.fortiflex_configid_list) > 0 ? 1 : 0
+  name                = "${local.asg_name}_fgt_asg_sn_inventory"
+  description         = "Cloudwatch event rule for FortiGate Auto Scaling Group scheduled refresh of FortiFlex serial number inventory."
+  schedule_expression = var.sn_inventory_schedule_expression
+  tags = merge(
+    lookup(var.tags, "general", {}),
+    lookup(var.tags, "cloudwatch", {})
+  )
+}
+
+resource "aws_cloudwatch_event_target" "fgt_asg_sn_inventory" {
+  count     = var.sn_inventory_schedule_expression != "" && length(var.fortiflex_configid_list) > 0 ? 1 : 0
+  rule      = aws_cloudwatch_event_rule.fgt_asg_sn_inventory[0].name
+  target_id = "${local.asg_name}_fgt_asg_sn_inventory_target"
+  arn       = aws_lambda_function.fgt_asg_lambda.arn
+  input = jsonencode({
+    operation = "refresh_sn_inventory"
+  })
+}
@@ -301,7 +301,7 @@ variable "create_dynamodb_table" {
 }
 
 variable "dynamodb_table_name" {
-  description = "DynamoDB table name that used for tracking Auto Scale Group information, such as instance information and primary IP."
+  description = "DynamoDB table name that used for tracking Auto Scale Group information, such as instance information and primary IP. A table not created by this module should have a global secondary index record_type-index with hash key record_type (String), otherwise per-instance records are listed by scanning the table."
   type        = string
 }
 
@@ -389,12 +389,57 @@ variable "dynamodb_privatelink" {
   default = null
 }
 
+variable "s3_gateway_endpoint" {
+  description = <<-EOF
+  S3 gateway endpoint for the VPC of the internal Lambda function.
+  Configuration and license content over the Lambda invocation payload limit is staged in the S3 bucket lic_s3_name under the prefix staged/, and the internal Lambda function, which runs in the VPC, reads it from there. Create the endpoint if the subnets of the internal Lambda function have no other route to S3, such as a NAT gateway.
+  Staged objects are deleted once the operation is done. Objects left by failed operations are expired after 1 day only in the bucket created by this module, add a lifecycle rule for the prefix staged/ to a bucket given by lic_s3_name.
+  Options:
+    - vpc_id          : (Required|string) VPC ID that will used to create gateway endpoint.
+    - region          : (Required|string) The region to deploy the gateway endpoint.
+    - route_table_ids : (Required|list) Route table ID list of the subnets of the internal Lambda function.
+
+  Example:
+  ```
+  s3_gateway_endpoint = {
+    vpc_id = \<VPC_id\>
+    region = "us-west-1"
+    route_table_ids = ["\<route_table_id\>"]
+  }
+  ```
+  EOF
+  type = object({
+    vpc_id          = string
+    region          = string
+    route_table_ids = list(string)
+  })
+  default = null
+}
+
 variable "lambda_timeout" {
   description = "Amount of time your Lambda Function has to run in seconds. Defaults to 300."
   type        = number
   default     = 300
 }
 
+variable "fanout_concurrency" {
+  description = "Maximum number of FortiGate instances that are health checked or reconfigured concurrently, such as when a new primary instance is elected. Default is 10."
+  type        = number
+  default     = 10
+}
+
+variable "reconcile_schedule_expression" {
+  description = "Schedule expression of the EventBridge rule that triggers the reconciler to clean up interfaces, Elastic IPs, licenses and serial numbers left by terminated instances. If set to empty string, the clean up runs on every launch and terminate event instead. Default is rate(15 minutes)."
+  type        = string
+  default     = "rate(15 minutes)"
+}
+
+variable "reconcile_concurrency" {
+  description = "Maximum number of orphaned instances that the reconciler cleans up concurrently. Default is 4."
+  type        = number
+  default     = 4
+}
+
 variable "lic_s3_name" {
   description = "AWS S3 bucket name that contains FortiGate license files or token json file."
   type        = string
@@ -437,6 +482,24 @@ variable "fortiflex_configid_list" {
   default     = []
 }
 
+variable "fortiflex_token_pool_size" {
+  description = "Number of FortiFlex VM tokens that are generated ahead and kept in the DynamoDB table, so a launching instance gets its token without calling FortiFlex. Serial numbers in the pool are reactivated and consume points while waiting. The pool is refilled in the background after each launch and on the serial number inventory refresh. Default is 0, which disables the pool."
+  type        = number
+  default     = 0
+}
+
+variable "sn_inventory_ttl" {
+  description = "Seconds that the FortiFlex serial number inventory cached in the DynamoDB table stays fresh. Launch and terminate events only sync the inventory with FortiFlex when it is older than this, empty, or has no available serial number left. Default is 3600."
+  type        = number
+  default     = 3600
+}
+
+variable "sn_inventory_schedule_expression" {
+  description = "Schedule expression of the EventBridge rule that refreshes the FortiFlex serial number inventory of fortiflex_configid_list. If set to empty string, the inventory is only refreshed by launch and terminate events when it is stale. Default is rate(30 minutes)."
+  type        = string
+  default     = "rate(30 minutes)"
+}
+
 variable "mgmt_intf_index" {
   description = "Management interface device index that will used on Lambda function to connect with FortiGate instance."
   type        = number